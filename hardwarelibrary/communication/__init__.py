@@ -1,9 +1,16 @@
 from .communicationport import *
 from .serialport import SerialPort
+from .serialportpool import SerialPortPool
 from .usbport import USBPort
+from .ringbuffer import RingBuffer
+from .timingpolicy import TimingPolicy, conservativeTiming, fastTiming
+from .portstatistics import PortStatistics
+from .usbdescriptorcache import USBDescriptorCache, USBDeviceStrings
 from .diagnostics import USBParameters, DeviceCommand, USBDeviceDescription
-from .debugport import DebugPort
+from .debugport import DebugPort, DebugEndPoint
 from .echoport import DebugEchoPort
+from .recordingport import RecordingPort, ReplayPort, RecordedEvent, ReplayMismatch
+from .asynccommunicationport import AsyncCommunicationPort, AsyncSerialPort
 import usb.backend.libusb1
 import platform
 from pathlib import *
@@ -0,0 +1,232 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from weakref import WeakKeyDictionary
+
+from .communicationport import *
+
+# port -> {loop: asyncio.Lock}, shared by all the wrappers of a port
+asyncTransactionLocks = WeakKeyDictionary()
+
+class AsyncCommunicationPort:
+    """AsyncCommunicationPort wraps any CommunicationPort (USBPort,
+    SerialPort, DebugPort...) to offer the same application-level functions
+    as coroutines, so that many instruments can be driven from a single
+    asyncio loop without dedicating a thread to each blocking read.
+
+    The blocking calls of the underlying port run in an executor (the
+    loop's default executor unless one is provided). Transactions (write
+    then read a reply) are serialized between coroutines with an
+    asyncio.Lock, one per underlying port (the port's transactionLock is
+    reentrant, it cannot exclude two wrappers used from the same loop
+    thread). They still take the port's transactionLock, so threads that
+    use the port directly are excluded as before.
+
+    Calls that only take the port's portLock briefly are made on the loop
+    when portLock is free, in the executor otherwise: a thread using the
+    port directly may hold it during a blocking read.
+    """
+
+    def __init__(self, port, executor=None):
+        self.port = port
+        self.executor = executor
+
+    @property
+    def isOpen(self):
+        return self.port.isOpen
+
+    @property
+    def asyncTransactionLock(self):
+        # Created on first use, inside the running loop
+        locksByLoop = asyncTransactionLocks.setdefault(self.port, WeakKeyDictionary())
+        loop = asyncio.get_running_loop()
+        lock = locksByLoop.get(loop)
+        if lock is None:
+            lock = asyncio.Lock()
+            locksByLoop[loop] = lock
+        return lock
+
+    async def runInExecutor(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def runWithPortLock(self, function, *args):
+        """ function(*args) must not block once it has the portLock """
+        if self.port.portLock.acquire(blocking=False):
+            try:
+                return function(*args)
+            finally:
+                self.port.portLock.release()
+        return await self.runInExecutor(function, *args)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """ Exclusive access to the port for a command and its reply, from
+        coroutines of this loop and from other threads. """
+        async with self.asyncTransactionLock:
+            while not self.port.transactionLock.acquire(blocking=False):
+                # Another thread has it: wait for its release in the executor
+                await self.runInExecutor(self.waitForTransactionLock)
+            try:
+                yield self
+            finally:
+                self.port.transactionLock.release()
+
+    def waitForTransactionLock(self):
+        with self.port.transactionLock:
+            pass
+
+    async def open(self, *args, **kwargs):
+        return await self.runInExecutor(self.port.open, *args, **kwargs)
+
+    async def close(self):
+        return await self.runInExecutor(self.port.close)
+
+    async def flush(self):
+        return await self.runInExecutor(self.port.flush)
+
+    async def bytesAvailable(self, endPoint=None) -> int:
+        return await self.runWithPortLock(self.port.bytesAvailable, endPoint)
+
+    async def writeData(self, data, endPoint=None) -> int:
+        return await self.runInExecutor(self.port.writeData, data, endPoint)
+
+    async def readData(self, length, endPoint=None) -> bytearray:
+        return await self.runInExecutor(self.port.readData, length, endPoint)
+
+    async def writeString(self, string, endPoint=None) -> int:
+        return await self.runInExecutor(self.port.writeString, string, endPoint)
+
+    async def readString(self, endPoint=None) -> str:
+        return await self.runInExecutor(self.port.readString, endPoint)
+
+    async def readMatchingGroups(self, replyPattern, alternatePattern=None, endPoint=None):
+        reply = await self.readString(endPoint=endPoint)
+
+        match = compiledPattern(replyPattern).search(reply)
+
+        if match is not None:
+            return reply, match.groups()
+        else:
+            raise CommunicationReadNoMatch("Unable to match pattern:'{0}' in reply:'{1}'".format(replyPattern, reply))
+
+    async def writeStringExpectMatchingString(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        async with self.asyncTransactionLock:
+            return await self.runInExecutor(self.port.writeStringExpectMatchingString, string, replyPattern, alternatePattern, endPoints)
+
+    async def writeStringReadFirstMatchingGroup(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        async with self.asyncTransactionLock:
+            return await self.runInExecutor(self.port.writeStringReadFirstMatchingGroup, string, replyPattern, alternatePattern, endPoints)
+
+    async def writeStringReadMatchingGroups(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        async with self.asyncTransactionLock:
+            return await self.runInExecutor(self.port.writeStringReadMatchingGroups, string, replyPattern, alternatePattern, endPoints)
+
+
+class AsyncSerialPort(AsyncCommunicationPort):
+    """AsyncSerialPort waits for serial data with loop.add_reader() on the
+    file descriptor of the pyserial port instead of blocking a thread.
+    When there is no file descriptor (pyftdi URLs, Windows, loops without
+    add_reader), it falls back to the executor like AsyncCommunicationPort.
+    Writes always go through the executor: a pyserial write blocks when the
+    output buffer is full and waits for the portLock.
+    """
+
+    def __init__(self, port, executor=None):
+        super().__init__(port, executor=executor)
+
+    @property
+    def fileDescriptor(self):
+        try:
+            return self.port.port.fileno()
+        except Exception:
+            return None
+
+    @property
+    def readTimeout(self):
+        try:
+            return self.port.port.timeout
+        except AttributeError:
+            return None
+
+    async def waitUntilReadable(self, fileDescriptor, timeout):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def setReadable():
+            if not readable.done():
+                readable.set_result(True)
+
+        loop.add_reader(fileDescriptor, setReadable)
+        try:
+            await asyncio.wait_for(readable, timeout)
+        finally:
+            loop.remove_reader(fileDescriptor)
+
+    async def fillReadBuffer(self, endPoint=None):
+        fileDescriptor = self.fileDescriptor
+        if fileDescriptor is None:
+            raise NotImplementedError("No file descriptor to wait on")
+
+        if await self.runWithPortLock(self.port.readAvailableIntoBuffer, endPoint) > 0:
+            return
+
+        try:
+            await self.waitUntilReadable(fileDescriptor, self.readTimeout)
+        except asyncio.TimeoutError:
+            raise CommunicationReadTimeout("Nothing received within {0} s".format(self.readTimeout))
+
+        await self.runWithPortLock(self.port.readAvailableIntoBuffer, endPoint)
+
+    async def readString(self, endPoint=None) -> str:
+        try:
+            while True:
+                string = await self.runWithPortLock(self.port.readBufferedString)
+                if string is not None:
+                    return string
+                await self.fillReadBuffer(endPoint)
+        except NotImplementedError:
+            return await super().readString(endPoint)
+
+    async def readData(self, length, endPoint=None) -> bytearray:
+        try:
+            while await self.bytesAvailable(endPoint) < length:
+                await self.fillReadBuffer(endPoint)
+        except NotImplementedError:
+            return await super().readData(length, endPoint)
+
+        # Everything is in the receive buffer: does not block
+        return await self.runWithPortLock(self.port.readData, length, endPoint)
+
+    async def writeStringExpectMatchingString(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        async with self.transaction():
+            await self.writeString(string, endPoints[0])
+            reply = await self.readString(endPoints[1])
+            match = compiledPattern(replyPattern).search(reply)
+            if match is None:
+                if alternatePattern is not None:
+                    match = compiledPattern(alternatePattern).search(reply)
+                    if match is None:
+                        raise CommunicationReadAlternateMatch(reply)
+                raise CommunicationReadNoMatch("Unable to find first group with pattern:'{0}'".format(replyPattern))
+
+        return reply
+
+    async def writeStringReadFirstMatchingGroup(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        reply, groups = await self.writeStringReadMatchingGroups(string, replyPattern, alternatePattern, endPoints)
+        if len(groups) >= 1:
+            return reply, groups[0]
+        else:
+            raise CommunicationReadNoMatch("Unable to find first group with pattern:'{0}' in {1}".format(replyPattern, groups))
+
+    async def writeStringReadMatchingGroups(self, string, replyPattern, alternatePattern=None, endPoints=(None, None)):
+        async with self.transaction():
+            await self.writeString(string, endPoints[0])
+            reply = await self.readString(endPoints[1])
+
+            match = compiledPattern(replyPattern).search(reply)
+
+            if match is not None:
+                return reply, match.groups()
+            else:
+                raise CommunicationReadNoMatch("Unable to match pattern:'{0}' in reply:'{1}'".format(replyPattern, reply))
@@ -1,6 +1,116 @@
 import re
+import struct
+from functools import lru_cache
+import numpy as np
+
+@lru_cache(maxsize=256)
+def compiledPattern(pattern):
+    """ Returns the compiled regular expression for pattern (a string or an
+    already compiled pattern). Ad-hoc patterns passed to the ports as
+    strings are compiled once and kept in this LRU cache. """
+    if pattern is None:
+        return None
+    return re.compile(pattern)
+
+@lru_cache(maxsize=256)
+def compiledStruct(format):
+    """ Returns the struct.Struct for format (a format string or an already
+    compiled struct.Struct), compiled only once. """
+    if format is None:
+        return None
+    if isinstance(format, struct.Struct):
+        return format
+    return struct.Struct(format)
+
+class StructLayout:
+    """ A binary record declared once with a struct format and decoded
+    straight from any buffer (bytes, bytearray, array.array, memoryview)
+    into recordType: a NamedTuple class, a NumPy structured dtype or None
+    for plain tuples. """
+    def __init__(self, format, recordType=None):
+        self.struct = compiledStruct(format)
+        self.recordType = recordType
+        self.isStructuredArray = isinstance(recordType, np.dtype)
+        if self.isStructuredArray and recordType.itemsize != self.struct.size:
+            raise ValueError("dtype itemsize {0} does not match format size {1}".format(recordType.itemsize, self.struct.size))
+
+    @property
+    def format(self):
+        return self.struct.format
+
+    @property
+    def size(self):
+        return self.struct.size
+
+    def pack(self, *values) -> bytes:
+        return self.struct.pack(*values)
+
+    def packInto(self, buffer, offset, *values):
+        self.struct.pack_into(buffer, offset, *values)
+
+    def unpack(self, buffer, offset=0):
+        """ Decodes a single record starting at offset. """
+        if self.isStructuredArray:
+            return np.frombuffer(buffer, dtype=self.recordType, count=1, offset=offset)[0]
+
+        values = self.struct.unpack_from(buffer, offset)
+        if self.recordType is None:
+            return values
+        return self.recordType._make(values)
+
+    def unpackAll(self, buffer, count=None):
+        """ Decodes consecutive records: a NumPy structured array if recordType
+        is a dtype, otherwise a list. Without count, decodes as many complete
+        records as the buffer holds. """
+        view = memoryview(buffer).cast('B')
+        if count is None:
+            count = len(view) // self.size
+
+        if self.isStructuredArray:
+            return np.frombuffer(view, dtype=self.recordType, count=count)
+
+        records = self.struct.iter_unpack(view[:count * self.size])
+        if self.recordType is not None:
+            return [ self.recordType._make(values) for values in records ]
+        return list(records)
+
+class CommandResult:
+    """ The outcome of one Command.execute(): what was sent, the raw reply,
+    the regex groups (TextCommand) or decoded values (BinaryCommand).
+    It cannot be modified, so the same command definition can be executed
+    from many threads or for many devices at the same time. """
+    __slots__ = ('name', 'payload', 'reply', 'matchGroups', 'values')
+
+    def __init__(self, name, payload=None, reply=None, matchGroups=None, values=None):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'payload', payload)
+        object.__setattr__(self, 'reply', reply)
+        object.__setattr__(self, 'matchGroups', matchGroups)
+        object.__setattr__(self, 'values', values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CommandResult is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CommandResult is immutable")
+
+    def __repr__(self):
+        return "CommandResult(name={0!r}, reply={1!r}, matchGroups={2!r}, values={3!r})".format(self.name, self.reply, self.matchGroups, self.values)
+
+    def matchAsFloat(self, index=0):
+        if self.matchGroups is not None:
+            return float(self.matchGroups[index])
+        return None
 
 class Command:
+    """ A command definition. execute() sends it and returns a CommandResult
+    without modifying the command, so definitions can be shared (e.g. in a
+    class-level `commands` dictionary). send() is the older interface that
+    keeps the last reply and the exceptions in the command itself. """
+
+    # send() keeps only this many exceptions in self.exceptions
+    maximumExceptionCount = 10
+
     def __init__(self, name:str, endPoints = (None, None)):
         self.name = name
         self.reply = None
@@ -31,9 +141,28 @@ class Command:
     def hasError(self):
         return len(self.exceptions) != 0
 
+    def execute(self, port, *arguments, onSent=None) -> CommandResult:
+        """ onSent() is called once the request is written, before the
+        reply is read (send() uses it to set isSent). """
+        raise NotImplementedError("Subclasses must implement the execute() command")
+
     def send(self, port) -> bool:
         raise NotImplementedError("Subclasses must implement the send() command")
 
+    def markSent(self):
+        self.isSent = True
+
+    def keepResult(self, result):
+        self.isSent = True
+        self.reply = result.reply
+        self.matchGroups = result.matchGroups
+        self.isSentSuccessfully = True
+
+    def keepException(self, error):
+        self.exceptions.append(error)
+        del self.exceptions[:-self.maximumExceptionCount]
+        self.isSentSuccessfully = False
+
 class TextCommand(Command):
     def __init__(self, name, text, replyPattern = None, 
                                    alternatePattern = None, 
@@ -42,6 +171,14 @@ class TextCommand(Command):
         self.text : str = text
         self.replyPattern: str = replyPattern
         self.alternatePattern: str = alternatePattern
+        self.replyRegex = compiledPattern(replyPattern)
+        self.alternateRegex = compiledPattern(alternatePattern)
+
+        match = re.search(r"\{(.*?)\}", self.text)
+        if match is None:
+            self._numberOfArguments = 0
+        else:
+            self._numberOfArguments = len(match.groups())
 
     @property
     def payload(self):
@@ -49,36 +186,36 @@ class TextCommand(Command):
 
     @property
     def numberOfArguments(self):
-        match = re.search(r"\{(.*?)\}", self.text)
-        if match is None:
-            return 0
-        return len(match.groups())
+        return self._numberOfArguments
 
-    def send(self, port, params=None) -> bool:
-        try:
-            if params is not None:
-                textCommand = self.text.format(params)
-            else:
-                textCommand = self.text
+    def execute(self, port, params=None, onSent=None) -> CommandResult:
+        if params is not None:
+            textCommand = self.text.format(params)
+        else:
+            textCommand = self.text
 
-            if port is None:
-                raise RuntimeError("port cannot be None")
+        if port is None:
+            raise RuntimeError("port cannot be None")
 
+        reply = None
+        matchGroups = None
+        with port.transactionLock:
             port.writeString(string=textCommand, endPoint=self.endPoints[0])
-            self.isSent = True
-
-            if self.replyPattern is not None:
-                self.reply, self.matchGroups = port.readMatchingGroups(
-                           replyPattern=self.replyPattern,
-                           alternatePattern=self.alternatePattern,
+            if onSent is not None:
+                onSent()
+            if self.replyRegex is not None:
+                reply, matchGroups = port.readMatchingGroups(
+                           replyPattern=self.replyRegex,
+                           alternatePattern=self.alternateRegex,
                            endPoint=self.endPoints[1])
-            else:
-                pass
-            
-            self.isSentSuccessfully = True
+
+        return CommandResult(self.name, payload=textCommand, reply=reply, matchGroups=matchGroups)
+
+    def send(self, port, params=None) -> bool:
+        try:
+            self.keepResult(self.execute(port, params, onSent=self.markSent))
         except Exception as err:
-            self.exceptions.append(err)
-            self.isSentSuccessfully = False
+            self.keepException(err)
             return True
 
         return False
@@ -97,57 +234,65 @@ class MultilineTextCommand(Command):
         self.alternatePattern: str = alternatePattern
         self.lineCount = lineCount
         self.lastLinePattern = lastLinePattern
+        self.replyRegex = compiledPattern(replyPattern)
+        self.alternateRegex = compiledPattern(alternatePattern)
+        self.lastLineRegex = compiledPattern(lastLinePattern)
 
     @property
     def payload(self):
         return self.text
 
-    def send(self, port, params=None) -> bool:
-        try:
-            if params is not None:
-                textCommand = self.text.format(params)
-            else:
-                textCommand = self.text
+    def execute(self, port, params=None, onSent=None) -> CommandResult:
+        """ The reply and matchGroups of the result are tuples with one
+        element per line. """
+        if params is not None:
+            textCommand = self.text.format(params)
+        else:
+            textCommand = self.text
 
-            if port is None:
-                raise RuntimeError("port cannot be None")
+        if port is None:
+            raise RuntimeError("port cannot be None")
 
+        replies = []
+        matchGroups = []
+        with port.transactionLock:
             port.writeString(string=textCommand, endPoint=self.endPoints[0])
-            self.isSent = True
+            if onSent is not None:
+                onSent()
 
             if self.lineCount > 1:
-                self.reply = []
-                self.matchGroups = []
-
                 for i in range(self.lineCount):
-                    reply, matchGroups = port.readMatchingGroups(
-                        replyPattern=self.replyPattern,
-                        alternatePattern=self.alternatePattern,
+                    reply, groups = port.readMatchingGroups(
+                        replyPattern=self.replyRegex,
+                        alternatePattern=self.alternateRegex,
                         endPoint=self.endPoints[1])
-                    self.reply.append(reply)
-                    self.matchGroups.append(matchGroups)
+                    replies.append(reply)
+                    matchGroups.append(groups)
 
             elif self.lastLinePattern is not None:
-                self.reply = []
-                self.matchGroups = []
-
                 while True:
-                    reply, matchGroups = port.readMatchingGroups(
-                        replyPattern=self.replyPattern,
-                        alternatePattern=self.alternatePattern,
+                    reply, groups = port.readMatchingGroups(
+                        replyPattern=self.replyRegex,
+                        alternatePattern=self.alternateRegex,
                         endPoint=self.endPoints[1])
-                    self.reply.append(reply)
-                    self.matchGroups.append(matchGroups)
+                    replies.append(reply)
+                    matchGroups.append(groups)
 
-                    if re.search(self.lastLinePattern, reply) is not None:
+                    if self.lastLineRegex.search(reply) is not None:
                         break
             else:
                 raise Exception("lineCount and lastLinePattern cannot both be None")
 
-            self.isSentSuccessfully = True
+        return CommandResult(self.name, payload=textCommand, reply=tuple(replies), matchGroups=tuple(matchGroups))
+
+    def send(self, port, params=None) -> bool:
+        try:
+            result = self.execute(port, params, onSent=self.markSent)
+            self.keepResult(result)
+            self.reply = list(result.reply)
+            self.matchGroups = list(result.matchGroups)
         except Exception as err:
-            self.exceptions.append(err)
-            self.isSentSuccessfully = False
+            self.keepException(err)
             return True
 
         return False
@@ -165,19 +310,142 @@ class DataCommand(Command):
     def payload(self):
         return self.data
 
-    def send(self, port) -> bool:
-        try:
-            nBytes = port.writeData(data=self.data, endPoint=self.endPoints[0])
-            self.isSent = True
+    def execute(self, port, onSent=None) -> CommandResult:
+        reply = None
+        with port.transactionLock:
+            port.writeData(data=self.data, endPoint=self.endPoints[0])
+            if onSent is not None:
+                onSent()
             if self.replyDataLength > 0:
-                self.reply = port.readData(length=self.replyDataLength)
+                reply = port.readData(length=self.replyDataLength)
             elif self.replyHexRegex is not None:
                 raise NotImplementedError("DataCommand reply pattern not implemented")
-                # self.reply = port.readData(length=self.replyDataLength)
-            self.isSentSuccessfully = True
+
+        return CommandResult(self.name, payload=self.data, reply=reply)
+
+    def send(self, port) -> bool:
+        try:
+            self.keepResult(self.execute(port, onSent=self.markSent))
+        except Exception as err:
+            self.keepException(err)
+            raise(err)
+
+        return False
+
+
+class BinaryCommand(DataCommand):
+    """ A DataCommand whose request and reply are declared with struct
+    formats, compiled once, instead of being packed and unpacked by hand
+    on every call. For example, a Sutter move is:
+
+        BinaryCommand("MOVE", prefix=b'M', requestFormat='<lll', suffix=b'\\r', replyFormat='<c')
+
+    The request is prefix + requestFormat packed with the arguments given to
+    send() + suffix. The reply is framed in one of three ways:
+        - fixed (default): replyCount records of replyFormat,
+        - lengthFormat: a length field (e.g. '<H') giving the number of bytes that follow,
+        - terminator: everything up to and including the terminator.
+    It is decoded from a memoryview into replyType (NamedTuple class or NumPy
+    dtype) and kept in `values`: a single record when replyCount is 1,
+    otherwise a list or structured array (replyCount=None decodes as many
+    records as a length-prefixed or terminated frame holds).
+    """
+    def __init__(self, name, requestFormat=None, replyFormat=None, replyType=None,
+                       prefix=b'', suffix=b'', replyCount=1,
+                       lengthFormat=None, terminator=None,
+                       endPoints=(None, None)):
+        self.requestLayout = StructLayout(requestFormat) if requestFormat is not None else None
+        self.replyLayout = StructLayout(replyFormat, replyType) if replyFormat is not None else None
+        self.lengthStruct = compiledStruct(lengthFormat)
+        self.terminator = terminator
+        self.replyCount = replyCount
+        self.prefix = bytes(prefix)
+        self.suffix = bytes(suffix)
+
+        requestSize = 0 if self.requestLayout is None else self.requestLayout.size
+        template = self.prefix + bytes(requestSize) + self.suffix
+
+        replyDataLength = 0
+        if self.replyLayout is not None and lengthFormat is None and terminator is None and replyCount is not None:
+            replyDataLength = self.replyLayout.size * replyCount
+
+        DataCommand.__init__(self, name, data=template, replyDataLength=replyDataLength, endPoints=endPoints)
+        self.values = None
+
+        self._numberOfArguments = 0
+        if self.requestLayout is not None:
+            self._numberOfArguments = len(self.requestLayout.struct.unpack(bytes(requestSize)))
+
+    @property
+    def numberOfArguments(self):
+        return self._numberOfArguments
+
+    def request(self, *arguments) -> bytes:
+        """ The bytes to write for these arguments. """
+        if self.requestLayout is None:
+            return bytes(self.data)
+        return self.prefix + self.requestLayout.struct.pack(*arguments) + self.suffix
+
+    def readResult(self, port, payload=None) -> CommandResult:
+        """ Reads one framed reply from port and decodes it. """
+        endPoint = self.endPoints[1]
+        body = None
+        if self.lengthStruct is not None:
+            header = port.readData(self.lengthStruct.size, endPoint)
+            (length,) = self.lengthStruct.unpack_from(header)
+            reply = port.readData(length, endPoint)
+        elif self.terminator is not None:
+            reply = port.readDataUntil(self.terminator, endPoint)
+            body = memoryview(reply)[:len(reply) - len(self.terminator)]
+        else:
+            reply = port.readData(self.replyDataLength, endPoint)
+
+        if body is None:
+            body = memoryview(reply)
+
+        if self.replyLayout is None:
+            values = bytes(body)
+        elif self.replyCount == 1:
+            values = self.replyLayout.unpack(body)
+        else:
+            values = self.replyLayout.unpackAll(body, self.replyCount)
+
+        return CommandResult(self.name, payload=payload, reply=reply, values=values)
+
+    def readReply(self, port):
+        """ Same as readResult() but keeps the reply in the command (raw bytes
+        in self.reply, decoded in self.values) and returns the decoded values. """
+        result = self.readResult(port)
+        self.reply = result.reply
+        self.values = result.values
+        self.isReplyReceived = True
+        self.isReplyReceivedSuccessfully = True
+        return self.values
+
+    @property
+    def expectsReply(self):
+        return self.replyLayout is not None or self.lengthStruct is not None or self.terminator is not None
+
+    def execute(self, port, *arguments, onSent=None) -> CommandResult:
+        request = self.request(*arguments)
+        with port.transactionLock:
+            port.writeData(data=request, endPoint=self.endPoints[0])
+            if onSent is not None:
+                onSent()
+            if self.expectsReply:
+                return self.readResult(port, payload=request)
+
+        return CommandResult(self.name, payload=request)
+
+    def keepResult(self, result):
+        Command.keepResult(self, result)
+        self.values = result.values
+
+    def send(self, port, *arguments) -> bool:
+        try:
+            self.keepResult(self.execute(port, *arguments, onSent=self.markSent))
         except Exception as err:
-            self.exceptions.append(err)
-            self.isSentSuccessfully = False
+            self.keepException(err)
             raise(err)
 
         return False
@@ -4,7 +4,10 @@ import time
 import random
 import inspect
 from threading import RLock
+from typing import NamedTuple
 from .commands import *
+from .timingpolicy import *
+from .portstatistics import PortStatistics, InstrumentedLock
 
 class CommunicationReadTimeout(serial.SerialException):
     pass
@@ -15,17 +18,68 @@ class CommunicationReadNoMatch(Exception):
 class CommunicationReadAlternateMatch(Exception):
     pass
 
+class BatchReply(NamedTuple):
+    command: str
+    reply: str = None
+    groups: tuple = None
+    error: Exception = None
+
+class NoLock:
+    """ Stands in for portLock and transactionLock in a port created with
+    threadSafe=False: same interface as an RLock, but nothing is locked. """
+    def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        return False
+
 class CommunicationPort:
     """CommunicationPort class with basic application-level protocol 
     functions to write strings and read strings, and abstract away
     the details of the communication.
 
+    portLock protects the port and its buffers during a single read or
+    write, transactionLock keeps a command and its reply together. Both
+    are reentrant. A port used by a single thread (e.g. an acquisition
+    script) can be created with threadSafe=False: the locks are then
+    NoLock and cost almost nothing. Ports shared between threads (or
+    obtained from SerialPortPool) must be thread-safe.
+
+    readString() and readDataUntil() wait for data outside portLock when
+    the port can wait (canWaitForData(), e.g. a SerialPort with a file
+    descriptor): other threads can use the port meanwhile. Otherwise, and
+    for readData()/readInto(), the read blocks for up to the port timeout
+    while holding portLock (e.g. USBPort, or SerialPort on Windows or with
+    a pyftdi URL).
+
+    The delays used when opening and flushing are set by timingPolicy
+    (see TimingPolicy), for a class of port or for a single port.
+
+    enableStatistics() instruments the port (see PortStatistics). When it
+    is not enabled, statistics is None and nothing is measured: the
+    instrumentation replaces methods and locks of the instance, so the
+    disabled path is exactly the uninstrumented code.
     """
-    
-    def __init__(self):
-        self.portLock = RLock()
-        self.transactionLock = RLock()
+    timingPolicy = conservativeTiming
+    statistics = None
+
+    def __init__(self, threadSafe=True):
+        self.isThreadSafe = threadSafe
+        if threadSafe:
+            self.portLock = RLock()
+            self.transactionLock = RLock()
+        else:
+            self.portLock = NoLock()
+            self.transactionLock = NoLock()
         self.terminator = b'\n'
+        self.readChunkSize = 1024
+        self._readBuffer = bytearray()
 
     @property
     def isOpen(self):
@@ -44,7 +98,80 @@ class CommunicationPort:
         fctName = inspect.currentframe().f_code.co_name
         raise NotImplementedError("Derived class must implement {0}".format(fctName))
 
-    def bytesAvailable(self) -> int:
+    def enableStatistics(self) -> PortStatistics:
+        """ Starts counting bytes, commands and timeouts and measuring the
+        latencies of writes, reads, readString, transactions and of the waits
+        on portLock and transactionLock. Should be called while the port is
+        not in use by other threads. Returns the PortStatistics. """
+        if self.statistics is not None:
+            return self.statistics
+
+        statistics = PortStatistics()
+        self._uninstrumentedLocks = (self.portLock, self.transactionLock)
+        self.portLock = InstrumentedLock(self.portLock, statistics, PortStatistics.portLockWait)
+        self.transactionLock = InstrumentedLock(self.transactionLock, statistics, PortStatistics.transactionLockWait, PortStatistics.transaction)
+
+        writeData = self.writeData
+        def instrumentedWriteData(data, endPoint=None):
+            startTime = time.perf_counter()
+            nBytes = writeData(data, endPoint)
+            statistics.recordDuration(PortStatistics.write, time.perf_counter() - startTime, PortStatistics.writes, 1, PortStatistics.bytesWritten, len(data))
+            return nBytes
+
+        doReadData = self.doReadData
+        def instrumentedDoReadData(length, endPoint=None):
+            startTime = time.perf_counter()
+            try:
+                data = doReadData(length, endPoint)
+            except CommunicationReadTimeout as err:
+                statistics.increment(PortStatistics.timeouts)
+                raise err
+            statistics.recordDuration(PortStatistics.read, time.perf_counter() - startTime, PortStatistics.reads, 1, PortStatistics.bytesRead, len(data))
+            return data
+
+        doReadInto = self.doReadInto
+        def instrumentedDoReadInto(view, endPoint=None):
+            startTime = time.perf_counter()
+            try:
+                nBytes = doReadInto(view, endPoint)
+            except CommunicationReadTimeout as err:
+                statistics.increment(PortStatistics.timeouts)
+                raise err
+            statistics.recordDuration(PortStatistics.read, time.perf_counter() - startTime, PortStatistics.reads, 1, PortStatistics.bytesRead, nBytes)
+            return nBytes
+
+        readString = self.readString
+        def instrumentedReadString(endPoint=None):
+            startTime = time.perf_counter()
+            string = readString(endPoint)
+            statistics.recordDuration(PortStatistics.readString, time.perf_counter() - startTime)
+            return string
+
+        self.writeData = instrumentedWriteData
+        self.doReadData = instrumentedDoReadData
+        if type(self).doReadInto is not CommunicationPort.doReadInto:
+            # the default doReadInto calls doReadData, which is already counted
+            self.doReadInto = instrumentedDoReadInto
+        self.readString = instrumentedReadString
+        self.statistics = statistics
+        return statistics
+
+    def disableStatistics(self):
+        """ Removes the instrumentation. The last statistics are lost unless
+        a snapshot() was kept. """
+        if self.statistics is None:
+            return
+
+        for name in ['writeData', 'doReadData', 'doReadInto', 'readString']:
+            self.__dict__.pop(name, None)
+        self.portLock, self.transactionLock = self._uninstrumentedLocks
+        self.statistics = None
+
+    def bytesAvailable(self, endPoint=None) -> int:
+        with self.portLock:
+            return len(self._readBuffer) + self.doBytesAvailable(endPoint)
+
+    def doBytesAvailable(self, endPoint=None) -> int:
         fctName = inspect.currentframe().f_code.co_name
         raise NotImplementedError("Derived class must implement {0}".format(fctName))
 
@@ -52,47 +179,150 @@ class CommunicationPort:
         fctName = inspect.currentframe().f_code.co_name
         raise NotImplementedError("Derived class must implement {0}".format(fctName))
 
+    def flushReadBuffer(self):
+        with self.portLock:
+            self._readBuffer = bytearray()
+
     def readData(self, length, endPoint=None) -> bytearray:
+        """ Returns exactly length bytes, starting with any bytes left over
+        in the receive buffer by a previous readString(). """
+        with self.portLock:
+            if len(self._readBuffer) == 0:
+                return self.doReadData(length, endPoint)
+
+            data = self._readBuffer[:length]
+            del self._readBuffer[:length]
+            if len(data) < length:
+                data += self.doReadData(length - len(data), endPoint)
+
+        return data
+
+    def doReadData(self, length, endPoint=None) -> bytearray:
         fctName = inspect.currentframe().f_code.co_name
         raise NotImplementedError("Derived class must implement {0}".format(fctName))
 
+    def readInto(self, buffer, endPoint=None) -> int:
+        """ Fills buffer (a bytearray, NumPy array or anything supporting the
+        buffer protocol) completely and returns the number of bytes read.
+        Subclasses that can avoid intermediate copies override doReadInto. """
+        view = memoryview(buffer).cast('B')
+        with self.portLock:
+            nBytesRead = min(len(self._readBuffer), len(view))
+            if nBytesRead > 0:
+                view[:nBytesRead] = self._readBuffer[:nBytesRead]
+                del self._readBuffer[:nBytesRead]
+
+            if nBytesRead < len(view):
+                nBytesRead += self.doReadInto(view[nBytesRead:], endPoint)
+
+        return nBytesRead
+
+    def doReadInto(self, view, endPoint=None) -> int:
+        data = self.doReadData(len(view), endPoint)
+        view[:len(data)] = data
+        return len(data)
+
     def writeData(self, data, endPoint=None) -> int:
         fctName = inspect.currentframe().f_code.co_name
         raise NotImplementedError("Derived class must implement {0}".format(fctName))
 
-    def readString(self, endPoint=None) -> str:      
-        with self.portLock:
-            byte = None
-            data = bytearray(0)
-            try:
-                while (byte != b''):
-                    byte = self.readData(1, endPoint)
-                    data += byte
-                    if byte == self.terminator:
-                        break
-            except CommunicationReadTimeout as err:
-                raise CommunicationReadTimeout("Only obtained {0}".format(data))
+    def readString(self, endPoint=None) -> str:
+        """ Reads up to and including the terminator. Bytes are pulled from
+        the port in chunks (whatever is available, up to readChunkSize) and
+        anything received after the terminator is kept in the receive buffer
+        for the next read. """
+        return self.readDataUntil(self.terminator, endPoint).decode(encoding='utf-8')
 
-            string = data.decode(encoding='utf-8')
+    def readDataUntil(self, terminator, endPoint=None) -> bytearray:
+        """ Same as readString() but for binary data: returns the bytes up
+        to and including terminator, without decoding. """
+        canWait = self.canWaitForData(endPoint)
+        while True:
+            with self.portLock:
+                data = self._readBuffer
+                searchStart = 0
+                while True:
+                    index = data.find(terminator, searchStart)
+                    if index >= 0:
+                        end = index + len(terminator)
+                        line = data[:end]
+                        del data[:end]
+                        return line
 
-        return string
+                    searchStart = max(len(data) - len(terminator) + 1, 0)
+                    if canWait and self.doBytesAvailable(endPoint) <= 0:
+                        break # Wait without the lock
 
-    def writeString(self, string, endPoint=None) -> int:
-        nBytes = 0
+                    try:
+                        data += self.doReadData(self.nextChunkLength(endPoint), endPoint)
+                    except CommunicationReadTimeout as err:
+                        self.raiseReadTimeout()
+
+            if not self.waitForData(endPoint):
+                if self.statistics is not None:
+                    self.statistics.increment(PortStatistics.timeouts)
+                with self.portLock:
+                    self.raiseReadTimeout()
+
+    def raiseReadTimeout(self):
+        """ With portLock held: discards the partial data in the receive buffer """
+        partialData = bytes(self._readBuffer)
+        self._readBuffer.clear()
+        raise CommunicationReadTimeout("Only obtained {0}".format(partialData))
+
+    def canWaitForData(self, endPoint=None) -> bool:
+        """ True if waitForData() is implemented for this port """
+        return False
+
+    def waitForData(self, endPoint=None) -> bool:
+        """ Waits, without portLock, until data can be read or the read
+        timeout expires (returns False) """
+        fctName = inspect.currentframe().f_code.co_name
+        raise NotImplementedError("Derived class must implement {0}".format(fctName))
+
+    def readBufferedString(self):
+        """ Returns a complete line if one is already in the receive buffer,
+        without reading from the port, or None. """
         with self.portLock:
-            data = bytearray(string, "utf-8")
-            nBytes = self.writeData(data, endPoint)
+            index = self._readBuffer.find(self.terminator)
+            if index < 0:
+                return None
 
-        return nBytes
+            end = index + len(self.terminator)
+            line = self._readBuffer[:end]
+            del self._readBuffer[:end]
+            return line.decode(encoding='utf-8')
+
+    def readAvailableIntoBuffer(self, endPoint=None) -> int:
+        """ Moves whatever the port already has waiting into the receive
+        buffer without blocking and returns the number of bytes moved. """
+        with self.portLock:
+            available = self.doBytesAvailable(endPoint)
+            if available > 0:
+                self._readBuffer += self.doReadData(available, endPoint)
+            return available
+
+    def nextChunkLength(self, endPoint=None) -> int:
+        """ Number of bytes to request from the port without blocking longer
+        than necessary: everything that is waiting (capped at readChunkSize),
+        or a single byte when nothing has arrived yet. """
+        available = self.doBytesAvailable(endPoint)
+        if available <= 0:
+            return 1
+        return min(available, self.readChunkSize)
+
+    def writeString(self, string, endPoint=None) -> int:
+        # writeData takes the portLock: no need to hold it while encoding
+        return self.writeData(string.encode("utf-8"), endPoint)
 
     def writeStringExpectMatchingString(self, string, replyPattern, alternatePattern = None, endPoints=(None,None)):
         with self.transactionLock:
             self.writeString(string, endPoints[0])
             reply = self.readString(endPoints[1])
-            match = re.search(replyPattern, reply)
+            match = compiledPattern(replyPattern).search(reply)
             if match is None:
                 if alternatePattern is not None:
-                    match = re.search(alternatePattern, reply)
+                    match = compiledPattern(alternatePattern).search(reply)
                     if match is None:
                         raise CommunicationReadAlternateMatch(reply)
                 raise CommunicationReadNoMatch("Unable to find first group with pattern:'{0}'".format(replyPattern))
@@ -112,17 +342,70 @@ class CommunicationPort:
             self.writeString(string, endPoints[0])
             reply = self.readString(endPoints[1])
 
-            match = re.search(replyPattern, reply)
+            match = compiledPattern(replyPattern).search(reply)
 
             if match is not None:
                 return reply, match.groups()
             else:
                 raise CommunicationReadNoMatch("Unable to match pattern:'{0}' in reply:'{1}'".format(replyPattern, reply))
 
+    def writeStringsReadMatchingGroups(self, commands, endPoints=(None,None)) -> list:
+        """ Pipelined transaction for devices that queue commands: all the
+        (command, replyPattern) pairs are written with a single writeData,
+        then one reply per command is read and matched in order. A command
+        with a replyPattern of None expects no reply.
+
+        Returns a BatchReply for each command. Errors are reported per
+        command in BatchReply.error instead of being raised: a reply that
+        does not match or cannot be read (e.g. not UTF-8) does not prevent
+        the following ones from being read, but after a read timeout the
+        remaining replies are marked as timed out. If the write fails, every
+        command has the error.
+        """
+        data = bytearray()
+        for command, replyPattern in commands:
+            data += command.encode("utf-8")
+
+        replies = []
+        with self.transactionLock:
+            try:
+                self.writeData(data, endPoints[0])
+            except Exception as err:
+                return [ BatchReply(command, error=err) for command, replyPattern in commands ]
+
+            timeout = None
+            for command, replyPattern in commands:
+                if replyPattern is None:
+                    replies.append(BatchReply(command))
+                    continue
+
+                if timeout is not None:
+                    replies.append(BatchReply(command, error=timeout))
+                    continue
+
+                try:
+                    reply = self.readString(endPoints[1])
+                except CommunicationReadTimeout as err:
+                    timeout = err
+                    replies.append(BatchReply(command, error=err))
+                    continue
+                except Exception as err:
+                    replies.append(BatchReply(command, error=err))
+                    continue
+
+                match = compiledPattern(replyPattern).search(reply)
+                if match is not None:
+                    replies.append(BatchReply(command, reply, match.groups()))
+                else:
+                    error = CommunicationReadNoMatch("Unable to match pattern:'{0}' in reply:'{1}'".format(replyPattern, reply))
+                    replies.append(BatchReply(command, reply, error=error))
+
+        return replies
+
     def readMatchingGroups(self, replyPattern, alternatePattern = None, endPoint=None):
         reply = self.readString(endPoint=endPoint)
 
-        match = re.search(replyPattern, reply)
+        match = compiledPattern(replyPattern).search(reply)
 
         if match is not None:
             return reply, match.groups()
@@ -1,8 +1,10 @@
 import time
 import random
+import array
 
 from hardwarelibrary.communication import *
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
+import usb.core
 
 class DebugDataCommand(Command):
     def __init__(self, name, dataHexRegex = None, unpackingMask = None, endPoints = (None, None)):
@@ -30,12 +32,20 @@ class DebugDataCommand(Command):
         return False
 
 class DebugPort(CommunicationPort):
-    def __init__(self, delay=0):
+    """ A port that answers in software (by default an echo). delay
+    simulates the response time of a device: after each write, the reply
+    is produced after a random time between 0 and delay seconds. The wait
+    happens outside the portLock, so other threads can use the port
+    meanwhile (a transaction still holds its transactionLock). The random
+    times come from randomGenerator (the random module unless replaced,
+    e.g. by a seeded random.Random for reproducible delays). """
+    def __init__(self, delay=0, threadSafe=True):
         self.inputBuffers = [bytearray()]
         self.outputBuffers = [bytearray()]
         self.delay = delay
+        self.randomGenerator = random
         self._isOpen = False
-        super(DebugPort, self).__init__()
+        super(DebugPort, self).__init__(threadSafe=threadSafe)
 
     @property
     def isOpen(self):
@@ -52,36 +62,40 @@ class DebugPort(CommunicationPort):
         self._isOpen = False
         return
 
-    def bytesAvailable(self, endPoint=0):
+    def doBytesAvailable(self, endPoint=None):
+        if endPoint is None:
+            endPoint = 0
+
         return len(self.outputBuffers[endPoint])
 
     def flush(self):
+        self.flushReadBuffer()
         self.buffers = [bytearray(),bytearray()]
 
-    def readData(self, length, endPoint=None):
-        if endPoint is None:
-            endPointIndex = 0
+    def doReadData(self, length, endPoint=None):
+        endPointIndex = endPoint if endPoint is not None else 0
 
         with self.portLock:
-            time.sleep(self.delay*random.random())
-            data = bytearray()
-            for i in range(0, length):
-                if len(self.outputBuffers[endPointIndex]) > 0:
-                    byte = self.outputBuffers[endPointIndex].pop(0)
-                    data.append(byte)
-                else:
-                    raise CommunicationReadTimeout("Unable to read data")
+            outputBuffer = self.outputBuffers[endPointIndex]
+            if len(outputBuffer) < length:
+                raise CommunicationReadTimeout("Unable to read data")
+
+            data = outputBuffer[:length]
+            del outputBuffer[:length]
 
         return data
 
     def writeData(self, data, endPoint=None):
-        if endPoint is None:
-            endPointIndex = 0
+        endPointIndex = endPoint if endPoint is not None else 0
 
         with self.portLock:
             self.inputBuffers[endPointIndex].extend(data)
 
-        self.processInputBuffers(endPointIndex=endPointIndex)
+        if self.delay > 0:
+            time.sleep(self.delay*self.randomGenerator.random())
+
+        with self.portLock:
+            self.processInputBuffers(endPointIndex=endPointIndex)
 
         return len(data)
 
@@ -95,4 +109,50 @@ class DebugPort(CommunicationPort):
 
         # Do something, here we do an Echo
         self.writeToOutputBuffer(inputBytes, endPointIndex)
-        self.inputBuffers[endPointIndex] = bytearray()
\ No newline at end of file
+        self.inputBuffers[endPointIndex] = bytearray()
+
+
+class DebugEndPoint:
+    """ A simulated USB input endpoint with the same read() interface as a
+    PyUSB endpoint. Data added with feed() is returned in packets of at most
+    wMaxPacketSize bytes, each read taking latency seconds. A read with no
+    data waits up to its timeout (in ms) then raises USBTimeoutError. """
+    def __init__(self, wMaxPacketSize=64, latency=0, bEndpointAddress=0x81):
+        self.wMaxPacketSize = wMaxPacketSize
+        self.bEndpointAddress = bEndpointAddress
+        self.latency = latency
+        self.readCount = 0
+        self.pendingData = bytearray()
+        self.dataAvailable = Condition()
+
+    def feed(self, data):
+        with self.dataAvailable:
+            self.pendingData.extend(data)
+            self.dataAvailable.notify_all()
+
+    def read(self, size_or_buffer, timeout=None):
+        if timeout is None:
+            timeout = 1000
+
+        if isinstance(size_or_buffer, int):
+            buffer = None
+            size = size_or_buffer
+        else:
+            buffer = size_or_buffer
+            size = len(size_or_buffer)
+
+        time.sleep(self.latency)
+        with self.dataAvailable:
+            if not self.dataAvailable.wait_for(lambda: len(self.pendingData) > 0, timeout=timeout/1000):
+                raise usb.core.USBTimeoutError("Operation timed out", errno=110, error_code=-7)
+
+            self.readCount += 1
+            nBytes = min(size, self.wMaxPacketSize, len(self.pendingData))
+            data = array.array('B', self.pendingData[:nBytes])
+            del self.pendingData[:nBytes]
+
+        if buffer is None:
+            return data
+
+        buffer[:nBytes] = data
+        return nBytes
@@ -1,6 +1,7 @@
 import usb.core
 import usb.util
 from .usbport import *
+from .usbdescriptorcache import USBDescriptorCache
 from os import listdir, stat, system
 from stat import *
 from os.path import isfile, join, exists, isfile
@@ -386,13 +387,14 @@ def connectedUSBDevices(idVendor=None, idProduct=None, serialNumber=None):
         devices = list(usb.core.find(find_all=True, 
                                 idVendor=idVendor, 
                                 idProduct=idProduct))
+    USBDescriptorCache().purge(devices, [(idVendor, idProduct)])
 
     # Remove Apple Devices
     devices = [device for device in devices if device.idVendor != 0x05ac]
     
     if serialNumber is not None: # A serial number was provided, try to match
         for device in devices:
-            deviceSerialNumber = usb.util.get_string(device, device.iSerialNumber ) 
+            deviceSerialNumber = USBDescriptorCache().serialNumber(device)
             if deviceSerialNumber == serialNumber:
                 return [device]
 
@@ -5,6 +5,6 @@ from hardwarelibrary.communication import *
 from threading import Thread, Lock
 
 class DebugEchoPort(DebugPort):
-    def __init__(self, delay=0):
-        super(DebugEchoPort, self).__init__(delay=delay)
+    def __init__(self, delay=0, threadSafe=True):
+        super(DebugEchoPort, self).__init__(delay=delay, threadSafe=threadSafe)
 
@@ -0,0 +1,192 @@
+import math
+import time
+from threading import Lock
+import numpy as np
+
+class PortStatistics:
+    """
+    Counters and latency histograms of a CommunicationPort, enabled with
+    port.enableStatistics(). All the storage is allocated once, in flat
+    lists (much faster than NumPy to update one element at a time), so
+    recording an operation never allocates. NumPy is only used to analyze.
+
+    Counters: bytes read and written, reads, writes, commands (outermost
+    transactions, i.e. transactionLock held) and read timeouts.
+
+    Latencies, for each operation of PortStatistics.operations: a histogram
+    with power-of-two bins starting at 1 µs (bin i counts durations between
+    2**(i-1) and 2**i µs), the number of samples, the total and the maximum.
+    'portLockWait' and 'transactionLockWait' are the times spent waiting to
+    acquire the locks, 'transaction' is the time the transactionLock is held.
+
+    snapshot() returns an independent copy, and PortStatistics.combined()
+    adds several of them (DeviceManager().portStatistics() uses it).
+    """
+    counters = ('bytesRead', 'bytesWritten', 'reads', 'writes', 'commands', 'timeouts')
+    operations = ('write', 'read', 'readString', 'transaction', 'portLockWait', 'transactionLockWait')
+    numberOfBins = 32
+    firstBinDuration = 1e-6
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = [0] * len(self.counters)
+        self.histograms = [0] * (len(self.operations) * self.numberOfBins)
+        self.totalTimes = [0.0] * len(self.operations)
+        self.maximumTimes = [0.0] * len(self.operations)
+        self.startTime = time.time()
+
+    @classmethod
+    def binEdges(cls):
+        """ Upper bound of each bin, in seconds """
+        return cls.firstBinDuration * np.power(2.0, np.arange(cls.numberOfBins))
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counts[counter] += value
+
+    def recordDuration(self, operation, duration, counter=None, value=1, bytesCounter=None, nBytes=0):
+        """ Adds a sample to the histogram of operation and, optionally,
+        increments a counter and a byte counter, with a single lock. """
+        if duration <= self.firstBinDuration:
+            index = 0
+        else:
+            index = min(math.frexp(duration / self.firstBinDuration)[1], self.numberOfBins - 1)
+
+        with self.lock:
+            self.histograms[operation * self.numberOfBins + index] += 1
+            self.totalTimes[operation] += duration
+            if duration > self.maximumTimes[operation]:
+                self.maximumTimes[operation] = duration
+            if counter is not None:
+                self.counts[counter] += value
+            if bytesCounter is not None:
+                self.counts[bytesCounter] += nBytes
+
+    def reset(self):
+        with self.lock:
+            for values in [self.counts, self.histograms, self.totalTimes, self.maximumTimes]:
+                values[:] = [0] * len(values)
+            self.startTime = time.time()
+
+    def snapshot(self):
+        copy = PortStatistics()
+        with self.lock:
+            copy.counts[:] = self.counts
+            copy.histograms[:] = self.histograms
+            copy.totalTimes[:] = self.totalTimes
+            copy.maximumTimes[:] = self.maximumTimes
+            copy.startTime = self.startTime
+        return copy
+
+    @classmethod
+    def combined(cls, statistics):
+        """ The sum of several PortStatistics (or snapshots) """
+        total = PortStatistics()
+        for stats in statistics:
+            stats = stats.snapshot()
+            total.counts = [ a + b for a, b in zip(total.counts, stats.counts) ]
+            total.histograms = [ a + b for a, b in zip(total.histograms, stats.histograms) ]
+            total.totalTimes = [ a + b for a, b in zip(total.totalTimes, stats.totalTimes) ]
+            total.maximumTimes = [ max(a, b) for a, b in zip(total.maximumTimes, stats.maximumTimes) ]
+            total.startTime = min(total.startTime, stats.startTime)
+        return total
+
+    def histogram(self, operation) -> np.ndarray:
+        """ The counts in each bin for operation (see binEdges()) """
+        start = self.operations.index(operation) * self.numberOfBins
+        return np.array(self.histograms[start:start + self.numberOfBins], dtype=np.int64)
+
+    def count(self, name) -> int:
+        """ A counter (e.g. 'bytesRead') or the number of samples of an operation (e.g. 'write') """
+        if name in self.counters:
+            return int(self.counts[self.counters.index(name)])
+        return int(self.histogram(name).sum())
+
+    def meanTime(self, operation) -> float:
+        count = self.count(operation)
+        if count == 0:
+            return None
+        return float(self.totalTimes[self.operations.index(operation)]) / count
+
+    def maximumTime(self, operation) -> float:
+        return float(self.maximumTimes[self.operations.index(operation)])
+
+    def percentile(self, operation, percent) -> float:
+        """ Upper bound of the bin that contains the given percentile,
+        a resolution of a factor 2 """
+        histogram = self.histogram(operation)
+        total = histogram.sum()
+        if total == 0:
+            return None
+        index = int(np.searchsorted(np.cumsum(histogram), total * percent / 100.0))
+        return float(self.binEdges()[index])
+
+    def bytesPerSecond(self) -> (float, float):
+        """ Average (read, written) throughput since the last reset """
+        duration = max(time.time() - self.startTime, 1e-9)
+        return self.count('bytesRead') / duration, self.count('bytesWritten') / duration
+
+    def asDict(self) -> dict:
+        """ Counters, then mean/p50/p99/maximum latencies for each operation """
+        summary = { name: self.count(name) for name in self.counters }
+        for operation in self.operations:
+            summary[operation] = {"count": self.count(operation),
+                                  "mean": self.meanTime(operation),
+                                  "p50": self.percentile(operation, 50),
+                                  "p99": self.percentile(operation, 99),
+                                  "maximum": self.maximumTime(operation)}
+        return summary
+
+    def __repr__(self):
+        lines = [", ".join([ "{0}={1}".format(name, self.count(name)) for name in self.counters ])]
+        for operation in self.operations:
+            count = self.count(operation)
+            if count > 0:
+                lines.append("{0:20s} n={1:<8d} mean={2:.1f} µs p99<={3:.1f} µs max={4:.1f} µs".format(operation, count,
+                             self.meanTime(operation)*1e6, self.percentile(operation, 99)*1e6, self.maximumTime(operation)*1e6))
+        return "\n".join(lines)
+
+PortStatistics.bytesRead, PortStatistics.bytesWritten, PortStatistics.reads, PortStatistics.writes, PortStatistics.commands, PortStatistics.timeouts = range(len(PortStatistics.counters))
+PortStatistics.write, PortStatistics.read, PortStatistics.readString, PortStatistics.transaction, PortStatistics.portLockWait, PortStatistics.transactionLockWait = range(len(PortStatistics.operations))
+
+
+class InstrumentedLock:
+    """
+    Stands in for a port's RLock while statistics are enabled: the same
+    underlying lock is used (so code that kept a reference to the original
+    is still excluded), but the time waiting for it is recorded and, for the
+    transactionLock, the time it is held by the outermost owner.
+    """
+    def __init__(self, lock, statistics, waitOperation, holdOperation=None):
+        self.lock = lock
+        self.statistics = statistics
+        self.waitOperation = waitOperation
+        self.holdOperation = holdOperation
+        self.depth = 0          # only modified by the owner
+        self.acquiredTime = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        startTime = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            if self.depth == 0:
+                self.acquiredTime = time.perf_counter()
+                if self.holdOperation is not None:
+                    self.statistics.recordDuration(self.waitOperation, self.acquiredTime - startTime, PortStatistics.commands)
+                else:
+                    self.statistics.recordDuration(self.waitOperation, self.acquiredTime - startTime)
+            self.depth += 1
+        return acquired
+
+    def release(self):
+        if self.depth > 0: # not the case if acquired before statistics were enabled
+            self.depth -= 1
+            if self.depth == 0 and self.holdOperation is not None:
+                self.statistics.recordDuration(self.holdOperation, time.perf_counter() - self.acquiredTime)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self.release()
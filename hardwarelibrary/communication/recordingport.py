@@ -0,0 +1,245 @@
+import time
+from collections import deque
+from typing import NamedTuple
+from .communicationport import *
+
+class RecordedEvent(NamedTuple):
+    kind: bytes         # RecordedEvent.write, RecordedEvent.read or RecordedEvent.timeout
+    time: float         # seconds since the recording started
+    endPoint: int = None
+    data: bytes = b''
+
+RecordedEvent.write = b'W'
+RecordedEvent.read = b'R'
+RecordedEvent.timeout = b'T'
+
+class ReplayMismatch(Exception):
+    pass
+
+class RecordingPort(CommunicationPort):
+    """
+    Wraps any CommunicationPort (SerialPort, USBPort, DebugPort...) and
+    records every writeData() and every read (with its timestamp) to a
+    compact binary file, so that a session with a real instrument can be
+    replayed later with ReplayPort, without the instrument.
+
+    The file starts with RecordingPort.fileSignature, followed by one
+    record per event: the header (kind, time, endPoint, length) packed with
+    RecordingPort.eventLayout, then the data.
+
+        port = RecordingPort(SerialPort(portPath=...), "sutter.hwrec")
+        port.open(baudRate=128000)
+        ... use port as usual ...
+        port.close()
+    """
+    fileSignature = b'HWLREC1\n'
+    eventLayout = StructLayout('<cdbI')     # kind, time, endPoint (-1 for None), length
+
+    def __init__(self, port, filePath):
+        super().__init__()
+        self.port = port
+        self.filePath = filePath
+        self.file = open(filePath, 'wb')
+        self.file.write(self.fileSignature)
+        self.startTime = time.perf_counter()
+
+    @property
+    def isOpen(self):
+        return self.port.isOpen
+
+    def open(self, *args, **kwargs):
+        return self.port.open(*args, **kwargs)
+
+    def close(self):
+        self.port.close()
+        self.stopRecording()
+
+    def stopRecording(self):
+        with self.portLock:
+            if not self.file.closed:
+                self.file.close()
+
+    def flush(self):
+        self.flushReadBuffer()
+        self.port.flush()
+
+    def recordEvent(self, kind, endPoint, data=b''):
+        if endPoint is None:
+            endPoint = -1
+
+        with self.portLock:
+            if self.file.closed:
+                return
+            header = self.eventLayout.pack(kind, time.perf_counter() - self.startTime, endPoint, len(data))
+            self.file.write(header)
+            self.file.write(data)
+
+    def doBytesAvailable(self, endPoint=None) -> int:
+        return self.port.bytesAvailable(endPoint)
+
+    def doReadData(self, length, endPoint=None) -> bytearray:
+        try:
+            data = self.port.readData(length, endPoint)
+        except CommunicationReadTimeout as err:
+            self.recordEvent(RecordedEvent.timeout, endPoint)
+            raise err
+
+        self.recordEvent(RecordedEvent.read, endPoint, bytes(data))
+        return data
+
+    def writeData(self, data, endPoint=None) -> int:
+        nBytes = self.port.writeData(data, endPoint)
+        self.recordEvent(RecordedEvent.write, endPoint, bytes(data))
+        return nBytes
+
+    @classmethod
+    def readEvents(cls, filePath) -> list:
+        """ The list of RecordedEvent in a file written by RecordingPort. """
+        with open(filePath, 'rb') as file:
+            content = file.read()
+
+        if not content.startswith(cls.fileSignature):
+            raise ValueError("{0} is not a RecordingPort file".format(filePath))
+
+        events = []
+        view = memoryview(content)
+        offset = len(cls.fileSignature)
+        headerSize = cls.eventLayout.size
+        while offset + headerSize <= len(content):
+            kind, eventTime, endPoint, length = cls.eventLayout.unpack(view, offset)
+            offset += headerSize
+            if endPoint == -1:
+                endPoint = None
+            events.append(RecordedEvent(kind, eventTime, endPoint, bytes(view[offset:offset + length])))
+            offset += length
+
+        return events
+
+
+class ReplayPort(CommunicationPort):
+    """
+    Plays back a session recorded with RecordingPort. Each writeData() must
+    match the next recorded write (unless strict is False), and makes the
+    replies that were read after it available, either immediately
+    (realTime=False, to measure the protocol layer as fast as possible) or
+    with the delays originally observed after that write (realTime=True).
+    Reading beyond what was recorded raises CommunicationReadTimeout, as does
+    reading at the point where the recording had a timeout.
+    """
+    def __init__(self, filePath=None, events=None, realTime=False, strict=True):
+        super().__init__()
+        if events is None:
+            events = RecordingPort.readEvents(filePath)
+        self.events = list(events)
+        self.realTime = realTime
+        self.strict = strict
+        self._isOpen = False
+        self.cursor = 0
+        self.scheduledEvents = deque()
+        self.releasedData = {}
+
+    @property
+    def isOpen(self):
+        return self._isOpen
+
+    @property
+    def isFinished(self):
+        """ True when all recorded events have been replayed and read. """
+        return self.cursor >= len(self.events) and len(self.scheduledEvents) == 0
+
+    def open(self, *args, **kwargs):
+        if self._isOpen:
+            raise Exception("Port already open")
+        self._isOpen = True
+        self.rewind()
+
+    def close(self):
+        self._isOpen = False
+
+    def rewind(self):
+        with self.portLock:
+            self.flushReadBuffer()
+            self.cursor = 0
+            self.scheduledEvents.clear()
+            self.releasedData = {}
+            self.scheduleRepliesAfter(time.perf_counter(), 0)
+
+    def flush(self):
+        self.flushReadBuffer()
+
+    def scheduleRepliesAfter(self, now, referenceTime):
+        """ Schedules the reads (and timeouts) that follow the cursor, up to
+        the next write, at their recorded delay after referenceTime. """
+        while self.cursor < len(self.events):
+            event = self.events[self.cursor]
+            if event.kind == RecordedEvent.write:
+                break
+
+            releaseTime = now
+            if self.realTime:
+                releaseTime += max(0, event.time - referenceTime)
+            self.scheduledEvents.append((releaseTime, event))
+            self.cursor += 1
+
+    def releaseScheduledEvents(self, untilTimeout=False):
+        """ Moves the data that is due into releasedData. Stops at a timeout
+        event, which is consumed only when untilTimeout is True. Returns
+        True if a timeout was consumed. """
+        now = time.perf_counter()
+        while len(self.scheduledEvents) > 0:
+            releaseTime, event = self.scheduledEvents[0]
+            if releaseTime > now:
+                return False
+
+            if event.kind == RecordedEvent.timeout:
+                if untilTimeout:
+                    self.scheduledEvents.popleft()
+                return untilTimeout
+
+            self.scheduledEvents.popleft()
+            self.releasedData.setdefault(event.endPoint, bytearray()).extend(event.data)
+
+        return False
+
+    def doBytesAvailable(self, endPoint=None) -> int:
+        with self.portLock:
+            self.releaseScheduledEvents()
+            return len(self.releasedData.get(endPoint, b''))
+
+    def doReadData(self, length, endPoint=None) -> bytearray:
+        with self.portLock:
+            while True:
+                self.releaseScheduledEvents()
+                available = self.releasedData.setdefault(endPoint, bytearray())
+                if len(available) >= length:
+                    data = available[:length]
+                    del available[:length]
+                    return data
+
+                if len(self.scheduledEvents) == 0:
+                    raise CommunicationReadTimeout("Only obtained {0} (nothing more was recorded)".format(bytes(available)))
+
+                releaseTime, event = self.scheduledEvents[0]
+                delay = releaseTime - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                if event.kind == RecordedEvent.timeout:
+                    if self.releaseScheduledEvents(untilTimeout=True):
+                        raise CommunicationReadTimeout("Only obtained {0} (timeout recorded)".format(bytes(available)))
+
+    def writeData(self, data, endPoint=None) -> int:
+        with self.portLock:
+            if self.cursor >= len(self.events):
+                if self.strict:
+                    raise ReplayMismatch("Nothing more recorded, but {0} was written".format(bytes(data)))
+                return len(data)
+
+            event = self.events[self.cursor]
+            if self.strict and (event.data != bytes(data) or event.endPoint != endPoint):
+                raise ReplayMismatch("Expected {0} but {1} was written".format(event.data, bytes(data)))
+
+            self.cursor += 1
+            self.scheduleRepliesAfter(time.perf_counter(), event.time)
+
+        return len(data)
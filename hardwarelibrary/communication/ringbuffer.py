@@ -0,0 +1,95 @@
+class RingBuffer:
+    """A preallocated circular byte buffer used by ports to accumulate
+    incoming data (e.g. USB packets) and hand it out in arbitrary pieces.
+
+    Bytes are copied in once (write) and copied out once (read/readInto)
+    through memoryviews: the buffer never re-slices or reallocates
+    its content unless it must grow beyond its capacity.
+    """
+
+    def __init__(self, capacity=65536):
+        if capacity <= 0:
+            raise ValueError("RingBuffer capacity must be positive")
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def freeSpace(self) -> int:
+        return self.capacity - self._size
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+
+    def write(self, data) -> int:
+        source = memoryview(data).cast('B')
+        length = len(source)
+        if self._size + length > len(self._buffer):
+            self._grow(self._size + length)
+
+        capacity = len(self._buffer)
+        tail = (self._head + self._size) % capacity
+        firstLength = min(length, capacity - tail)
+        self._view[tail:tail + firstLength] = source[:firstLength]
+        if firstLength < length:
+            self._view[:length - firstLength] = source[firstLength:]
+
+        self._size += length
+        return length
+
+    def read(self, length) -> bytearray:
+        length = min(length, self._size)
+        head = self._head
+        if head + length <= len(self._buffer):
+            data = self._buffer[head:head + length]
+            self._size -= length
+            self._head = head + length if self._size > 0 else 0
+            return data
+
+        data = bytearray(length)
+        self._copyOut(memoryview(data), length)
+        return data
+
+    def readInto(self, buffer) -> int:
+        """ Copies as many bytes as possible into buffer (any object
+        supporting the buffer protocol, such as a bytearray or a NumPy array)
+        and returns the number of bytes copied. """
+        destination = memoryview(buffer).cast('B')
+        length = min(len(destination), self._size)
+        self._copyOut(destination, length)
+        return length
+
+    def _copyOut(self, destination, length):
+        capacity = len(self._buffer)
+        firstLength = min(length, capacity - self._head)
+        destination[:firstLength] = self._view[self._head:self._head + firstLength]
+        if firstLength < length:
+            destination[firstLength:length] = self._view[:length - firstLength]
+
+        self._size -= length
+        if self._size == 0:
+            self._head = 0
+        else:
+            self._head = (self._head + length) % capacity
+
+    def _grow(self, minimumCapacity):
+        newCapacity = self.capacity
+        while newCapacity < minimumCapacity:
+            newCapacity *= 2
+
+        newBuffer = bytearray(newCapacity)
+        size = self._size
+        self._copyOut(memoryview(newBuffer), size)
+        self._buffer = newBuffer
+        self._view = memoryview(newBuffer)
+        self._head = 0
+        self._size = size
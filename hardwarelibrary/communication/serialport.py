@@ -1,5 +1,6 @@
 from .communicationport import *
 import time
+import select
 from serial.tools.list_ports import comports
 from serial.tools.list_ports_common import ListPortInfo
 import re
@@ -14,6 +15,22 @@ class UnableToOpenSerialPort(serial.SerialException):
 class MoreThanOneMatch(serial.SerialException):
     pass
 
+class PortIndex(dict):
+    """ Device paths of enumerated ports (ListPortInfo) keyed by
+    (vid, None, None) and (vid, pid, None), in enumeration order, with the
+    serial number of each path in serialNumbers. A serial number is a
+    pattern searched in the serial numbers of a (vid, pid) key, so it is
+    not a key. On macOS, ports are sometimes "doubled" because two
+    user-space DriverExtension prepare a port (FTDI and Apple's for instance):
+    they are kept, as before. """
+    def __init__(self, ports):
+        super().__init__()
+        self.serialNumbers = {}
+        for port in ports:
+            self.serialNumbers[port.device] = port.serial_number
+            for key in [(port.vid, None, None), (port.vid, port.pid, None)]:
+                self.setdefault(key, []).append(port.device)
+
 class SerialPort(CommunicationPort):
     """
     An implementation of CommunicationPort using BSD-style serial port
@@ -26,8 +43,14 @@ class SerialPort(CommunicationPort):
        or the find_url.py script from the distribution. More info: https://eblot.github.io/pyftdi/api/usbtools.html
        You have to add any custom VID/PID when using tools (but they are added here in SerialPort) @line 30.
     """
-    def __init__(self, idVendor=None, idProduct=None, serialNumber=None, portPath=None, port=None):
-        CommunicationPort.__init__(self)
+    portCacheTimeout = 5.0
+    _portIndex = None
+    _portIndexTime = 0
+    _portCacheLock = RLock()
+    _registeredCustomIds = set()
+
+    def __init__(self, idVendor=None, idProduct=None, serialNumber=None, portPath=None, port=None, threadSafe=True):
+        CommunicationPort.__init__(self, threadSafe=threadSafe)
 
         try:
             Ftdi.add_custom_product(vid=4930, pid=1, pidname="Sutter")
@@ -68,50 +91,68 @@ class SerialPort(CommunicationPort):
         # or              idVendor
 
         # We must add custom vendors when required
+        cls.registerCustomIds(idVendor, idProduct)
+
+        portIndex = cls.portIndex()
+        if idProduct is None:
+            return list(portIndex.get((idVendor, None, None), []))
+        elif serialNumber is None:
+            return list(portIndex.get((idVendor, idProduct, None), []))
+
+        # A serial number is a regular expression searched in the serial
+        # numbers ("ABC" also matches "ABC2"). Most of the time it is a plain
+        # serial number: a substring test finds the same ports.
+        if re.escape(serialNumber) == serialNumber:
+            serialNumberLower = serialNumber.lower()
+            matches = lambda portSerialNumber: serialNumberLower in portSerialNumber.lower()
+        else:
+            matches = re.compile(serialNumber, re.IGNORECASE).search
+
+        ports = []
+        for port in portIndex.get((idVendor, idProduct, None), []):
+            portSerialNumber = portIndex.serialNumbers[port]
+            if portSerialNumber is not None and matches(portSerialNumber):
+                ports.append(port)
+
+        return ports
+
+    @classmethod
+    def registerCustomIds(cls, idVendor=None, idProduct=None):
+        if (idVendor, idProduct) in cls._registeredCustomIds:
+            return
+
         try:
             if idVendor is not None and idProduct is not None:
-                # print("Adding custom product")
                 pyftdi.ftdi.Ftdi.add_custom_product(vid=idVendor, pid=idProduct, pidname='VID {0}: PID {1}'.format(idVendor, idProduct))
             elif idVendor is not None:
-                # print("Adding custom vendor")
                 pyftdi.ftdi.Ftdi.add_custom_vendor(vid=idVendor, vidname='VID {0}'.format(idVendor))
 
         except ValueError as err:
             # It is not an error: it is already registered
             pass
 
+        cls._registeredCustomIds.add((idVendor, idProduct))
 
-        # It sometimes happens on macOS that the ports are "doubled" because two user-space DriverExtension 
-        # prepare a port (FTDI and Apple's for instance).  If that is the case, then we try to remove duplicates
-
-        portObjects = []
-        allPorts = comports()            # From PySerial
-        ftdiPorts = cls.ftdiPorts()
-        # print(ftdiPorts)
-        allPorts.extend(ftdiPorts) # From pyftdi
-
-        for port in allPorts:
-            if idProduct is None:
-                if port.vid == idVendor:
-                    portObjects.append(port)
-            elif serialNumber is None:
-                if port.vid == idVendor and port.pid == idProduct:
-                    portObjects.append(port)
-            else:
-                if port.vid == idVendor and port.pid == idProduct:
-                    if re.search(serialNumber, port.serial_number, re.IGNORECASE):
-                        portObjects.append(port)
-
-
-        ports = []
-        # portsAlreadyAdded = []
-        for port in portObjects:
-            # uniqueIdentifier = (port.vid, port.pid, port.serial_number)
-            # if not (uniqueIdentifier in portsAlreadyAdded):                
-            ports.append(port.device)
-                # portsAlreadyAdded.append(uniqueIdentifier)
+    @classmethod
+    def portIndex(cls) -> PortIndex:
+        """ The ports from pyserial and pyftdi, indexed by (vid, None, None),
+        (vid, pid, None) and (vid, pid, serialNumber). Enumerating ports can
+        take hundreds of milliseconds, so the index is kept for
+        portCacheTimeout seconds or until invalidatePortCache() is called
+        (DeviceManager does when a USB device is connected or disconnected). """
+        with cls._portCacheLock:
+            if cls._portIndex is None or time.monotonic() > cls._portIndexTime + cls.portCacheTimeout:
+                allPorts = list(comports())            # From PySerial
+                allPorts.extend(cls.ftdiPorts())       # From pyftdi
+                cls._portIndex = PortIndex(allPorts)
+                cls._portIndexTime = time.monotonic()
+
+            return cls._portIndex
 
-        return ports
+    @classmethod
+    def invalidatePortCache(cls):
+        with cls._portCacheLock:
+            cls._portIndex = None
 
     @classmethod
     def ftdiPorts(cls):
@@ -160,40 +201,52 @@ class SerialPort(CommunicationPort):
                 # self.portPath = re.match(r"^ftdi://0x1342:0x1/1")
                 # print(self.portPath)
                 self.port = pyftdi.serialext.serial_for_url(self.portPath, baudrate=baudRate, timeout=timeout)
+            elif self.portPath is not None and "://" in self.portPath:
+                # Other pyserial URL handlers, e.g. loop:// or socket://
+                self.port = serial.serial_for_url(self.portPath, baudrate=baudRate, timeout=timeout, rtscts=rtscts, dsrdtr=dsrdtr)
             else:
                 self.port = serial.Serial(self.portPath, baudRate, timeout=timeout, rtscts=rtscts, dsrdtr=dsrdtr)
         else:
             self.port.open()
 
-        timeoutTime = time.time() + timeout
-        while not self.isOpen:
-            time.sleep(0.05)
-            if time.time() > timeoutTime:
-                raise UnableToOpenSerialPort()
-        time.sleep(0.05)
+        if not self.timingPolicy.waitUntil(lambda: self.isOpen, timeout):
+            raise UnableToOpenSerialPort()
+        self.timingPolicy.sleep(self.timingPolicy.openSettleDelay)
 
     def close(self):
         self.port.close()
 
-    def bytesAvailable(self) -> int:
+    def doBytesAvailable(self, endPoint=None) -> int:
         return self.port.inWaiting()
 
     def flush(self):
+        self.flushReadBuffer()
         if self.isOpen:
-            # When an FTDI chip is used, this short sleep delay appears necessary
+            # When an FTDI chip is used, a short delay appears necessary
             # If not, the flush does not occur.
-            time.sleep(0.02)
+            policy = self.timingPolicy
+            policy.sleep(policy.flushSettleDelay)
+            if policy.flushQuietTime is not None:
+                policy.waitUntilQuiet(self.port.inWaiting, self.port.read)
             self.port.flushInput()
             self.port.flushOutput()
-            time.sleep(0.02)
+            policy.sleep(policy.flushSettleDelay)
 
-    def readString(self, endPoint=0):
-        with self.portLock:
-            data = self.port.read_until(expected=self.terminator)
+    @property
+    def fileDescriptor(self):
+        try:
+            return self.port.fileno()
+        except Exception:
+            return None # pyftdi URLs, loop://, Windows
+
+    def canWaitForData(self, endPoint=None) -> bool:
+        return self.fileDescriptor is not None
 
-        return data.decode()
+    def waitForData(self, endPoint=None) -> bool:
+        readable, _, _ = select.select([self.fileDescriptor], [], [], self.port.timeout)
+        return len(readable) > 0
 
-    def readData(self, length, endPoint=0) -> bytearray:
+    def doReadData(self, length, endPoint=0) -> bytearray:
         with self.portLock:
             data = self.port.read(length)
             if len(data) != length:
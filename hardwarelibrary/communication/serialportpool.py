@@ -0,0 +1,159 @@
+import time
+from threading import RLock, Timer
+from .serialport import SerialPort, UnableToOpenSerialPort
+
+class IncompatibleOpenParameters(UnableToOpenSerialPort):
+    pass
+
+class SerialPortPool:
+    """
+    A registry of shared SerialPorts, keyed by portPath (a device path or a
+    URL such as 'ftdi://...' or 'loop://'). Several logical devices behind
+    the same physical port (e.g. the channels of a multi-channel FTDI chip
+    driving several devices) acquire() the same SerialPort object, and
+    therefore share its portLock and transactionLock: their commands are
+    serialized per physical port.
+
+    Ports are reference-counted. When the last user calls release(), the
+    port stays open for idleTimeout seconds so that a device that is shut
+    down and reinitialized does not reopen it (with the associated delays),
+    then it is closed.
+
+    This is a singleton, like NotificationCenter and DeviceManager.
+    """
+    _instance = None
+
+    class Entry:
+        def __init__(self, port, openParameters):
+            self.port = port
+            self.openParameters = openParameters
+            self.referenceCount = 0
+            self.idleSince = None
+
+    def destroy(self):
+        pool = SerialPortPool()
+        pool.closeAllPorts()
+        SerialPortPool._instance = None
+        del(pool)
+
+    def __init__(self):
+        if not hasattr(self, 'entries'):
+            self.entries = {}
+        if not hasattr(self, 'lock'):
+            self.lock = RLock()
+        if not hasattr(self, 'idleTimeout'):
+            self.idleTimeout = 2.0
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def acquire(self, portPath=None, idVendor=None, idProduct=None, serialNumber=None, **openParameters) -> SerialPort:
+        """ Returns the open, shared SerialPort for portPath (or for the first
+        port matching idVendor/idProduct/serialNumber). The port is opened
+        with openParameters (baudRate, timeout, rtscts, dsrdtr) by the first
+        caller. Later callers get the same port and must ask for the same
+        parameters, or none: other values raise IncompatibleOpenParameters
+        (a shared port cannot have two baud rates). Each acquire() must be
+        balanced by a release(). """
+        if portPath is None:
+            portPath = SerialPort.matchAnyPort(idVendor=idVendor, idProduct=idProduct, serialNumber=serialNumber)
+            if portPath is None:
+                raise UnableToOpenSerialPort("No serial port matching idVendor {0}, idProduct {1}, serialNumber {2}".format(idVendor, idProduct, serialNumber))
+
+        with self.lock:
+            entry = self.entries.get(portPath)
+            if entry is None:
+                port = SerialPort(portPath=portPath)
+                port.open(**openParameters)
+                entry = SerialPortPool.Entry(port, openParameters)
+                self.entries[portPath] = entry
+            else:
+                mismatches = {}
+                for name, value in openParameters.items():
+                    if name not in entry.openParameters or entry.openParameters[name] != value:
+                        mismatches[name] = value
+                if len(mismatches) > 0:
+                    raise IncompatibleOpenParameters("Port {0} is already open with {1}, not {2}".format(portPath, entry.openParameters, mismatches))
+                if not entry.port.isOpen:
+                    entry.port.open(**entry.openParameters)
+
+            entry.referenceCount += 1
+            entry.idleSince = None
+            return entry.port
+
+    def release(self, port):
+        """ Gives back a port obtained with acquire(). A port that does not
+        come from the pool is simply closed, so devices can always release()
+        their port, pooled or not. """
+        with self.lock:
+            entry = self.entryForPort(port)
+            if entry is None:
+                if port.isOpen:
+                    port.close()
+                return
+
+            if entry.referenceCount > 0:
+                entry.referenceCount -= 1
+
+            if entry.referenceCount == 0:
+                entry.idleSince = time.monotonic()
+                if self.idleTimeout <= 0:
+                    self.closeIdlePorts()
+                else:
+                    timer = Timer(self.idleTimeout, self.closePortIfStillIdle, args=(entry, entry.idleSince))
+                    timer.daemon = True
+                    timer.start()
+
+    def closePortIfStillIdle(self, entry, idleSince):
+        """ Called idleTimeout after the last release(): closes the port
+        unless it was acquired again in the meantime. """
+        with self.lock:
+            if entry.referenceCount == 0 and entry.idleSince == idleSince:
+                if self.entries.get(entry.port.portPath) is entry:
+                    del self.entries[entry.port.portPath]
+                if entry.port.isOpen:
+                    entry.port.close()
+
+    def entryForPort(self, port):
+        entry = self.entries.get(getattr(port, 'portPath', None))
+        if entry is not None and entry.port is port:
+            return entry
+        return None
+
+    def referenceCount(self, portPath) -> int:
+        with self.lock:
+            entry = self.entries.get(portPath)
+            if entry is None:
+                return 0
+            return entry.referenceCount
+
+    def closeIdlePorts(self, idleTimeout=None) -> int:
+        """ Closes and forgets the ports that nobody uses since at least
+        idleTimeout seconds (self.idleTimeout by default). Returns the number
+        of ports closed. """
+        if idleTimeout is None:
+            idleTimeout = self.idleTimeout
+
+        closedPortPaths = []
+        with self.lock:
+            now = time.monotonic()
+            for portPath, entry in self.entries.items():
+                if entry.referenceCount == 0 and entry.idleSince is not None:
+                    if now - entry.idleSince >= idleTimeout:
+                        closedPortPaths.append(portPath)
+
+            for portPath in closedPortPaths:
+                entry = self.entries.pop(portPath)
+                if entry.port.isOpen:
+                    entry.port.close()
+
+        return len(closedPortPaths)
+
+    def closeAllPorts(self):
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.port.isOpen:
+                    entry.port.close()
+            self.entries = {}
@@ -0,0 +1,93 @@
+import time
+from typing import NamedTuple
+
+class TimingPolicy(NamedTuple):
+    """
+    The delays used by ports and devices when opening, flushing and
+    sending commands, in seconds. Many devices (FTDI chips in particular)
+    need some time to settle, but fixed sleeps put a floor on every command
+    cycle: the policy makes them configurable per port (CommunicationPort.timingPolicy)
+    and per device class (e.g. SutterDevice.timingPolicy).
+
+    The defaults are the historical values (conservativeTiming). fastTiming
+    waits for events instead: it polls with an exponential backoff and
+    drains the input until it is quiet rather than sleeping a fixed time.
+    Use _replace() to derive a policy: conservativeTiming._replace(commandDelay=0)
+    """
+    pollInterval: float = 0.05          # First interval when polling for a condition (e.g. port is open)
+    backoffFactor: float = 1.0          # Each poll interval is multiplied by this factor...
+    maximumPollInterval: float = 0.05   # ...up to this value
+    openSettleDelay: float = 0.05       # After a serial port is open
+    flushSettleDelay: float = 0.02      # Before and after flushing a serial port
+    flushQuietTime: float = None        # If set, discard input until nothing arrives for that long before flushing
+    flushTimeout: float = 1.0           # Maximum time to wait for the input to be quiet
+    usbFlushDelay: float = 0.1          # Before and after flushing a USB port
+    usbFlushReadTimeout: float = 0.1    # Timeout of the read that empties the USB input endpoint
+    commandDelay: float = 0.1           # Before a device writes a command
+    replyDelay: float = 0.1             # Before a device reads a reply
+
+    def sleep(self, delay):
+        if delay is not None and delay > 0:
+            time.sleep(delay)
+
+    def waitUntil(self, condition, timeout) -> bool:
+        """ Polls condition() until it is True (returns True) or timeout
+        expires (returns False), with intervals growing by backoffFactor. """
+        deadline = time.time() + timeout
+        interval = self.pollInterval
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * self.backoffFactor, self.maximumPollInterval)
+
+        return True
+
+    def waitUntilQuiet(self, bytesAvailable, discard, quietTime=None, timeout=None) -> int:
+        """ Discards incoming data (discard(n) is called with bytesAvailable()
+        bytes) until nothing has arrived for quietTime, or timeout expires.
+        Returns the number of bytes discarded. """
+        if quietTime is None:
+            quietTime = self.flushQuietTime
+        if timeout is None:
+            timeout = self.flushTimeout
+
+        startTime = time.time()
+        lastDataTime = startTime
+        nBytesDiscarded = 0
+        interval = self.pollInterval
+        while True:
+            now = time.time()
+            if now - startTime >= timeout:
+                return nBytesDiscarded
+
+            available = bytesAvailable()
+            if available > 0:
+                discard(available)
+                nBytesDiscarded += available
+                lastDataTime = now
+                interval = self.pollInterval
+            elif now - lastDataTime >= quietTime:
+                return nBytesDiscarded
+            else:
+                time.sleep(min(interval, quietTime))
+                interval = min(interval * self.backoffFactor, self.maximumPollInterval)
+
+    @property
+    def usbFlushReadTimeoutInMs(self) -> int:
+        # PyUSB timeouts are in ms, and 0 means 'forever'
+        return max(1, int(self.usbFlushReadTimeout * 1000))
+
+conservativeTiming = TimingPolicy()
+
+fastTiming = TimingPolicy(pollInterval=0.0005,
+                          backoffFactor=2.0,
+                          maximumPollInterval=0.05,
+                          openSettleDelay=0,
+                          flushSettleDelay=0,
+                          flushQuietTime=0.0005,
+                          flushTimeout=0.1,
+                          usbFlushDelay=0,
+                          usbFlushReadTimeout=0.005,
+                          commandDelay=0,
+                          replyDelay=0)
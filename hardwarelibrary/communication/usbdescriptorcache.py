@@ -0,0 +1,136 @@
+import time
+from threading import RLock
+from typing import NamedTuple
+import usb.util
+
+class USBDeviceStrings(NamedTuple):
+    serialNumber: str
+    manufacturer: str
+    product: str
+
+class USBDescriptorCache:
+    """
+    The string descriptors (serial number, manufacturer, product) of the
+    connected USB devices. Reading one is a control transfer that takes
+    milliseconds and can block on a busy device, so each string is read
+    once per device and kept until forget() is called when the device
+    disconnects (the DeviceManager does) or purge() is called with a new
+    enumeration (the connectedUSBDevices() functions do). Devices are
+    identified by bus, port path and address: a device that is reconnected
+    gets another address, hence is read again.
+
+    A read that fails (e.g. a busy device) returns None and is not retried
+    before failureRetryInterval seconds. hits and misses count the lookups;
+    readString and clock can be replaced (e.g. for tests with fake devices).
+    """
+    _instance = None
+    failureRetryInterval = 1.0
+
+    def destroy(self):
+        cache = USBDescriptorCache()
+        USBDescriptorCache._instance = None
+        del(cache)
+
+    def __init__(self):
+        if not hasattr(self, 'lock'):
+            self.lock = RLock()
+        if not hasattr(self, 'strings'):
+            self.strings = {}  # key -> {descriptor index attribute: string}
+        if not hasattr(self, 'failedReads'):
+            self.failedReads = {}  # (key, descriptor index attribute) -> time of the failure
+        if not hasattr(self, 'hits'):
+            self.hits = 0
+        if not hasattr(self, 'misses'):
+            self.misses = 0
+        if not hasattr(self, 'readString'):
+            self.readString = usb.util.get_string
+        if not hasattr(self, 'clock'):
+            self.clock = time.monotonic
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    @staticmethod
+    def keyFor(usbDevice) -> tuple:
+        try:
+            portPath = usbDevice.port_numbers
+        except Exception as err:
+            portPath = None
+        return (getattr(usbDevice, 'bus', None), portPath, getattr(usbDevice, 'address', None), usbDevice.idVendor, usbDevice.idProduct)
+
+    def string(self, usbDevice, indexAttribute) -> str:
+        """ The string at index usbDevice.<indexAttribute> (e.g. 'iSerialNumber') """
+        key = self.keyFor(usbDevice)
+        with self.lock:
+            deviceStrings = self.strings.get(key)
+            if deviceStrings is not None and indexAttribute in deviceStrings:
+                self.hits += 1
+                return deviceStrings[indexAttribute]
+            failureTime = self.failedReads.get((key, indexAttribute))
+            if failureTime is not None and self.clock() - failureTime < self.failureRetryInterval:
+                self.hits += 1
+                return None
+            self.misses += 1
+
+        # Without the lock: the transfer can be slow
+        try:
+            index = getattr(usbDevice, indexAttribute, 0)
+            value = None
+            if index:
+                value = self.readString(usbDevice, index)
+        except Exception as err:
+            with self.lock:
+                self.failedReads[(key, indexAttribute)] = self.clock()
+            return None
+
+        with self.lock:
+            self.strings.setdefault(key, {})[indexAttribute] = value
+            self.failedReads.pop((key, indexAttribute), None)
+        return value
+
+    def serialNumber(self, usbDevice) -> str:
+        return self.string(usbDevice, 'iSerialNumber')
+
+    def manufacturer(self, usbDevice) -> str:
+        return self.string(usbDevice, 'iManufacturer')
+
+    def product(self, usbDevice) -> str:
+        return self.string(usbDevice, 'iProduct')
+
+    def deviceStrings(self, usbDevice) -> USBDeviceStrings:
+        return USBDeviceStrings(self.serialNumber(usbDevice), self.manufacturer(usbDevice), self.product(usbDevice))
+
+    def forget(self, usbDevice):
+        """ usbDevice was disconnected """
+        key = self.keyFor(usbDevice)
+        with self.lock:
+            self.strings.pop(key, None)
+            self.failedReads = { failure: failureTime for failure, failureTime in self.failedReads.items() if failure[0] != key }
+
+    def purge(self, connectedDevices, vidpids=None):
+        """ Forgets the devices that are not in connectedDevices anymore.
+        connectedDevices is a complete enumeration of the products in
+        vidpids, a list of (idVendor, idProduct) where None matches any
+        (all the products if vidpids is None): the other devices are kept. """
+        def isEnumerated(key):
+            if vidpids is None:
+                return True
+            idVendor, idProduct = key[3:]
+            for vendor, product in vidpids:
+                if vendor in (None, idVendor) and product in (None, idProduct):
+                    return True
+            return False
+
+        connectedKeys = set([ self.keyFor(usbDevice) for usbDevice in connectedDevices ])
+        with self.lock:
+            self.strings = { key: deviceStrings for key, deviceStrings in self.strings.items() if key in connectedKeys or not isEnumerated(key) }
+            self.failedReads = { failure: failureTime for failure, failureTime in self.failedReads.items() if failure[0] in connectedKeys or not isEnumerated(failure[0]) }
+
+    def clear(self):
+        with self.lock:
+            self.strings = {}
+            self.failedReads = {}
+            self.hits = 0
+            self.misses = 0
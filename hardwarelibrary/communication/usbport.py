@@ -1,4 +1,5 @@
 from .communicationport import *
+from .ringbuffer import RingBuffer
 
 import usb.core
 import usb.util
@@ -7,6 +8,7 @@ import time
 import random
 from threading import Thread, RLock
 import array
+import queue
 
 class USBPort(CommunicationPort):
     """USBPort class with basic application-level protocol 
@@ -32,8 +34,8 @@ class USBPort(CommunicationPort):
                         usbDevice = usb.core.find(idVendor=device.idVendor, idProduct=device.idProduct)
                         print(usbDevice)
 
-    def __init__(self, idVendor=None, idProduct=None, serialNumber=None, interfaceNumber=0, defaultEndPoints=(0, 1)):
-        CommunicationPort.__init__(self)
+    def __init__(self, idVendor=None, idProduct=None, serialNumber=None, interfaceNumber=0, defaultEndPoints=(0, 1), maximumTransferSize=None, threadSafe=True):
+        CommunicationPort.__init__(self, threadSafe=threadSafe)
         self.idVendor = idVendor
         self.idProduct = idProduct
         self.serialNumber = serialNumber
@@ -46,7 +48,24 @@ class USBPort(CommunicationPort):
         self.defaultOutputEndPoint = None
         self.defaultInputEndPoint = None
         self.defaultTimeout = 500
-        self._internalBuffer = bytearray()
+        self.internalBufferSize = 65536
+        self._internalBuffer = RingBuffer(self.internalBufferSize)
+        self._packetBuffers = {}
+
+        # Bulk mode: when set, a read that needs more than one packet asks
+        # libusb for several packets at once (up to maximumTransferSize bytes)
+        # instead of one round trip per packet. None reads a single packet.
+        self.maximumTransferSize = maximumTransferSize
+
+        # Optional background reading (see startBackgroundReading)
+        self.backgroundReader = None
+        self.backgroundEndPoint = None
+        self.quitBackgroundReading = False
+        self.backgroundError = None
+        self.latePacketDelay = 0.1
+        self._packetQueue = None
+        self._dropOldestPackets = False
+        self._backgroundStatistics = {"packets": 0, "bytes": 0, "dropped": 0, "late": 0, "timeouts": 0}
 
     @property
     def isOpen(self):
@@ -62,7 +81,8 @@ class USBPort(CommunicationPort):
         if self.isOpen:
             raise Exception("Port already open")
 
-        self._internalBuffer = bytearray()
+        self._internalBuffer = RingBuffer(self.internalBufferSize)
+        self._packetBuffers = {}
 
         self.device = usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct)
         if self.device is None:
@@ -84,9 +104,13 @@ class USBPort(CommunicationPort):
         self.flush()
 
     def close(self):
+        if self.backgroundReader is not None:
+            self.stopBackgroundReading()
+
         with self.portLock:
-            self._internalBuffer = None
-            
+            self._internalBuffer.clear()
+            self._packetBuffers = {}
+
             if self.device is not None:
                 usb.util.dispose_resources(self.device)
                 self.device = None
@@ -95,51 +119,227 @@ class USBPort(CommunicationPort):
                 self.defaultOutputEndPoint = None
                 self.defaultInputEndPoint = None
 
-    def bytesAvailable(self, endPoint=None) -> int:
+    def doBytesAvailable(self, endPoint=None) -> int:
         with self.portLock:
             return len(self._internalBuffer)
 
     def flush(self, endPoint=None):
-        self._internalBuffer = bytearray()
+        self.flushReadBuffer()
+        self._internalBuffer.clear()
         if self.isNotOpen:
             return
 
-        if endPoint is None:
-            inputEndPoint = self.defaultInputEndPoint
-        else:
-            inputEndPoint = self.interface[endPoint]
+        inputEndPoint = self.inputEndPoint(endPoint)
+
+        if self.backgroundReader is not None and inputEndPoint is self.backgroundEndPoint:
+            self.drainPacketQueue()
+            return
+
+        policy = self.timingPolicy
+        policy.sleep(policy.usbFlushDelay)
 
-        time.sleep(0.1)
-        
         with self.portLock:            
-            data = usb.util.create_buffer(inputEndPoint.wMaxPacketSize)
+            data = self.packetBuffer(inputEndPoint)
             try:
-                nBytesRead = inputEndPoint.read(size_or_buffer=data, timeout=100)
+                nBytesRead = inputEndPoint.read(size_or_buffer=data, timeout=policy.usbFlushReadTimeoutInMs)
             except:
                 pass # not an error
 
-        time.sleep(0.1)
+        policy.sleep(policy.usbFlushDelay)
+
+
+    def inputEndPoint(self, endPoint=None):
+        """ The endpoint read in the background is the default until
+        stopBackgroundReading() """
+        if endPoint is None:
+            if self.backgroundReader is not None:
+                return self.backgroundEndPoint
+            return self.defaultInputEndPoint
+        return self.interface[endPoint]
+
+    def transferSize(self, inputEndPoint, length) -> int:
+        """ Number of bytes to request in one endpoint read when length bytes
+        are still needed: always a whole number of packets, so that the
+        transfer ends on the device's last packet and never waits for data
+        that was not requested."""
+        packetSize = inputEndPoint.wMaxPacketSize
+        if self.maximumTransferSize is None or length <= packetSize:
+            return packetSize
+
+        nPackets = min((length + packetSize - 1) // packetSize,
+                       max(self.maximumTransferSize // packetSize, 1))
+        return nPackets * packetSize
 
+    def packetBuffer(self, inputEndPoint, size=None):
+        """ A buffer that libusb reads into, allocated once per endpoint and
+        transfer size. PyUSB requires an array.array for in-place reads and
+        always requests the full length of that array."""
+        if size is None:
+            size = inputEndPoint.wMaxPacketSize
+
+        key = (inputEndPoint.bEndpointAddress, size)
+        packetBuffer = self._packetBuffers.get(key)
+        if packetBuffer is None:
+            packetBuffer = usb.util.create_buffer(size)
+            self._packetBuffers[key] = packetBuffer
+        return packetBuffer
+
+    def readPacketIntoInternalBuffer(self, inputEndPoint, length=0):
+        if self.backgroundReader is not None and inputEndPoint is self.backgroundEndPoint:
+            return self.readQueuedPacketIntoInternalBuffer()
+
+        data = self.packetBuffer(inputEndPoint, self.transferSize(inputEndPoint, length))
+        nBytesRead = inputEndPoint.read(size_or_buffer=data, timeout=self.defaultTimeout)
+        self._internalBuffer.write(memoryview(data)[:nBytesRead])
+        return nBytesRead
+
+    @property
+    def isReadingInBackground(self):
+        """ False once the reader has stopped on an error (backgroundError),
+        even though its queued packets can still be read """
+        return self.backgroundReader is not None and self.backgroundReader.is_alive()
+
+    def startBackgroundReading(self, queueDepth=8, endPoint=None, dropOldestPackets=False):
+        """ Starts a thread that keeps reading packets from the input
+        endpoint while the caller is busy with the previous ones. Completed
+        packets wait in a queue of queueDepth packets that readData() and
+        readString() consume. When the queue is full, the reader waits for
+        room, or discards the oldest packet if dropOldestPackets is True.
+
+        The endpoint only needs read(size_or_buffer, timeout),
+        wMaxPacketSize and bEndpointAddress (as in PyUSB), so any object
+        with that interface (e.g. DebugEndPoint) can be used. Until
+        stopBackgroundReading(), it replaces the default input endpoint.
+        Each read requests up to maximumTransferSize bytes (one packet if
+        None).
+
+        If the reader stops on an error, readData() returns the packets
+        already queued, then raises IOError. Background reading can then
+        be started again. """
+        if self.isReadingInBackground:
+            raise RuntimeError("Background reading already running")
+        elif self.backgroundReader is not None:
+            self.stopBackgroundReading() # Stopped on an error
 
-    def readData(self, length, endPoint=None) -> bytearray:
         if not self.isOpen:
             self.open()
 
-        if endPoint is None:
-            inputEndPoint = self.defaultInputEndPoint
-        else:
-            inputEndPoint = self.interface[endPoint]
+        inputEndPoint = endPoint
+        if inputEndPoint is None or isinstance(inputEndPoint, int):
+            inputEndPoint = self.inputEndPoint(endPoint)
+
+        self._packetQueue = queue.Queue(maxsize=queueDepth)
+        self._dropOldestPackets = dropOldestPackets
+        self.backgroundEndPoint = inputEndPoint
+        self.backgroundError = None
+        self.quitBackgroundReading = False
+        self.backgroundReader = Thread(target=self.backgroundReadingLoop, args=(inputEndPoint,), name="USBPort-backgroundReading", daemon=True)
+        self.backgroundReader.start()
+
+    def stopBackgroundReading(self):
+        if self.backgroundReader is None:
+            raise RuntimeError("No background reading running")
+
+        self.quitBackgroundReading = True
+        self.backgroundReader.join()
+        self.backgroundReader = None
+
+        with self.portLock:
+            # Whatever was already read is still valid data for the next readData()
+            self.drainPacketQueue(keepData=True)
+            self.backgroundEndPoint = None
+            self._packetQueue = None
+
+    def backgroundReadingLoop(self, inputEndPoint):
+        # Only this thread writes the packets, bytes, dropped and timeouts
+        # counters. late is written by the thread that consumes the packets.
+        statistics = self._backgroundStatistics
+        transferSize = self.transferSize(inputEndPoint, self.maximumTransferSize or 0)
+        while not self.quitBackgroundReading:
+            try:
+                data = inputEndPoint.read(size_or_buffer=transferSize, timeout=self.defaultTimeout)
+            except usb.core.USBTimeoutError:
+                statistics["timeouts"] += 1
+                continue
+            except Exception as err:
+                self.backgroundError = err
+                break
+
+            packet = (time.perf_counter(), data)
+            statistics["packets"] += 1
+            statistics["bytes"] += len(data)
+
+            while not self.quitBackgroundReading:
+                try:
+                    self._packetQueue.put(packet, timeout=0.05)
+                    break
+                except queue.Full:
+                    if self._dropOldestPackets:
+                        try:
+                            self._packetQueue.get_nowait()
+                            statistics["dropped"] += 1
+                        except queue.Empty:
+                            pass
+
+    def readQueuedPacketIntoInternalBuffer(self):
+        try:
+            receivedTime, data = self._packetQueue.get(timeout=self.defaultTimeout/1000)
+        except queue.Empty:
+            if self.backgroundError is not None:
+                raise IOError("Background reading stopped: {0}".format(self.backgroundError))
+            raise CommunicationReadTimeout("No packet received from background reader")
+
+        if time.perf_counter() - receivedTime > self.latePacketDelay:
+            self._backgroundStatistics["late"] += 1
+
+        self._internalBuffer.write(data)
+        return len(data)
+
+    def drainPacketQueue(self, keepData=False):
+        while True:
+            try:
+                receivedTime, data = self._packetQueue.get_nowait()
+            except queue.Empty:
+                break
+            if keepData:
+                self._internalBuffer.write(data)
+
+    def backgroundStatistics(self) -> dict:
+        """ Counters for background reading: packets and bytes read,
+        packets dropped because the queue was full, packets consumed more
+        than latePacketDelay seconds after they arrived, read timeouts, and
+        the current queue depth. """
+        statistics = dict(self._backgroundStatistics)
+        statistics["queued"] = self._packetQueue.qsize() if self._packetQueue is not None else 0
+        return statistics
+
+    def resetBackgroundStatistics(self):
+        for key in self._backgroundStatistics:
+            self._backgroundStatistics[key] = 0
+
+    def doReadData(self, length, endPoint=None) -> bytearray:
+        if not self.isOpen:
+            self.open()
+
+        inputEndPoint = self.inputEndPoint(endPoint)
 
         with self.portLock:
             while length > len(self._internalBuffer):
-                data = usb.util.create_buffer(inputEndPoint.wMaxPacketSize)
-                nBytesRead = inputEndPoint.read(size_or_buffer=data, timeout=self.defaultTimeout)
-                self._internalBuffer += bytearray(data[:nBytesRead])
+                self.readPacketIntoInternalBuffer(inputEndPoint, length - len(self._internalBuffer))
+
+            return self._internalBuffer.read(length)
+
+    def doReadInto(self, view, endPoint=None) -> int:
+        if not self.isOpen:
+            self.open()
+
+        inputEndPoint = self.inputEndPoint(endPoint)
 
-            data = self._internalBuffer[:length]
-            self._internalBuffer = self._internalBuffer[length:]
+        with self.portLock:
+            while len(view) > len(self._internalBuffer):
+                self.readPacketIntoInternalBuffer(inputEndPoint, len(view) - len(self._internalBuffer))
 
-        return data
+            return self._internalBuffer.readInto(view)
 
     def writeData(self, data, endPoint=None) -> int:
         if not self.isOpen:
@@ -156,13 +356,3 @@ class USBPort(CommunicationPort):
                 raise IOError("Not all bytes written to port: actual {0} requested {1}".format(nBytesWritten, len(data)))
 
         return nBytesWritten
-
-    def readString(self, endPoint=None) -> str:      
-        data = bytearray()
-        while True:
-            try:
-                data += self.readData(length=1, endPoint=endPoint)
-                if data[-1] == 10: # How to write '\n' ?
-                    return data.decode(encoding='utf-8')
-            except Exception as err:
-                raise IOError("Unable to read string terminator: {0}".format(err))
@@ -3,6 +3,7 @@ import re
 from enum import Enum
 from typing import NamedTuple
 from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from hardwarelibrary.notificationcenter import NotificationCenter, Notification
 from hardwarelibrary.physicaldevice import PhysicalDevice, DeviceState, debugClassIdVendor
 from hardwarelibrary.motion import DebugLinearMotionDevice, LinearMotionDevice, SutterDevice
@@ -10,6 +11,11 @@ from hardwarelibrary.spectrometers import Spectrometer
 from hardwarelibrary.powermeters import PowerMeterDevice, IntegraDevice
 from hardwarelibrary.oscilloscope import OscilloscopeDevice
 from hardwarelibrary.communication.diagnostics import *
+from hardwarelibrary.communication.serialport import SerialPort
+from hardwarelibrary.communication.communicationport import CommunicationPort
+from hardwarelibrary.communication.portstatistics import PortStatistics
+from hardwarelibrary.communication.usbdescriptorcache import USBDescriptorCache
+from hardwarelibrary.usbhotplug import USBDeviceSet, createHotplugMonitor
 import hardwarelibrary.utils as utils
 
 class DeviceManagerNotification(Enum):
@@ -49,11 +55,7 @@ class USBDeviceDescriptor:
     def fromUSBDevice(cls, usbDevice):
         idProduct = usbDevice.idProduct
         idVendor = usbDevice.idVendor
-        serialNumber = None
-        try:
-            serialNumber = usb.util.get_string(usbDevice, usbDevice.iSerialNumber)
-        except Exception as err:
-            serialNumber = None
+        serialNumber = USBDescriptorCache().serialNumber(usbDevice)
 
         return USBDeviceDescriptor(serialNumber=serialNumber, idProduct=idProduct, idVendor=idVendor, usbDevice=usbDevice)
 
@@ -99,7 +101,27 @@ class USBDeviceDescriptor:
         return True
 
 class DeviceManager:
+    class DeviceOperationFailed(Exception):
+        """ Raised by initializeDevices()/shutdownDevices() after all the
+        devices were processed: errors has the exception of each device that
+        failed (TimeoutError if it did not finish in time, DeviceBusy if a
+        previous operation that timed out is still running) """
+        def __init__(self, errors):
+            self.errors = errors
+            super().__init__("{0} device(s) failed: {1}".format(len(errors),
+                             "; ".join([ "{0}: {1!r}".format(device, error) for device, error in errors.items() ])))
+    class UnableToInitializeDevices(DeviceOperationFailed):
+        pass
+    class UnableToShutdownDevices(DeviceOperationFailed):
+        pass
+    class PrerequisiteFailed(Exception):
+        pass
+    class DeviceBusy(Exception):
+        pass
+
     _instance = None
+    maximumConcurrentOperations = 8
+    statusInterval = 0.3
 
     def destroy(self):
         dm = DeviceManager()
@@ -119,6 +141,12 @@ class DeviceManager:
             self.usbDevices = []
         if not hasattr(self, 'usbDeviceDescriptors'):
             self.usbDeviceDescriptors = []
+        if not hasattr(self, 'usbDeviceSet'):
+            self.usbDeviceSet = USBDeviceSet(source=connectedUSBDevices)
+        if not hasattr(self, 'hotplugMonitor'):
+            self.hotplugMonitor = None # created by startMonitoring() if None
+        if not hasattr(self, 'busyDevices'):
+            self.busyDevices = set() # devices whose operation timed out but is still running
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -133,6 +161,8 @@ class DeviceManager:
         with self.lock:
             if not self.isMonitoring:
                 self.quitMonitoring = False
+                if self.hotplugMonitor is None:
+                    self.hotplugMonitor = createHotplugMonitor(self.statusInterval)
                 self.monitoring = Thread(target=self.monitoringLoop, name="DeviceManager-RunLoop")
                 NotificationCenter().postNotification(notificationName=DeviceManagerNotification.willStartMonitoring, notifyingObject=self)
                 self.monitoring.start()
@@ -143,8 +173,14 @@ class DeviceManager:
         currentDevices = []
         with self.lock:
             newDevices, newlyDisconnected = self.newlyConnectedAndDisconnectedUSBDevices()
-            for newUsbDevice in newDevices:
-                self.usbDeviceConnected(newUsbDevice)
+            if len(newDevices) > 0 or len(newlyDisconnected) > 0:
+                # Serial ports come and go with their USB device
+                SerialPort.invalidatePortCache()
+
+        # Without the lock: the probes post notifications from worker threads
+        self.usbDevicesConnected(newDevices)
+
+        with self.lock:
             for oldUsbDevice in newlyDisconnected:
                 self.usbDeviceDisconnected(oldUsbDevice)
 
@@ -156,14 +192,21 @@ class DeviceManager:
         startTime = time.time()
         endTime = startTime + duration
         NotificationCenter().postNotification(DeviceManagerNotification.didStartMonitoring, notifyingObject=self)
+        usbDevicesMayHaveChanged = True
         while time.time() < endTime :    
-            currentDevices = self.updateConnectedDevices()
+            if usbDevicesMayHaveChanged:
+                currentDevices = self.updateConnectedDevices()
+            else:
+                with self.lock:
+                    currentDevices = list(self.devices)
             NotificationCenter().postNotification(DeviceManagerNotification.status, notifyingObject=self, userInfo=currentDevices)
 
             with self.lock:
                 if self.quitMonitoring:
                      break
-            time.sleep(0.3)
+            # The USB devices are enumerated again only after a hotplug event
+            # (or every statusInterval without hotplug events)
+            usbDevicesMayHaveChanged = self.hotplugMonitor.waitForChange(self.statusInterval)
         NotificationCenter().postNotification(DeviceManagerNotification.didStopMonitoring, notifyingObject=self)
 
     def showNotifications(self):
@@ -184,10 +227,8 @@ class DeviceManager:
         print(notification.name, notification.userInfo)
 
     def newlyConnectedAndDisconnectedUSBDevices(self):
-        currentlyConnectedDevices = connectedUSBDevices()
-        newlyConnected = [ usbDevice for usbDevice in currentlyConnectedDevices if usbDevice not in self.usbDevices]
-        newlyDisconnected = [ usbDevice for usbDevice in self.usbDevices if usbDevice not in currentlyConnectedDevices]
-        self.usbDevices = currentlyConnectedDevices
+        newlyConnected, newlyDisconnected = self.usbDeviceSet.update()
+        self.usbDevices = self.usbDeviceSet.devices
 
         return newlyConnected, newlyDisconnected
 
@@ -201,32 +242,66 @@ class DeviceManager:
             NotificationCenter().postNotification(DeviceManagerNotification.willStopMonitoring, notifyingObject=self)
             with self.lock:
                 self.quitMonitoring = True
+            self.hotplugMonitor.wakeUp()
             self.monitoring.join()
+            self.hotplugMonitor.close()
+            self.hotplugMonitor = None
             self.removeAllDevices()
             self.monitoring = None
         else:
             raise RuntimeError("No monitoring loop running")
 
     def usbDeviceConnected(self, usbDevice):
+        descriptor, deviceInstances = self.probeUSBDevice(usbDevice)
+        self.addProbedDevices(descriptor, deviceInstances)
+
+    def usbDevicesConnected(self, usbDevices):
+        """ Same as usbDeviceConnected() for each USB device, but the
+        different USB devices are probed concurrently """
+        if len(usbDevices) <= 1:
+            for usbDevice in usbDevices:
+                self.usbDeviceConnected(usbDevice)
+            return
+
+        probed = {}
+        def probe(usbDevice):
+            probed[usbDevice] = self.probeUSBDevice(usbDevice)
+
+        self.performConcurrently(probe, usbDevices)
+        for usbDevice in usbDevices:
+            if usbDevice in probed:
+                self.addProbedDevices(*probed[usbDevice])
+
+    def probeUSBDevice(self, usbDevice):
+        """ The descriptor of usbDevice and the instances of the candidate
+        classes that could be initialized with it (then shut down). Called
+        from the worker threads of usbDevicesConnected(): does not use
+        self.lock. """
         descriptor = USBDeviceDescriptor.fromUSBDevice(usbDevice)
         NotificationCenter().postNotification(DeviceManagerNotification.usbDeviceDidConnect, notifyingObject=self, userInfo=descriptor)
-        if descriptor not in self.usbDeviceDescriptors:
-            self.usbDeviceDescriptors.append(descriptor)
 
+        deviceInstances = []
         candidates = utils.getCandidateDeviceClasses(PhysicalDevice, descriptor.idVendor, descriptor.idProduct)
         for candidateClass in candidates:
-            # This may throw if incompat:
-            #                 deviceInstanceible
+            # The candidates share the USB device: they are tried one at a time
             try:
-                candidateClass(serialNumber=descriptor.serialNumber,
-                                            idProduct=descriptor.idProduct,
-                                            idVendor=descriptor.idVendor)
+                deviceInstance = candidateClass(serialNumber=descriptor.serialNumber,
+                                                idProduct=descriptor.idProduct,
+                                                idVendor=descriptor.idVendor)
                 deviceInstance.initializeDevice()
                 deviceInstance.shutdownDevice()
-                self.addDevice(deviceInstance)
+                deviceInstances.append(deviceInstance)
             except Exception as err:
                 pass
-                
+        return descriptor, deviceInstances
+
+    def addProbedDevices(self, descriptor, deviceInstances):
+        with self.lock:
+            if descriptor not in self.usbDeviceDescriptors:
+                self.usbDeviceDescriptors.append(descriptor)
+            for deviceInstance in deviceInstances:
+                self.addDevice(deviceInstance)
+
     def usbDeviceDisconnected(self, usbDevice):
         descriptor = None
         for aDescriptor in self.usbDeviceDescriptors:
@@ -252,12 +327,134 @@ class DeviceManager:
     def removeAllDevices(self):
         with self.lock:
             devicesToRemove = set(self.devices)
+
+        # Without the lock: the devices post notifications from worker threads
+        errors = self.performConcurrently(lambda device: device.shutdownDevice(), devicesToRemove)
+        with self.lock:
             for device in devicesToRemove:
-                try:
-                    device.shutdownDevice()
-                except Exception as err:
-                    print(err)
-                self.removeDevice(device)
+                if device in errors:
+                    print(errors[device])
+                if device in self.devices:
+                    self.removeDevice(device)
+
+    def initializeDevices(self, devices=None, timeout=None, dependencies=None):
+        """ Initializes devices (all the devices by default) concurrently,
+        with at most maximumConcurrentOperations at a time. A device is only
+        initialized once its dependencies (dependencies[device], a list of
+        devices) are, and fails with PrerequisiteFailed if one of them
+        failed. A device that takes more than timeout seconds fails with
+        TimeoutError (its initialization continues in the background, and
+        the device fails with DeviceBusy in other operations until it ends).
+        Raises UnableToInitializeDevices with all the errors, once the
+        other devices are initialized. """
+        if devices is None:
+            with self.lock:
+                devices = list(self.devices)
+        errors = self.performConcurrently(lambda device: device.initializeDevice(), devices, timeout, dependencies)
+        if len(errors) > 0:
+            raise DeviceManager.UnableToInitializeDevices(errors)
+
+    def shutdownDevices(self, devices=None, timeout=None, dependencies=None):
+        """ Shuts down devices (all the devices by default) concurrently, as
+        initializeDevices() in reverse: a device is shut down after the
+        devices that depend on it, even if they failed. Raises
+        UnableToShutdownDevices with all the errors. """
+        if devices is None:
+            with self.lock:
+                devices = list(self.devices)
+
+        dependents = {}
+        for device, prerequisites in (dependencies or {}).items():
+            for prerequisite in prerequisites:
+                dependents.setdefault(prerequisite, []).append(device)
+
+        errors = self.performConcurrently(lambda device: device.shutdownDevice(), devices, timeout, dependents,
+                                          skipAfterFailedPrerequisite=False)
+        if len(errors) > 0:
+            raise DeviceManager.UnableToShutdownDevices(errors)
+
+    def performConcurrently(self, operation, devices, timeout=None, prerequisites=None, skipAfterFailedPrerequisite=True) -> dict:
+        """ Calls operation(device) for each device from a pool of threads, a
+        device after its prerequisites (only those in devices), and returns
+        the exceptions by device.
+
+        An operation that times out cannot be interrupted: it keeps running
+        in its thread, and the device stays in busyDevices until it ends.
+        Meanwhile, the device fails with DeviceBusy instead of running
+        another operation concurrently on the same device and port. """
+        devices = list(devices)
+        prerequisites = { device: [ other for other in (prerequisites or {}).get(device, []) if other in devices ] for device in devices }
+        errors = {}
+        finished = set()
+        with self.lock:
+            busy = [ device for device in devices if device in self.busyDevices ]
+        for device in busy:
+            errors[device] = DeviceManager.DeviceBusy("{0} is still running an operation that timed out".format(device))
+            finished.add(device)
+        waiting = [ device for device in devices if device not in busy ]
+        running = {}     # future -> device
+        startTimes = {}  # device -> time.monotonic(), set by the worker
+
+        def perform(device):
+            startTimes[device] = time.monotonic()
+            operation(device)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.maximumConcurrentOperations, len(devices))),
+                                      thread_name_prefix="DeviceManager-worker")
+        try:
+            while len(waiting) > 0 or len(running) > 0:
+                for device in list(waiting):
+                    failed = [ other for other in prerequisites[device] if other in errors ]
+                    if len(failed) > 0 and skipAfterFailedPrerequisite:
+                        errors[device] = DeviceManager.PrerequisiteFailed("{0} requires {1}".format(device, failed[0]))
+                        finished.add(device)
+                        waiting.remove(device)
+                    elif all([ other in finished for other in prerequisites[device] ]):
+                        running[executor.submit(perform, device)] = device
+                        waiting.remove(device)
+
+                if len(running) == 0:
+                    for device in waiting:
+                        errors[device] = DeviceManager.PrerequisiteFailed("Circular dependency for {0}".format(device))
+                    break
+
+                waitTime = None
+                if timeout is not None:
+                    started = [ startTimes[device] for device in running.values() if device in startTimes ]
+                    if len(started) > 0:
+                        waitTime = max(min(started) + timeout - time.monotonic(), 0)
+                    else:
+                        waitTime = timeout
+
+                done, notDone = wait(list(running.keys()), timeout=waitTime, return_when=FIRST_COMPLETED)
+                for future in done:
+                    device = running.pop(future)
+                    if future.exception() is not None:
+                        errors[device] = future.exception()
+                    finished.add(device)
+
+                if timeout is not None:
+                    now = time.monotonic()
+                    for future, device in list(running.items()):
+                        if device in startTimes and now - startTimes[device] >= timeout:
+                            errors[device] = TimeoutError("{0} did not finish in {1} s".format(device, timeout))
+                            finished.add(device)
+                            del running[future]
+                            self.markBusyUntilDone(device, future)
+        finally:
+            executor.shutdown(wait=False)
+
+        return errors
+
+    def markBusyUntilDone(self, device, future):
+        with self.lock:
+            self.busyDevices.add(device)
+
+        def done(future):
+            with self.lock:
+                self.busyDevices.discard(device)
+
+        future.add_done_callback(done) # Called immediately if already done
 
     def removeDevice(self, device):
         with self.lock:
@@ -307,14 +504,43 @@ class DeviceManager:
             return None
         return devices[0]
 
+    def devicePorts(self) -> list:
+        """ The communication ports of the devices, once each even when
+        devices share a port (SerialPortPool) """
+        with self.lock:
+            ports = []
+            for device in self.devices:
+                port = getattr(device, 'port', None)
+                if isinstance(port, CommunicationPort) and not any(port is other for other in ports):
+                    ports.append(port)
+            return ports
+
+    def enablePortStatistics(self):
+        for port in self.devicePorts():
+            port.enableStatistics()
+
+    def disablePortStatistics(self):
+        for port in self.devicePorts():
+            port.disableStatistics()
+
+    def portStatistics(self) -> PortStatistics:
+        """ The statistics of all the device ports that have them enabled,
+        added together """
+        return PortStatistics.combined([ port.statistics for port in self.devicePorts() if port.statistics is not None ])
+
     def sendCommand(self, commandName, deviceIdentifier=0):
         DeviceManager().updateConnectedDevices()
         device = list(self.devices)[deviceIdentifier]
 
         if device.state == DeviceState.Ready:
             command = device.commands[commandName]
-            command.send(port=device.port)
-            return (commandName, command.text, command.matchGroups)
+            try:
+                result = command.execute(port=device.port)
+                return (commandName, command.text, result.matchGroups)
+            except Exception as err:
+                # As with send(): the exception is kept in the command
+                command.keepException(err)
+                return (commandName, command.text, None)
         else:
             print("Device {0} is not Ready: call initializeDevice()".format(device))
 
@@ -1,5 +1,6 @@
 from hardwarelibrary.motion.rotationdevice import *
 from hardwarelibrary.communication.serialport import SerialPort
+from hardwarelibrary.communication.serialportpool import SerialPortPool
 from hardwarelibrary.communication.commands import DataCommand
 from hardwarelibrary.communication.debugport import DebugPort
 
@@ -39,8 +40,7 @@ class IntellidriveDevice(RotationDevice):
                 if portPath is None:
                     raise PhysicalDevice.UnableToInitialize("No Intellidrive Device connected")
 
-                self.port = SerialPort(portPath=portPath)
-                self.port.open(baudRate=9600)
+                self.port = SerialPortPool().acquire(portPath, baudRate=9600)
 
             if self.port is None:
                 raise PhysicalDevice.UnableToInitialize("Cannot allocate port {0}".format(portPath))
@@ -57,13 +57,13 @@ class IntellidriveDevice(RotationDevice):
 
         except Exception as error:
             if self.port is not None:
-                if self.port.isOpen:
-                    self.port.close()
+                SerialPortPool().release(self.port)
+                self.port = None
             self.internalState = State.notInit
             raise PhysicalDevice.UnableToInitialize(error)
 
     def doShutdownDevice(self):
-        self.port.close()
+        SerialPortPool().release(self.port)
         self.port = None
 
     def doGetSatus(self):
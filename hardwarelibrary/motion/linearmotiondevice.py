@@ -29,11 +29,13 @@ class LinearMotionDevice(PhysicalDevice):
     def moveTo(self, position):
         NotificationCenter().postNotification(LinearMotionNotification.willMove, notifyingObject=self, userInfo=position)
         self.doMoveTo(position)
+        self.statusWillChange()
         NotificationCenter().postNotification(LinearMotionNotification.didMove, notifyingObject=self, userInfo=position)
 
     def moveBy(self, displacement):
         NotificationCenter().postNotification(LinearMotionNotification.willMove, notifyingObject=self, userInfo=displacement)
         self.doMoveBy(displacement)
+        self.statusWillChange()
         NotificationCenter().postNotification(LinearMotionNotification.didMove, notifyingObject=self, userInfo=displacement)
 
     def position(self) -> ():
@@ -44,6 +46,7 @@ class LinearMotionDevice(PhysicalDevice):
     def home(self) -> ():
         NotificationCenter().postNotification(LinearMotionNotification.willMove, notifyingObject=self)
         self.doHome()
+        self.statusWillChange()
         NotificationCenter().postNotification(LinearMotionNotification.didMove, notifyingObject=self)
 
     def moveInMicronsTo(self, position):
@@ -59,6 +62,13 @@ class LinearMotionDevice(PhysicalDevice):
         positionInMicrons = [x / self.nativeStepsPerMicrons for x in position]
         return tuple(positionInMicrons)
 
+    def doGetStatusUserInfo(self):
+        """ With adaptiveRefresh only, the position: it is read from the
+        device at every status update, so the interval follows the motion """
+        if self.adaptiveRefresh:
+            return self.doGetPosition()
+        return None
+
     def mapPositions(self, width: int, height: int, stepInMicrons: float, direction: Direction = Direction.unidirectional):
         """mapPositions(width, height, stepInMicrons[, direction == "leftRight" or "zigzag"])
 
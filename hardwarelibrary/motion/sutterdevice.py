@@ -3,7 +3,8 @@ from hardwarelibrary.motion.linearmotiondevice import *
 from hardwarelibrary.communication.communicationport import *
 from hardwarelibrary.communication.usbport import USBPort
 from hardwarelibrary.communication.serialport import SerialPort
-from hardwarelibrary.communication.commands import DataCommand
+from hardwarelibrary.communication.serialportpool import SerialPortPool
+from hardwarelibrary.communication.commands import DataCommand, BinaryCommand, compiledStruct
 from hardwarelibrary.communication.debugport import DebugPort
 
 import re
@@ -16,6 +17,17 @@ class SutterDevice(LinearMotionDevice):
     classIdVendor = 4930
     classIdProduct = 1
 
+    # The delays before each command and each reply. Use fastTiming to rely
+    # on the port timeout instead.
+    timingPolicy = conservativeTiming
+
+    commands = {
+        "POSITION": BinaryCommand(name="POSITION", prefix=b'C\r', replyFormat='<xlllx'),
+        "MOVE": BinaryCommand(name="MOVE", prefix=b'M', requestFormat='<lll', suffix=b'\r', replyFormat='<c'),
+        "HOME": BinaryCommand(name="HOME", prefix=b'H\r', replyFormat='<c'),
+        "WORK": BinaryCommand(name="WORK", prefix=b'Y\r', replyFormat='<c')
+    }
+
     def __init__(self, serialNumber: str = None):
         super().__init__(serialNumber=serialNumber, idVendor=self.classIdVendor, idProduct=self.classIdProduct)
         self.port = None
@@ -45,8 +57,7 @@ class SutterDevice(LinearMotionDevice):
                 if portPath is None:
                     raise PhysicalDevice.UnableToInitialize("No Sutter Device connected")
 
-                self.port = SerialPort(portPath=portPath)
-                self.port.open(baudRate=128000, timeout=10)
+                self.port = SerialPortPool().acquire(portPath, baudRate=128000, timeout=10)
 
             if self.port is None:
                 raise PhysicalDevice.UnableToInitialize("Cannot allocate port {0}".format(self.portPath))
@@ -55,12 +66,12 @@ class SutterDevice(LinearMotionDevice):
 
         except Exception as error:
             if self.port is not None:
-                if self.port.isOpen:
-                    self.port.close()
+                SerialPortPool().release(self.port)
+                self.port = None
             raise PhysicalDevice.UnableToInitialize(error)
 
     def doShutdownDevice(self):
-        self.port.close()
+        SerialPortPool().release(self.port)
         self.port = None
 
     def sendCommandBytes(self, commandBytes):
@@ -69,7 +80,7 @@ class SutterDevice(LinearMotionDevice):
         if self.port is None:
             self.initializeDevice()
         
-        time.sleep(0.1)
+        self.timingPolicy.sleep(self.timingPolicy.commandDelay)
         nBytesWritten = self.port.writeData(commandBytes)
         if nBytesWritten != len(commandBytes):
             raise Exception(f"Unable to send command {commandBytes} to device.")
@@ -85,32 +96,39 @@ class SutterDevice(LinearMotionDevice):
         if self.port is None:
             self.initializeDevice()
 
-        time.sleep(0.1)
+        self.timingPolicy.sleep(self.timingPolicy.replyDelay)
         replyBytes = self.port.readData(size)
         if len(replyBytes) != size:
             raise Exception(f"Not enough bytes read in readReply {replyBytes}")
 
-        # print(replyBytes, format)
-        # print(unpack(format, replyBytes))
-        return unpack(format, replyBytes)
+        return compiledStruct(format).unpack(replyBytes)
+
+    def sendCommand(self, command, *arguments) -> tuple:
+        """ Sends a BinaryCommand from self.commands with its arguments, then
+        reads and decodes its reply, with the same delays as sendCommandBytes()
+        and readReply(). The port's transactionLock is held from the write to
+        the reply, so devices sharing a pooled port do not interleave. """
+        if self.port is None:
+            self.initializeDevice()
+
+        with self.port.transactionLock:
+            self.sendCommandBytes(command.request(*arguments))
+            self.timingPolicy.sleep(self.timingPolicy.replyDelay)
+            return command.readResult(self.port).values
 
     def positionInMicrosteps(self) -> (int, int, int):  # for compatibility
         return self.doGetPosition()
 
     def doGetPosition(self) -> (int, int, int):
         """ Returns the position in microsteps """
-        commandBytes = pack('<cc', b'C', b'\r')
-        self.sendCommandBytes(commandBytes)
-        (x, y, z) = self.readReply(size=14, format='<xlllx')
+        (x, y, z) = self.sendCommand(self.commands["POSITION"])
 
         return (x, y, z)
 
     def doMoveTo(self, position):
         """ Move to a position in microsteps """
         x, y, z = position
-        commandBytes = pack('<clllc', b'M', int(x), int(y), int(z), b'\r')
-        self.sendCommandBytes(commandBytes)
-        reply = self.readReply(size=1, format='<c')
+        reply = self.sendCommand(self.commands["MOVE"], int(x), int(y), int(z))
 
         if reply != (b'\r',):
             raise Exception(f"Expected carriage return, but got '{reply}' instead.")
@@ -124,21 +142,19 @@ class SutterDevice(LinearMotionDevice):
             raise Exception("Unable to read position from device")
 
     def doHome(self):
-        commandBytes = pack('<cc', b'H', b'\r')
-        self.sendCommandBytes(commandBytes)
-        replyBytes = self.readReply(1, '<c')
+        command = self.commands["HOME"]
+        replyBytes = self.sendCommand(command)
         if replyBytes is None:
-            raise Exception(f"Nothing received in respnse to {commandBytes}")
+            raise Exception(f"Nothing received in respnse to {command.payload}")
         if replyBytes != (b'\r',):
             raise Exception(f"Expected carriage return, but got {replyBytes} instead.")     
         
     def work(self):
         self.home()
-        commandBytes = pack('<cc', b'Y', b'\r')
-        self.sendCommandBytes(commandBytes)
-        replyBytes = self.readReply(1, '<c')
+        command = self.commands["WORK"]
+        replyBytes = self.sendCommand(command)
         if replyBytes is None:
-            raise Exception(f"Nothing received in respnse to {commandBytes}")
+            raise Exception(f"Nothing received in respnse to {command.payload}")
         if replyBytes != (b'\r',):
             raise Exception(f"Expected carriage return, but got {replyBytes} instead.")
 
@@ -154,7 +170,7 @@ class SutterDevice(LinearMotionDevice):
             inputBytes = self.inputBuffers[endPointIndex]
 
             if inputBytes[0] == b'm'[0] or inputBytes[0] == b'M'[0]:
-                x,y,z = unpack("<xlllx", inputBytes)
+                x,y,z = compiledStruct("<xlllx").unpack(inputBytes)
                 self.xSteps = x
                 self.ySteps = y
                 self.zSteps = z
@@ -165,7 +181,7 @@ class SutterDevice(LinearMotionDevice):
                 self.zSteps = 0
                 self.writeToOutputBuffer(bytearray(b'\r'), endPointIndex)
             elif inputBytes[0] == b'c'[0] or inputBytes[0] == b'C'[0]:
-                data = pack('<clllc', b'c', self.xSteps, self.ySteps, self.zSteps, b'\r')
+                data = compiledStruct('<clllc').pack(b'c', self.xSteps, self.ySteps, self.zSteps, b'\r')
                 self.writeToOutputBuffer(data, endPointIndex)
             else:
                 print("Unrecognized command (not everything is implemented): {0}".format(inputBytes))
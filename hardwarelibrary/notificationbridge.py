@@ -0,0 +1,392 @@
+import os
+import tempfile
+import pickle
+from threading import Thread, RLock, Event
+from collections import OrderedDict
+from typing import NamedTuple
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # Python 3.7: arrays are pickled
+    shared_memory = None
+
+from hardwarelibrary.notificationcenter import NotificationCenter, OverflowPolicy
+
+class RemoteObject:
+    """ Stands in, in another process, for the object that posted a
+    notification. The same RemoteObject is used for all the notifications
+    of an object (same identifier and className), so it can be observed
+    like a local object. Its description (str() of the object) is updated
+    in place when it changes. """
+    __slots__ = ('identifier', 'className', 'description')
+
+    def __init__(self, identifier, className, description=None):
+        self.identifier = identifier
+        self.className = className
+        self.description = description
+
+    @property
+    def key(self) -> tuple:
+        return (self.identifier, self.className)
+
+    def __eq__(self, rhs):
+        return isinstance(rhs, RemoteObject) and self.key == rhs.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "RemoteObject(identifier={0!r}, className={1!r}, description={2!r})".format(self.identifier, self.className, self.description)
+
+class SharedArray(NamedTuple):
+    """ A NumPy array sent through shared memory instead of being pickled """
+    name: str
+    shape: tuple
+    dtype: str
+    processId: int
+
+class NotificationBridge:
+    """
+    Forwards notifications of the local NotificationCenter to other
+    processes (e.g. visualization or analysis, so that they do not compete
+    with device I/O for the GIL), over a Unix socket:
+
+        bridge = NotificationBridge(notificationNames=[PhysicalDeviceNotification.status])
+        bridge.start()
+        ... give bridge.address and bridge.authkey to the other processes (RemoteNotificationCenter) ...
+        bridge.stop()
+
+    Clients must present authkey (random by default), since they receive
+    pickles from the bridge and the bridge from them.
+
+    Only the names in notificationNames are forwarded, and only to the
+    processes that observe them. The bridge observes them asynchronously
+    (OverflowPolicy.dropOldest), so a slow client never stalls a device.
+
+    The userInfo is pickled, except NumPy arrays of at least
+    sharedMemoryThreshold bytes (alone or in a dict, list or tuple):
+    they are copied once into shared memory, and the block is unlinked
+    when every client has copied it out. The object that posted is
+    represented by a RemoteObject.
+    """
+    sharedMemoryThreshold = 65536
+
+    def __init__(self, notificationNames, address=None, authkey=None, queueSize=1000):
+        if address is None:
+            address = os.path.join(tempfile.mkdtemp(), "notifications")
+        if authkey is None:
+            authkey = os.urandom(32)
+        self.address = address
+        self.authkey = authkey
+        self.notificationNames = list(notificationNames)
+        self.queueSize = queueSize
+        self.listener = None
+        self.listeningThread = None
+        self.clients = []
+        self.lock = RLock()
+        self.sharedBlocks = {}      # name -> [SharedMemory, number of clients that have not released it]
+        self.sentCount = 0
+        self.sharedBytes = 0
+
+    @property
+    def isRunning(self):
+        return self.listener is not None
+
+    def start(self):
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        self.listeningThread = Thread(target=self.acceptClients, name="NotificationBridge-listener", daemon=True)
+        self.listeningThread.start()
+        for notificationName in self.notificationNames:
+            NotificationCenter().addObserver(self, self.forwardNotification, notificationName,
+                                             asynchronous=True, overflowPolicy=OverflowPolicy.dropOldest, queueSize=self.queueSize)
+
+    def stop(self):
+        NotificationCenter().removeObserver(self)
+        with self.lock:
+            listener = self.listener
+            self.listener = None
+            clients = list(self.clients)
+            self.clients = []
+
+        if listener is not None:
+            # accept() is not interrupted by close(): wake it with a connection
+            try:
+                Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+            except Exception:
+                pass
+            listener.close()
+            self.listeningThread.join()
+
+        for client in clients:
+            client.close()
+
+        with self.lock:
+            for sharedMemory, count in self.sharedBlocks.values():
+                sharedMemory.close()
+                sharedMemory.unlink()
+            self.sharedBlocks = {}
+
+    def acceptClients(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                continue # Wrong authkey: refused
+            except Exception:
+                return
+
+            with self.lock:
+                if self.listener is None:
+                    connection.close()
+                    return
+                client = BridgeClient(connection)
+                self.clients.append(client)
+            Thread(target=self.readFromClient, args=(client,), name="NotificationBridge-client", daemon=True).start()
+
+    def readFromClient(self, client):
+        """ Subscriptions, and shared memory blocks that were copied """
+        while True:
+            try:
+                message = client.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            command, argument = message
+            if command == 'subscribe':
+                client.notificationNames.add(argument)
+            elif command == 'unsubscribe':
+                client.notificationNames.discard(argument)
+            elif command == 'release':
+                self.releaseSharedBlock(argument)
+            elif command == 'ping':
+                client.send(('pong', argument))
+
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def releaseSharedBlock(self, name):
+        with self.lock:
+            entry = self.sharedBlocks.get(name)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.sharedBlocks[name]
+                entry[0].close()
+                entry[0].unlink()
+
+    def forwardNotification(self, notification):
+        if isinstance(notification.object, RemoteObject):
+            return # Received from another process: never relayed
+
+        with self.lock:
+            recipients = [ client for client in self.clients if notification.name in client.notificationNames ]
+        if len(recipients) == 0:
+            return
+
+        sharedNames = []
+        userInfo = self.encode(notification.userInfo, sharedNames)
+        notifyingObject = notification.object
+        remoteObject = None
+        if notifyingObject is not None:
+            remoteObject = RemoteObject(id(notifyingObject), type(notifyingObject).__name__, str(notifyingObject))
+
+        try:
+            message = pickle.dumps(('notification', notification.name, remoteObject, userInfo), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # The repr does not refer to the shared blocks: nobody will release them
+            for name in sharedNames:
+                self.releaseSharedBlock(name)
+            sharedNames = []
+            message = pickle.dumps(('notification', notification.name, remoteObject, repr(notification.userInfo)), protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            for name in sharedNames:
+                self.sharedBlocks[name][1] = len(recipients)
+
+        for client in recipients:
+            if not client.sendBytes(message):
+                # Disconnected: it will never release its blocks
+                for name in sharedNames:
+                    self.releaseSharedBlock(name)
+        self.sentCount += 1
+
+    def encode(self, value, sharedNames):
+        """ value with the large arrays replaced by SharedArray """
+        if isinstance(value, np.ndarray):
+            if shared_memory is None or value.nbytes < self.sharedMemoryThreshold or value.dtype.hasobject:
+                return value
+            array = np.ascontiguousarray(value)
+            sharedMemory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=sharedMemory.buf)[...] = array
+            with self.lock:
+                self.sharedBlocks[sharedMemory.name] = [sharedMemory, 0]
+            sharedNames.append(sharedMemory.name)
+            self.sharedBytes += array.nbytes
+            return SharedArray(sharedMemory.name, array.shape, array.dtype.str, os.getpid())
+        elif isinstance(value, dict):
+            return { key: self.encode(item, sharedNames) for key, item in value.items() }
+        elif isinstance(value, list):
+            return [ self.encode(item, sharedNames) for item in value ]
+        elif isinstance(value, tuple) and not isinstance(value, SharedArray):
+            items = [ self.encode(item, sharedNames) for item in value ]
+            if hasattr(value, '_make'):
+                return value._make(items)
+            return tuple(items)
+        return value
+
+
+class BridgeClient:
+    """ A connected process, on the bridge side """
+    def __init__(self, connection):
+        self.connection = connection
+        self.notificationNames = set()
+        self.sendLock = RLock()
+
+    def send(self, message) -> bool:
+        return self.sendBytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def sendBytes(self, data) -> bool:
+        with self.sendLock:
+            try:
+                self.connection.send_bytes(data)
+                return True
+            except (OSError, EOFError, ValueError):
+                return False
+
+    def close(self):
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+
+class RemoteNotificationCenter:
+    """
+    The other end of a NotificationBridge, in another process. Observers
+    are added and removed as with the NotificationCenter: the bridge is
+    asked to forward the notification names that are observed, and the
+    notifications it sends are posted to the NotificationCenter of this
+    process by a receiving thread, with a RemoteObject as the object.
+
+        center = RemoteNotificationCenter(address, authkey)
+        center.addObserver(self, self.showSpectrum, SpectrometerNotification.didAcquire)
+
+    The same RemoteObject is posted for all the notifications of an object.
+    Those of the last maximumRemoteObjects objects are kept, and those
+    given as observedObject to addObserver() until close().
+    """
+    maximumRemoteObjects = 1000
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self.sendLock = RLock()
+        self.remoteObjects = OrderedDict()  # (identifier, className) -> RemoteObject, least recently used first
+        self.observedRemoteObjects = {}     # (identifier, className) -> RemoteObject, never evicted
+        self.subscriptions = {}     # notificationName -> id of the observers
+        self.receivedCount = 0
+        self.pongReceived = Event()
+        self.receivingThread = Thread(target=self.receiveNotifications, name="RemoteNotificationCenter", daemon=True)
+        self.receivingThread.start()
+
+    def send(self, message):
+        with self.sendLock:
+            self.connection.send(message)
+
+    def addObserver(self, observer, method, notificationName, observedObject=None, **options):
+        """ Same as NotificationCenter.addObserver(), for a notification
+        forwarded by the bridge. observedObject is a RemoteObject. """
+        if observedObject is not None:
+            with self.sendLock:
+                observedObject = self.observedRemoteObjects.setdefault(observedObject.key, self.remoteObjects.get(observedObject.key, observedObject))
+        NotificationCenter().addObserver(observer, method, notificationName, observedObject, **options)
+        with self.sendLock:
+            observers = self.subscriptions.setdefault(notificationName, set())
+            if len(observers) == 0:
+                self.send(('subscribe', notificationName))
+            observers.add(id(observer))
+
+    def removeObserver(self, observer, notificationName=None, observedObject=None):
+        NotificationCenter().removeObserver(observer, notificationName, observedObject)
+        with self.sendLock:
+            for name, observers in list(self.subscriptions.items()):
+                if notificationName is not None and name != notificationName:
+                    continue
+                observers.discard(id(observer))
+                if len(observers) == 0:
+                    del self.subscriptions[name]
+                    self.send(('unsubscribe', name))
+
+    def synchronize(self, timeout=5) -> bool:
+        """ Waits until the bridge has processed the previous requests
+        (e.g. subscriptions) """
+        self.pongReceived.clear()
+        self.send(('ping', None))
+        return self.pongReceived.wait(timeout)
+
+    def remoteObject(self, description) -> RemoteObject:
+        """ The RemoteObject already used for this object, with its
+        description updated. An identifier is an id() in the other process:
+        it can be reused by an object of another class. """
+        if description is None:
+            return None
+        key = description.key
+        with self.sendLock:
+            remoteObject = self.observedRemoteObjects.get(key) or self.remoteObjects.get(key)
+            if remoteObject is None:
+                remoteObject = description
+            else:
+                remoteObject.description = description.description
+            self.remoteObjects[key] = remoteObject
+            self.remoteObjects.move_to_end(key)
+            while len(self.remoteObjects) > self.maximumRemoteObjects:
+                self.remoteObjects.popitem(last=False)
+        return remoteObject
+
+    def decode(self, value):
+        if isinstance(value, SharedArray):
+            sharedMemory = shared_memory.SharedMemory(name=value.name)
+            try:
+                if value.processId != os.getpid():
+                    # The bridge owns the block: this process must not unlink it at exit
+                    resource_tracker.unregister(sharedMemory._name, 'shared_memory')
+                array = np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=sharedMemory.buf).copy()
+            finally:
+                sharedMemory.close()
+                self.send(('release', value.name))
+            return array
+        elif isinstance(value, dict):
+            return { key: self.decode(item) for key, item in value.items() }
+        elif isinstance(value, list):
+            return [ self.decode(item) for item in value ]
+        elif isinstance(value, tuple):
+            items = [ self.decode(item) for item in value ]
+            if hasattr(value, '_make'):
+                return value._make(items)
+            return tuple(items)
+        return value
+
+    def receiveNotifications(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                return
+
+            if message[0] == 'notification':
+                command, notificationName, description, userInfo = message
+                userInfo = self.decode(userInfo)
+                self.receivedCount += 1
+                NotificationCenter().postNotification(notificationName, self.remoteObject(description), userInfo)
+            elif message[0] == 'pong':
+                self.pongReceived.set()
+
+    def close(self):
+        self.connection.close()
+        self.receivingThread.join(1)
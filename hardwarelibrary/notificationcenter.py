@@ -1,4 +1,10 @@
-from threading import Thread, RLock
+from threading import Thread, RLock, Condition, current_thread
+from collections import deque
+import heapq
+import itertools
+import functools
+import time
+import weakref
 from enum import Enum
 
 # You must define notification names like this:
@@ -8,6 +14,8 @@ from enum import Enum
 #    didGetPosition = "didGetPosition"
 
 class Notification:
+    __slots__ = ('name', 'object', 'userInfo')
+
     def __init__(self, name, object=None, userInfo=None):
         if not isinstance(name, Enum):
             raise ValueError("You must use an enum-subclass of Enum, not a string for the notification name")
@@ -16,12 +24,195 @@ class Notification:
         self.object = object
         self.userInfo = userInfo
 
+class OverflowPolicy(Enum):
+    block        = "block"          # the poster waits until the observer has room
+    dropOldest   = "dropOldest"     # the oldest pending notification is discarded
+    coalesce     = "coalesce"       # only the latest notification per (name, object) is kept
+
+class AsynchronousDelivery:
+    """
+    The pending notifications of an asynchronous observer: a bounded
+    mailbox filled by postNotification() and emptied by the delivery
+    thread of the NotificationCenter. What happens when it is full is set
+    by overflowPolicy. With OverflowPolicy.coalesce, pending notifications
+    are kept per (name, object) so the mailbox never holds more than one
+    notification for each.
+
+    With a minimumInterval (1/maxRate), the pending notifications are
+    delivered in batches, at most one batch per interval: a coalescing
+    observer therefore receives the latest notification of each (name,
+    object) at most maxRate times per second.
+
+    Pending notifications are kept as (name, object, userInfo) and the
+    Notification is only created when it is delivered, so the ones that
+    are replaced or dropped cost no allocation.
+    """
+    def __init__(self, overflowPolicy=OverflowPolicy.block, queueSize=1000, loop=None, minimumInterval=None):
+        self.overflowPolicy = overflowPolicy
+        self.queueSize = queueSize
+        self.loop = loop
+        self.minimumInterval = minimumInterval
+        self.nextDeliveryTime = 0
+        if overflowPolicy == OverflowPolicy.coalesce:
+            self.pending = {}
+        else:
+            self.pending = deque()
+        self.batch = deque()    # being delivered, taken from pending
+        self.isScheduled = False
+        self.isCancelled = False
+        self.delivered = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self.pending) + len(self.batch)
+
+    @property
+    def isFull(self):
+        return self.depth >= self.queueSize
+
+    def put(self, name, notifyingObject, userInfo):
+        """ Called with the delivery lock held, once there is room if the policy is block """
+        if self.overflowPolicy == OverflowPolicy.coalesce:
+            key = (name, id(notifyingObject))
+            if key in self.pending:
+                self.dropped += 1
+            elif self.isFull:
+                self.dropOldest()
+            self.pending[key] = (name, notifyingObject, userInfo)
+        else:
+            if self.isFull:
+                self.dropOldest()
+            self.pending.append((name, notifyingObject, userInfo))
+
+    def dropOldest(self):
+        if len(self.batch) > 0:
+            self.batch.popleft()
+        elif self.overflowPolicy == OverflowPolicy.coalesce:
+            del self.pending[next(iter(self.pending))]
+        else:
+            self.pending.popleft()
+        self.dropped += 1
+
+    def isDue(self, now) -> bool:
+        if len(self.batch) > 0 or self.minimumInterval is None:
+            return True
+        return now >= self.nextDeliveryTime
+
+    def get(self, now) -> Notification:
+        if len(self.batch) == 0:
+            if self.overflowPolicy == OverflowPolicy.coalesce:
+                self.batch = deque(self.pending.values())
+                self.pending = {}
+            else:
+                self.batch, self.pending = self.pending, deque()
+            if self.minimumInterval is not None:
+                self.nextDeliveryTime = now + self.minimumInterval
+
+        name, notifyingObject, userInfo = self.batch.popleft()
+        return Notification(name, notifyingObject, userInfo)
+
+    def cancel(self):
+        self.isCancelled = True
+        self.pending.clear()
+        self.batch.clear()
+
+class StrongReference:
+    """ Same interface as a weakref.ref, for objects that cannot be weakly referenced """
+    __slots__ = ('object',)
+
+    def __init__(self, object):
+        self.object = object
+
+    def __call__(self):
+        return self.object
+
+def referenceTo(object, callback=None):
+    """ A weak reference to object if possible, otherwise a StrongReference """
+    if object is None:
+        return StrongReference(None)
+    try:
+        return weakref.ref(object, callback)
+    except TypeError:
+        return StrongReference(object)
+
+def refersTo(method, observer) -> bool:
+    """ True if method is bound to observer, closes over it (directly in
+    one of its cells) or is a functools.partial with observer as an argument """
+    if getattr(method, '__self__', None) is observer:
+        return True
+    if isinstance(method, functools.partial):
+        arguments = list(method.args) + list(method.keywords.values())
+        return refersTo(method.func, observer) or any([ argument is observer for argument in arguments ])
+
+    function = getattr(method, '__func__', method)
+    for cell in getattr(function, '__closure__', None) or ():
+        try:
+            if cell.cell_contents is observer:
+                return True
+        except ValueError:
+            pass # empty cell
+    return False
+
 class ObserverInfo:
-    def __init__(self, observer, method=None, notificationName=None, observedObject=None):
-        self.observer = observer
-        self.method = method
-        self.observedObject = observedObject
+    """
+    An observer registered with the NotificationCenter. The observer and
+    the observed object are weakly referenced, so that the NotificationCenter
+    never keeps them alive: when they are deleted, the NotificationCenter
+    forgets them (see NotificationCenter.purgeDeadReferences).
+
+    method is weakly referenced when it is a method of the observer (the
+    usual self.handle). A callable that refers to the observer (e.g.
+    lambda n: self.handle(n), see refersTo) would keep it alive: it is
+    kept by the observer itself (in observer.__dict__) and weakly referenced
+    here. Other callables (functions, lambdas, methods of other objects)
+    are kept, as are all callables when the observer has no __dict__ or
+    cannot be weakly referenced: they can then keep the observer alive
+    until removeObserver().
+    """
+    __slots__ = ('observerReference', 'methodReference', 'observedObjectReference', 'notificationName', 'delivery')
+
+    keptMethodsAttribute = '_notificationCenterMethods'
+
+    def __init__(self, observer, method=None, notificationName=None, observedObject=None, delivery=None, observerDied=None, observedObjectDied=None):
+        self.observerReference = referenceTo(observer, observerDied)
+        self.methodReference = StrongReference(method)
+        if observer is not None and isinstance(self.observerReference, weakref.ref):
+            if getattr(method, '__self__', None) is observer:
+                self.methodReference = weakref.WeakMethod(method)
+            elif refersTo(method, observer):
+                try:
+                    observer.__dict__.setdefault(self.keptMethodsAttribute, []).append(method)
+                    self.methodReference = weakref.ref(method)
+                except (AttributeError, TypeError):
+                    pass # No __dict__ (or read-only) or no weak reference to method: kept here
+        self.observedObjectReference = referenceTo(observedObject, observedObjectDied)
         self.notificationName = notificationName
+        self.delivery = delivery  # None for synchronous observers, or an AsynchronousDelivery
+
+    @property
+    def observer(self):
+        return self.observerReference()
+
+    @property
+    def method(self):
+        return self.methodReference()
+
+    @property
+    def observedObject(self):
+        return self.observedObjectReference()
+
+    def releaseMethod(self):
+        """ Removes method from the observer if it was kept there """
+        observer = self.observer
+        method = self.method
+        if observer is None or method is None or isinstance(self.methodReference, (StrongReference, weakref.WeakMethod)):
+            return
+        keptMethods = getattr(observer, '__dict__', {}).get(self.keptMethodsAttribute, [])
+        for index, keptMethod in enumerate(keptMethods):
+            if keptMethod is method:
+                del keptMethods[index]
+                break
 
     def matches(self, otherObserver) -> bool:
         if self.notificationName is not None and otherObserver.notificationName is not None and self.notificationName != otherObserver.notificationName:
@@ -36,68 +227,357 @@ class ObserverInfo:
         return self.matches(rhs)
 
 class NotificationCenter:
+    """
+    Observers are indexed by notification name, then by the identity of the
+    observed object (None for observers of any object), then by the
+    identity of the observer:
+
+        observers[notificationName][id(observedObject) or None][id(observer)] = ObserverInfo
+
+    A post only looks at the two buckets that can match (the object's and
+    the wildcard), and adding or removing an observer only touches the
+    buckets it is registered in (see observerKeys), instead of scanning
+    every observer.
+
+    Observers and observed objects are weakly referenced: removeObserver()
+    is not required, an observer that is deleted is removed automatically.
+    The weakref callbacks only record what died (they can run at any time,
+    in any thread) and the index is cleaned at the next add, remove or post.
+
+    Observers are called synchronously by postNotification(), unless they
+    were added with asynchronous=True: their notifications are then queued
+    (see AsynchronousDelivery and OverflowPolicy) and delivered by a single
+    delivery thread, or on an asyncio loop (loop=...) so a slow observer
+    does not stall the device thread that posts. Observers that only need
+    the latest value (e.g. a display) use coalesce=True and/or maxRate.
+    """
     _instance = None
+    defaultQueueSize = 1000
 
     def destroy(self):
         nc = NotificationCenter()
+        nc.stopDeliveryThread()
         NotificationCenter._instance = None
         del(nc)
 
     def __init__(self):
         if not hasattr(self, 'observers'):
             self.observers = {}
+        if not hasattr(self, 'observerKeys'):
+            self.observerKeys = {}  # id(observer) -> set of (notificationName, objectKey) it is registered for
         if not hasattr(self, 'lock'):
             self.lock = RLock()
+        if not hasattr(self, 'deadReferences'):
+            self.deadReferences = deque()   # ('observer', id) or ('object', id), appended by weakref callbacks
+        if not hasattr(self, 'deliveryCondition'):
+            self.deliveryCondition = Condition()
+            self.scheduledDeliveries = deque()  # ObserverInfo with pending notifications, in order
+            self.waitingDeliveries = []         # heap of (time, order, ObserverInfo) waiting for their next interval
+            self.waitingOrder = itertools.count()
+            self.deliveryThread = None
+            self.deliveriesInProgress = 0
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = object.__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def addObserver(self, observer, method, notificationName=None, observedObject=None):
+    @staticmethod
+    def objectKey(observedObject):
+        if observedObject is None:
+            return None
+        return id(observedObject)
+
+    def addObserver(self, observer, method, notificationName=None, observedObject=None,
+                    asynchronous=False, overflowPolicy=OverflowPolicy.block, queueSize=None, loop=None,
+                    coalesce=False, maxRate=None):
+        """ Calls method(notification) when notificationName is posted by
+        observedObject (or by any object if None). With asynchronous=True (or
+        an asyncio loop), the observer gets its own queue of queueSize
+        notifications, handled with overflowPolicy when full.
+
+        coalesce=True delivers (asynchronously) only the latest notification
+        of each (name, object), and maxRate (in Hz, implies coalesce) at
+        most maxRate times per second: stale notifications are skipped. """
         if notificationName is not None and not isinstance(notificationName, Enum):
             raise ValueError("You must use an enum-subclass of Enum, not a string for the notificationName")
 
-        observerInfo = ObserverInfo(observer=observer, method=method, notificationName=notificationName, observedObject=observedObject)
+        minimumInterval = None
+        if maxRate is not None:
+            if maxRate <= 0:
+                raise ValueError("maxRate must be positive")
+            minimumInterval = 1.0/maxRate
+            coalesce = True
+
+        if coalesce:
+            asynchronous = True
+            overflowPolicy = OverflowPolicy.coalesce
+
+        delivery = None
+        if asynchronous or loop is not None:
+            if queueSize is None:
+                queueSize = self.defaultQueueSize
+            delivery = AsynchronousDelivery(overflowPolicy, queueSize, loop, minimumInterval)
+
+        objectKey = self.objectKey(observedObject)
 
         with self.lock:
-            if notificationName not in self.observers.keys():
-                self.observers[notificationName] = [observerInfo]
+            if self.deadReferences:
+                self.purgeDeadReferences()
+
+            keys = self.observerKeys.get(id(observer))
+            if keys is not None:
+                # An observer of any object is a duplicate of an observer of a
+                # specific object for the same name (and vice-versa)
+                if objectKey is None:
+                    if any( name == notificationName for name, key in keys ):
+                        return
+                elif (notificationName, objectKey) in keys or (notificationName, None) in keys:
+                    return
             else:
-                if observerInfo not in self.observers[notificationName]:
-                    self.observers[notificationName].append(observerInfo)
+                keys = set()
+                self.observerKeys[id(observer)] = keys
+
+            observerInfo = ObserverInfo(observer=observer, method=method, notificationName=notificationName, observedObject=observedObject, delivery=delivery,
+                                        observerDied=self.observerDied(id(observer)), observedObjectDied=self.observedObjectDied(objectKey))
+            buckets = self.observers.setdefault(notificationName, {})
+            buckets.setdefault(objectKey, {})[id(observer)] = observerInfo
+            keys.add((notificationName, objectKey))
 
     def removeObserver(self, observer, notificationName=None, observedObject=None):
         if notificationName is not None and not isinstance(notificationName, Enum):
             raise ValueError("You must use an enum-subclass of Enum, not a string for the notificationName")
 
-        observerToRemove = ObserverInfo(observer=observer, notificationName=notificationName, observedObject=observedObject)
+        objectKey = self.objectKey(observedObject)
 
         with self.lock:
-            if notificationName is not None:
-                self.observers[notificationName] = [currentObserver for currentObserver in self.observers[notificationName] if not currentObserver.matches(observerToRemove) ]
+            if self.deadReferences:
+                self.purgeDeadReferences()
+
+            keys = self.observerKeys.get(id(observer))
+            if keys is None:
+                return
+
+            for name, key in list(keys):
+                if notificationName is not None and name != notificationName:
+                    continue
+                if objectKey is not None and key is not None and key != objectKey:
+                    continue
+                self.removeObserverInfo(id(observer), name, key)
+
+    def removeObserverInfo(self, observerId, name, key):
+        """ Removes an entry of the index, with the lock held """
+        buckets = self.observers[name]
+        bucket = buckets[key]
+        observerInfo = bucket.pop(observerId)
+        observerInfo.releaseMethod()
+        if len(bucket) == 0:
+            del buckets[key]
+        if observerInfo.delivery is not None:
+            with self.deliveryCondition:
+                observerInfo.delivery.cancel()
+                self.deliveryCondition.notify_all()
+
+        keys = self.observerKeys[observerId]
+        keys.remove((name, key))
+        if len(keys) == 0:
+            del self.observerKeys[observerId]
+
+    def observerDied(self, observerId):
+        deadReferences = self.deadReferences
+        return lambda reference: deadReferences.append(('observer', observerId))
+
+    def observedObjectDied(self, objectKey):
+        deadReferences = self.deadReferences
+        return lambda reference: deadReferences.append(('object', objectKey))
+
+    def purgeDeadReferences(self):
+        """ Removes the observers and the observations of objects that were
+        deleted, with the lock held. An id can only be reused once the object
+        is deleted, and this is called before the index is used. """
+        while self.deadReferences:
+            kind, identifier = self.deadReferences.popleft()
+            if kind == 'observer':
+                for name, key in list(self.observerKeys.get(identifier, ())):
+                    self.removeObserverInfo(identifier, name, key)
             else:
-                for name in self.observers.keys():
-                    self.observers[name] = [observer for observer in self.observers[name] if not observer.matches(observerToRemove) ]        
+                for name, buckets in list(self.observers.items()):
+                    bucket = buckets.get(identifier)
+                    if bucket is not None:
+                        for observerId in list(bucket.keys()):
+                            self.removeObserverInfo(observerId, name, identifier)
+
+    def matchingObservers(self, notificationName, notifyingObject) -> tuple:
+        """ The ObserverInfo that receive notificationName posted by notifyingObject """
+        with self.lock:
+            if self.deadReferences:
+                self.purgeDeadReferences()
+
+            buckets = self.observers.get(notificationName)
+            if buckets is None:
+                return ()
+
+            anyObject = buckets.get(None)
+            if notifyingObject is not None:
+                specificObject = buckets.get(id(notifyingObject))
+                if specificObject is not None:
+                    if anyObject is not None:
+                        return tuple(specificObject.values()) + tuple(anyObject.values())
+                    return tuple(specificObject.values())
+
+            if anyObject is not None:
+                return tuple(anyObject.values())
+            return ()
 
     def postNotification(self, notificationName, notifyingObject, userInfo=None):
         if not isinstance(notificationName, Enum):
             raise ValueError("You must use an enum-subclass of Enum, not a string for the notificationName")
 
+        # Observers are called outside the lock: they can add or remove
+        # observers, and slow observers do not block other threads.
+        notification = None
+        for observerInfo in self.matchingObservers(notificationName, notifyingObject):
+            if observerInfo.delivery is None:
+                method = observerInfo.method
+                if method is None:
+                    continue # deleted during this post
+                if notification is None:
+                    notification = Notification(notificationName, notifyingObject, userInfo)
+                method(notification)
+            else:
+                self.enqueueNotification(observerInfo, notificationName, notifyingObject, userInfo)
+
+    def enqueueNotification(self, observerInfo, notificationName, notifyingObject, userInfo):
+        delivery = observerInfo.delivery
+        with self.deliveryCondition:
+            if delivery.overflowPolicy == OverflowPolicy.block and current_thread() is not self.deliveryThread:
+                # The delivery thread never waits for itself (an observer that posts)
+                self.deliveryCondition.wait_for(lambda: not delivery.isFull or delivery.isCancelled)
+
+            if delivery.isCancelled:
+                return
+
+            delivery.put(notificationName, notifyingObject, userInfo)
+            if not delivery.isScheduled:
+                # Otherwise, the delivery thread already knows about it
+                delivery.isScheduled = True
+                self.scheduledDeliveries.append(observerInfo)
+                self.startDeliveryThread()
+                self.deliveryCondition.notify_all()
+
+    def startDeliveryThread(self):
+        if self.deliveryThread is None:
+            self.deliveryThread = Thread(target=self.deliveryLoop, name="NotificationCenter-delivery", daemon=True)
+            self.deliveryThread.start()
+
+    def deliveryLoop(self):
+        """ Delivers one notification at a time, taking observers in turn
+        so that a busy observer does not delay the others. """
+        while True:
+            with self.deliveryCondition:
+                while True:
+                    if self.deliveryThread is not current_thread():
+                        return
+
+                    now = time.monotonic()
+                    while len(self.waitingDeliveries) > 0 and self.waitingDeliveries[0][0] <= now:
+                        self.scheduledDeliveries.append(heapq.heappop(self.waitingDeliveries)[2])
+
+                    if len(self.scheduledDeliveries) > 0:
+                        break
+
+                    timeout = None
+                    if len(self.waitingDeliveries) > 0:
+                        timeout = self.waitingDeliveries[0][0] - now
+                    self.deliveryCondition.wait(timeout)
+
+                observerInfo = self.scheduledDeliveries.popleft()
+                delivery = observerInfo.delivery
+                if delivery.isCancelled or delivery.depth == 0:
+                    delivery.isScheduled = False
+                    continue
+
+                if not delivery.isDue(now):
+                    heapq.heappush(self.waitingDeliveries, (delivery.nextDeliveryTime, next(self.waitingOrder), observerInfo))
+                    continue
+
+                notification = delivery.get(now)
+                if delivery.depth > 0:
+                    self.scheduledDeliveries.append(observerInfo)
+                else:
+                    delivery.isScheduled = False
+                self.deliveriesInProgress += 1
+                self.deliveryCondition.notify_all()
+
+            try:
+                method = observerInfo.method
+                if method is None:
+                    pass # deleted since the notification was queued
+                elif delivery.loop is not None:
+                    delivery.loop.call_soon_threadsafe(method, notification)
+                else:
+                    method(notification)
+            except Exception as err:
+                print("Exception in asynchronous observer {0}: {1}".format(observerInfo.observer, err))
+            finally:
+                method = None # A closure could keep its observer alive until the next delivery
+                with self.deliveryCondition:
+                    delivery.delivered += 1
+                    self.deliveriesInProgress -= 1
+                    self.deliveryCondition.notify_all()
+
+    def waitUntilDelivered(self, timeout=None) -> bool:
+        """ Waits until all queued notifications have been delivered.
+        Returns False if timeout expired first. """
+        with self.deliveryCondition:
+            return self.deliveryCondition.wait_for(lambda: len(self.scheduledDeliveries) == 0 and len(self.waitingDeliveries) == 0 and self.deliveriesInProgress == 0, timeout=timeout)
+
+    def stopDeliveryThread(self):
+        with self.deliveryCondition:
+            thread = self.deliveryThread
+            self.deliveryThread = None
+            for observerInfo in list(self.scheduledDeliveries) + [ waiting[2] for waiting in self.waitingDeliveries ]:
+                observerInfo.delivery.isScheduled = False
+            self.scheduledDeliveries.clear()
+            self.waitingDeliveries = []
+            self.deliveryCondition.notify_all()
+
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    def deliveryStatistics(self) -> dict:
+        """ Queue depth, notifications delivered and dropped (or replaced by
+        a newer one when coalescing) for all asynchronous observers. """
+        statistics = {"observers": 0, "depth": 0, "delivered": 0, "dropped": 0}
         with self.lock:
-            if notificationName in self.observers.keys():
-                notification = Notification(notificationName, notifyingObject, userInfo)
-                for observerInfo in self.observers[notificationName]:
-                    if observerInfo.observedObject is None or observerInfo.observedObject == notifyingObject:
-                        observerInfo.method(notification)
+            observerInfos = [ observerInfo for buckets in self.observers.values() for bucket in buckets.values() for observerInfo in bucket.values() ]
+
+        with self.deliveryCondition:
+            for observerInfo in observerInfos:
+                if observerInfo.delivery is not None:
+                    statistics["observers"] += 1
+                    statistics["depth"] += observerInfo.delivery.depth
+                    statistics["delivered"] += observerInfo.delivery.delivered
+                    statistics["dropped"] += observerInfo.delivery.dropped
+        return statistics
 
     def observersCount(self):
         with self.lock:
-            count = 0
-            for name in self.observers.keys():
-                count += len(self.observers[name])
-            return count
+            if self.deadReferences:
+                self.purgeDeadReferences()
+            return sum([ len(keys) for keys in self.observerKeys.values() ])
 
     def clear(self):
         with self.lock:
+            for buckets in self.observers.values():
+                for bucket in buckets.values():
+                    for observerInfo in bucket.values():
+                        observerInfo.releaseMethod()
+                        if observerInfo.delivery is not None:
+                            with self.deliveryCondition:
+                                observerInfo.delivery.cancel()
             self.observers = {}
+            self.observerKeys = {}
+            self.deadReferences.clear()
+
+        self.stopDeliveryThread()
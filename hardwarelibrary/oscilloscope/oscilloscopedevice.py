@@ -2,6 +2,7 @@ import time
 from enum import Enum
 import struct
 from hardwarelibrary.communication.serialport import SerialPort
+from hardwarelibrary.communication.serialportpool import SerialPortPool
 from hardwarelibrary.physicaldevice import *
 from hardwarelibrary.notificationcenter import NotificationCenter, Notification
 import matplotlib.pyplot as plt
@@ -30,7 +31,7 @@ class OscilloscopeDevice(PhysicalDevice):
     def __init__(self, serialNumber:str = None, idProduct = 0x6001, idVendor = 0x0403):
         super().__init__(serialNumber, idProduct=self.classIdProduct, idVendor=self.classIdVendor)
 
-        self.port = SerialPort(idVendor=self.classIdVendor, idProduct=self.classIdProduct)
+        self.port = None
         self.delay = None
 
     def displayWaveforms(self, channels=None):
@@ -69,14 +70,20 @@ class OscilloscopeDevice(PhysicalDevice):
         return [(xZero + xIncr*(i-ptOffset), yZero + (value-yOffset)*yMul ) for i,value in enumerate(values) ]
 
     def doInitializeDevice(self):
-        if self.port is not None:
-            self.port.open(baudRate=9600, timeout=5.0, rtscts=True)
+        self.port = SerialPortPool().acquire(idVendor=self.classIdVendor, idProduct=self.classIdProduct,
+                                             baudRate=9600, timeout=5.0, rtscts=True)
+        try:
             self.doGetTektronikStatus()
+        except Exception as err:
+            SerialPortPool().release(self.port)
+            self.port = None
+            raise err
             # self.model = self.doSendQuery("ID?\n", "ID (TEK.*?),.+")
 
     def doShutdownDevice(self):
         if self.port is not None:
-            self.port.close()
+            SerialPortPool().release(self.port)
+            self.port = None
 
     def wait(self):
         if self.delay is not None:
@@ -3,6 +3,7 @@ from threading import Thread, RLock
 
 import hardwarelibrary.utils
 from hardwarelibrary.notificationcenter import NotificationCenter
+from hardwarelibrary.pollingscheduler import PollingScheduler, PollingTask
 import typing
 import time
 import re
@@ -58,10 +59,20 @@ class PhysicalDevice:
         self.port = None
 
         self.lock = RLock()
-        self.quitMonitoring = False
         self.monitoring = None
         self.refreshInterval = 1.0
 
+        # With adaptiveRefresh, the interval in use (currentRefreshInterval,
+        # refreshInterval at start) is divided by refreshFactor (down to
+        # minimumRefreshInterval) when the status changes, multiplied by it
+        # (up to maximumRefreshInterval) when it does not.
+        self.currentRefreshInterval = None
+        self.adaptiveRefresh = False
+        self.minimumRefreshInterval = 0.1
+        self.maximumRefreshInterval = 5.0
+        self.refreshFactor = 2.0
+        self.lastStatusUserInfo = None
+
     @classmethod
     def vidpids(cls):
         return [(cls.classIdVendor, cls.classIdProduct)]
@@ -141,25 +152,53 @@ class PhysicalDevice:
         raise NotImplementedError("Base class must override doShutdownDevice()")
 
     def startBackgroundStatusUpdates(self):
+        """ Posts PhysicalDeviceNotification.status now, then every
+        refreshInterval, from the threads of the PollingScheduler """
         with self.lock:
             if not self.isMonitoring:
-                self.quitMonitoring = False
-                self.monitoring = Thread(target=self.backgroundStatusUpdates, name="Physical-Device-backgroundStatusUpdates")
-                self.monitoring.start()
+                self.currentRefreshInterval = self.refreshInterval
+                # Assigned before scheduling: the first poll can run right away
+                self.monitoring = PollingTask(self.updateStatus, self.currentRefreshInterval,
+                                              name="{0}-{1}".format(type(self).__name__, id(self)))
+                PollingScheduler().scheduleTask(self.monitoring)
             else:
                 raise RuntimeError("Monitoring loop already running")
 
-    def backgroundStatusUpdates(self):
-        while True:
-            userInfo = self.doGetStatusUserInfo()
+    def updateStatus(self):
+        userInfo = self.doGetStatusUserInfo()
 
-            NotificationCenter().postNotification(PhysicalDeviceNotification.status, notifyingObject=self,
-                                                  userInfo=userInfo)
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, notifyingObject=self,
+                                              userInfo=userInfo)
 
-            with self.lock:
-                if self.quitMonitoring:
-                    break
-            time.sleep(self.refreshInterval)
+        if self.adaptiveRefresh:
+            interval = self.currentRefreshInterval or self.refreshInterval
+            if self.statusHasChanged(self.lastStatusUserInfo, userInfo):
+                self.currentRefreshInterval = max(interval / self.refreshFactor, self.minimumRefreshInterval)
+            else:
+                self.currentRefreshInterval = min(interval * self.refreshFactor, self.maximumRefreshInterval)
+            self.lastStatusUserInfo = userInfo
+        else:
+            self.currentRefreshInterval = self.refreshInterval
+
+        task = self.monitoring
+        if task is not None:
+            task.interval = self.currentRefreshInterval
+
+    def statusHasChanged(self, previousUserInfo, userInfo) -> bool:
+        """ Used by the adaptive refresh: override to ignore noise, e.g. with a tolerance """
+        try:
+            return bool(previousUserInfo != userInfo)
+        except (ValueError, TypeError): # e.g. arrays
+            return True
+
+    def statusWillChange(self):
+        """ Called after a command that changes the status (e.g. moveTo): with
+        adaptiveRefresh, polls again at minimumRefreshInterval from now """
+        if self.adaptiveRefresh:
+            self.currentRefreshInterval = self.minimumRefreshInterval
+            task = self.monitoring
+            if task is not None:
+                PollingScheduler().reschedule(task, self.currentRefreshInterval)
 
     def doGetStatusUserInfo(self):
         return None
@@ -171,10 +210,9 @@ class PhysicalDevice:
 
     def stopBackgroundStatusUpdates(self):
         if self.isMonitoring:
+            PollingScheduler().cancel(self.monitoring)
             with self.lock:
-                self.quitMonitoring = True
-            self.monitoring.join()
-            self.monitoring = None
+                self.monitoring = None
         else:
             raise RuntimeError("No status loop running")
 
@@ -0,0 +1,265 @@
+import time
+import math
+import heapq
+import itertools
+from typing import NamedTuple
+from threading import Thread, Condition, current_thread
+from concurrent.futures import ThreadPoolExecutor
+
+class PollingStatistics(NamedTuple):
+    interval: float
+    polls: int
+    missedDeadlines: int
+    overruns: int
+    errors: int
+    meanLateness: float
+    maximumLateness: float
+    meanDuration: float
+    maximumDuration: float
+
+class PollingTask:
+    """
+    A function polled every interval seconds by the PollingScheduler.
+    The deadlines stay on a grid (start + n * interval): a late poll does
+    not delay the next ones, and the deadlines that were missed because a
+    poll took too long are skipped (and counted), never polled in a burst.
+    The interval can be changed at any time, e.g. by the poll itself, and
+    applies from the next deadline.
+    """
+    def __init__(self, poll, interval, name=None):
+        self.poll = poll
+        self.interval = interval
+        self.name = name
+        self.deadline = None
+        self.isCancelled = False
+        self.isPolling = False
+        self.pollingThread = None
+
+        self.polls = 0
+        self.missedDeadlines = 0
+        self.overruns = 0     # polls longer than the interval
+        self.errors = 0
+        self.lastError = None
+        self.totalLateness = 0.0
+        self.maximumLateness = 0.0
+        self.totalDuration = 0.0
+        self.maximumDuration = 0.0
+
+    def recordPoll(self, lateness, duration):
+        self.polls += 1
+        self.totalLateness += lateness
+        self.maximumLateness = max(self.maximumLateness, lateness)
+        self.totalDuration += duration
+        self.maximumDuration = max(self.maximumDuration, duration)
+        if duration > self.interval:
+            self.overruns += 1
+
+    def nextDeadline(self, now):
+        """ The first deadline on the grid after now, counting the missed ones """
+        if self.interval <= 0:
+            return now
+        deadline = self.deadline + self.interval
+        if deadline < now:
+            missed = math.ceil((now - deadline) / self.interval)
+            self.missedDeadlines += missed
+            deadline += missed * self.interval
+        return deadline
+
+    def statistics(self) -> PollingStatistics:
+        meanLateness = None
+        meanDuration = None
+        if self.polls > 0:
+            meanLateness = self.totalLateness / self.polls
+            meanDuration = self.totalDuration / self.polls
+        return PollingStatistics(self.interval, self.polls, self.missedDeadlines, self.overruns, self.errors,
+                                 meanLateness, self.maximumLateness, meanDuration, self.maximumDuration)
+
+    def __repr__(self):
+        return "PollingTask({0}, interval={1})".format(self.name, self.interval)
+
+class PollingScheduler:
+    """
+    Polls all the PollingTasks (e.g. the background status updates of every
+    PhysicalDevice) with a single dispatch thread and a small pool of
+    numberOfWorkers threads, instead of one sleeping thread per task.
+    The tasks are kept in a heap ordered by deadline; a task is never polled
+    by two workers at the same time.
+
+        task = PollingScheduler().schedule(device.updateStatus, interval=1.0)
+        ...
+        PollingScheduler().cancel(task)
+
+    The dispatch thread starts with the first task (unless
+    startsAutomatically is False). Without it, runPending() polls the due
+    tasks in the calling thread, which, with a fake clock, makes the
+    scheduling deterministic.
+    """
+    _instance = None
+    numberOfWorkers = 4
+
+    def destroy(self):
+        scheduler = PollingScheduler()
+        scheduler.stop()
+        PollingScheduler._instance = None
+        del(scheduler)
+
+    def __init__(self):
+        if not hasattr(self, 'condition'):
+            self.condition = Condition()
+        if not hasattr(self, 'scheduledTasks'):
+            self.scheduledTasks = []
+        if not hasattr(self, 'tasks'):
+            self.tasks = [] # heap of (deadline, order, task), without those being polled
+        if not hasattr(self, 'order'):
+            self.order = itertools.count()
+        if not hasattr(self, 'clock'):
+            self.clock = time.monotonic
+        if not hasattr(self, 'startsAutomatically'):
+            self.startsAutomatically = True
+        if not hasattr(self, 'dispatching'):
+            self.dispatching = None
+        if not hasattr(self, 'quitDispatching'):
+            self.quitDispatching = False
+        if not hasattr(self, 'workers'):
+            self.workers = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls, *args, **kwargs)
+        return cls._instance
+
+    def schedule(self, poll, interval, name=None, delay=0) -> PollingTask:
+        """ Polls poll() after delay, then every interval seconds """
+        return self.scheduleTask(PollingTask(poll, interval, name), delay)
+
+    def scheduleTask(self, task, delay=0) -> PollingTask:
+        """ Same as schedule() for a task created beforehand, e.g. to keep
+        a reference to it before its first poll, which can run on a worker
+        before this returns """
+        with self.condition:
+            task.deadline = self.clock() + delay
+            self.scheduledTasks.append(task)
+            heapq.heappush(self.tasks, (task.deadline, next(self.order), task))
+            self.condition.notify_all()
+
+        if self.startsAutomatically:
+            self.start()
+        return task
+
+    def cancel(self, task):
+        """ No more polls of task. Waits for the current poll to finish,
+        unless called from the poll itself. """
+        with self.condition:
+            task.isCancelled = True
+            if task in self.scheduledTasks:
+                self.scheduledTasks.remove(task)
+            self.condition.notify_all()
+            while task.isPolling and task.pollingThread is not current_thread():
+                self.condition.wait()
+
+    def reschedule(self, task, interval):
+        """ Changes the interval of task and, if its next poll is later than
+        interval from now, moves it there (e.g. to poll faster right away
+        after a command). """
+        with self.condition:
+            task.interval = interval
+            if task.isCancelled or task.isPolling:
+                return # The next deadline is computed after the poll
+
+            deadline = self.clock() + interval
+            if deadline < task.deadline:
+                task.deadline = deadline
+                heapq.heappush(self.tasks, (task.deadline, next(self.order), task))
+                self.condition.notify_all()
+
+    def activeTasks(self) -> list:
+        with self.condition:
+            return list(self.scheduledTasks)
+
+    def statistics(self) -> dict:
+        """ PollingStatistics of the active tasks, by name """
+        return { task.name: task.statistics() for task in self.activeTasks() }
+
+    @property
+    def isRunning(self):
+        with self.condition:
+            return self.dispatching is not None
+
+    def start(self):
+        with self.condition:
+            if self.dispatching is None:
+                self.quitDispatching = False
+                self.workers = ThreadPoolExecutor(max_workers=self.numberOfWorkers, thread_name_prefix="PollingScheduler-worker")
+                self.dispatching = Thread(target=self.dispatchLoop, name="PollingScheduler-dispatch", daemon=True)
+                self.dispatching.start()
+
+    def stop(self):
+        """ Stops the threads once the current polls are finished. The tasks
+        are kept and polled again after start(). """
+        with self.condition:
+            dispatching = self.dispatching
+            if dispatching is None:
+                return
+            self.quitDispatching = True
+            self.condition.notify_all()
+
+        dispatching.join()
+        self.workers.shutdown(wait=True)
+        with self.condition:
+            self.dispatching = None
+            self.workers = None
+
+    def takeDueTasks(self, now) -> list:
+        """ Removes the tasks due at now from the heap, dropping the entries
+        of cancelled tasks and the previous entry of rescheduled tasks """
+        dueTasks = []
+        while self.tasks:
+            deadline, order, task = self.tasks[0]
+            if task.isCancelled or deadline != task.deadline or task.isPolling:
+                heapq.heappop(self.tasks) # Cancelled or rescheduled
+            elif deadline <= now:
+                heapq.heappop(self.tasks)
+                task.isPolling = True
+                dueTasks.append(task)
+            else:
+                break
+        return dueTasks
+
+    def runTask(self, task):
+        startTime = self.clock()
+        task.pollingThread = current_thread()
+        try:
+            task.poll()
+        except Exception as error:
+            task.errors += 1
+            task.lastError = error
+        endTime = self.clock()
+
+        with self.condition:
+            task.recordPoll(startTime - task.deadline, endTime - startTime)
+            task.isPolling = False
+            task.pollingThread = None
+            if not task.isCancelled:
+                task.deadline = task.nextDeadline(endTime)
+                heapq.heappush(self.tasks, (task.deadline, next(self.order), task))
+            self.condition.notify_all()
+
+    def runPending(self) -> int:
+        """ Polls the due tasks in the calling thread, returns how many """
+        with self.condition:
+            dueTasks = self.takeDueTasks(self.clock())
+        for task in dueTasks:
+            self.runTask(task)
+        return len(dueTasks)
+
+    def dispatchLoop(self):
+        with self.condition:
+            while not self.quitDispatching:
+                now = self.clock()
+                for task in self.takeDueTasks(now):
+                    self.workers.submit(self.runTask, task)
+
+                timeout = None
+                if self.tasks:
+                    timeout = max(self.tasks[0][0] - now, 0)
+                self.condition.wait(timeout)
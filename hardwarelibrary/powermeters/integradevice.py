@@ -29,22 +29,18 @@ class IntegraDevice(PowerMeterDevice):
         self.port = None
 
     def doGetAbsolutePower(self):
-        getPowerCommand = IntegraDevice.commands["GETPOWER"]
-        getPowerCommand.send(port=self.port)
-        self.absolutePower = float(getPowerCommand.matchGroups[0])
+        result = IntegraDevice.commands["GETPOWER"].execute(port=self.port)
+        self.absolutePower = result.matchAsFloat(0)
 
     def doGetCalibrationWavelength(self):
-        getWavelength = IntegraDevice.commands["GETWAVELENGTH"]
-        getWavelength.send(port=self.port)
-        self.calibrationWavelength = float(getWavelength.matchGroups[0])
+        result = IntegraDevice.commands["GETWAVELENGTH"].execute(port=self.port)
+        self.calibrationWavelength = result.matchAsFloat(0)
 
     def doSetCalibrationWavelength(self, wavelength):
-        setWavelength = IntegraDevice.commands["SETWAVELENGTH"]
-        setWavelength.send(port=self.port, params=(wavelength))
+        IntegraDevice.commands["SETWAVELENGTH"].execute(port=self.port, params=(wavelength))
         time.sleep(0.05) # This is necessary, see testIntegraDevice
 
     def doGetVersion(self):
-        getVersion = IntegraDevice.commands["VERSION"]
-        getVersion.send(port=self.port)
-        self.version = getVersion.matchGroups[0]
+        result = IntegraDevice.commands["VERSION"].execute(port=self.port)
+        self.version = result.matchGroups[0]
 
@@ -27,6 +27,7 @@ class PowerMeterDevice(PhysicalDevice):
     def setCalibrationWavelength(self, wavelength):
         self.doSetCalibrationWavelength(wavelength)
         self.doGetCalibrationWavelength()
+        self.statusWillChange()
 
     def measureAbsolutePower(self):
         self.doGetAbsolutePower()
@@ -6,12 +6,21 @@ class LaserSourceDevice:
 
     def turnOn(self):
         self.doTurnOn()
+        self.notifyStatusWillChange()
 
     def turnOff(self):
         self.doTurnOff()
+        self.notifyStatusWillChange()
 
     def setPower(self, power:float):
         self.doSetPower(power)
+        self.notifyStatusWillChange()
+
+    def notifyStatusWillChange(self):
+        # This is a mixin: statusWillChange() comes from PhysicalDevice, if any
+        statusWillChange = getattr(self, 'statusWillChange', None)
+        if statusWillChange is not None:
+            statusWillChange()
 
     def power(self) -> float:
         return self.doGetPower()
@@ -16,6 +16,7 @@ import usb.backend.libusb1
 
 from pathlib import *
 from hardwarelibrary.physicaldevice import PhysicalDevice
+from hardwarelibrary.communication.usbdescriptorcache import USBDescriptorCache
 from hardwarelibrary.spectrometers.viewer import *
 
 class NoSpectrometerConnected(RuntimeError):
@@ -220,10 +221,11 @@ class Spectrometer(PhysicalDevice):
         else:
             for idVendor in idVendors:
                 devices.extend(list(usb.core.find(find_all=True, idVendor=idVendor, idProduct=idProduct)))
+        USBDescriptorCache().purge(devices, [ (idVendor, idProduct) for idVendor in idVendors ])
 
         if serialNumber is not None: # A serial number was provided, try to match
             for device in devices:
-                deviceSerialNumber = usb.util.get_string(device, device.iSerialNumber ) 
+                deviceSerialNumber = USBDescriptorCache().serialNumber(device)
                 if deviceSerialNumber == serialNumber:
                     return [device]
 
@@ -28,6 +28,7 @@ except Exception as err:
     print('We will attempt to continue and hope for the best.')
 
 from hardwarelibrary.spectrometers.base import *
+from hardwarelibrary.communication.commands import StructLayout, compiledStruct
 from hardwarelibrary.spectrometers.viewer import *
     
 """
@@ -134,10 +135,12 @@ class OISpectrometer(Spectrometer):
     classIdVendor = 0x2457
 
     # The subclasses must define a NamedTuple Status and a packingFormat
-    # to retrieve and make sense of the status. See USB2000 for example.
+    # to retrieve and make sense of the status, and the statusLayout that
+    # decodes one into the other. See USB2000 for example.
     statusPackingFormat = None
     class Status(NamedTuple):
         pass
+    statusLayout = None
 
     timeScale = 1 # milliseconds=1, microseconds=1000
 
@@ -450,10 +453,9 @@ class OISpectrometer(Spectrometer):
         """
 
         self.sendCommand(cmdBytes = b'\xfe')
-        statusList = self.readReply(inputEndpoint=self.epStatus,
-                                    unpackingFormat=self.statusPackingFormat,
-                                    timeout=1000)
-        status = self.Status(*statusList)
+        status = self.readReply(inputEndpoint=self.epStatus,
+                                layout=self.statusLayout,
+                                timeout=1000)
         self.lastStatus = status
         return status
 
@@ -519,23 +521,28 @@ class OISpectrometer(Spectrometer):
         except Exception as err:
             print("Error writing to device: {0}".format(err))
 
-    def readReply(self, inputEndpoint, size = None, unpackingFormat=None, timeout=None):
+    def readReply(self, inputEndpoint, size = None, unpackingFormat=None, timeout=None, layout=None):
         """ Main entry point to read from device in order to have
-        consistent method to manage errors. """
+        consistent method to manage errors. With a StructLayout (or an
+        unpackingFormat), the packet is decoded directly from the buffer
+        returned by the endpoint. """
         if inputEndpoint is None:
             raise Exception("endpoint cannot be none")
 
-        buffer = array.array('B',[0]*inputEndpoint.wMaxPacketSize)
-        if unpackingFormat is not None:
-            size = calcsize(unpackingFormat)
+        if layout is None and unpackingFormat is not None:
+            layout = StructLayout(unpackingFormat)
+
+        if layout is not None:
+            size = layout.size
 
         if size is None:
+            buffer = array.array('B',[0]*inputEndpoint.wMaxPacketSize)
             inputEndpoint.read(size_or_buffer=buffer, timeout=timeout)
         else:
             buffer = inputEndpoint.read(size_or_buffer=size, timeout=timeout)
 
-        if unpackingFormat is not None:
-            return unpack(unpackingFormat, buffer)
+        if layout is not None:
+            return layout.unpack(buffer)
 
         return buffer
 
@@ -581,6 +588,7 @@ class USB2000(OISpectrometer):
         isSpectrumRequested: bool = None
         timerSwap: bool = None
         isSpectralDataReady : bool = None
+    statusLayout = StructLayout(statusPackingFormat, Status)
 
     def __init__(self, serialNumber=None, idProduct=None, idVendor=None):
         OISpectrometer.__init__(self, serialNumber, idProduct, idVendor, model="USB2000")
@@ -676,6 +684,7 @@ class USB4000_2000Plus(OISpectrometer):
         powerDown : bool = None
         packetsTransferred: int = None
         isHighSpeed : bool = None
+    statusLayout = StructLayout(statusPackingFormat, Status)
 
     def __init__(self, serialNumber=None, idProduct:int = None, idVendor:int = None, model=None):
         OISpectrometer.__init__(self, serialNumber=serialNumber, idProduct=idProduct, idVendor=idVendor, model="USB4000")
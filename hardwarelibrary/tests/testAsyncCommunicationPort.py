@@ -0,0 +1,242 @@
+import env
+import unittest
+import asyncio
+import os
+import time
+import threading
+from threading import Thread
+
+from hardwarelibrary.communication import *
+
+
+class FixedDelayDebugPort(DebugPort):
+    """ A DebugPort whose reads always take `delay` seconds, like a slow instrument. """
+    def doReadData(self, length, endPoint=None):
+        time.sleep(self.delay)
+        return super().doReadData(length, endPoint)
+
+
+class TestAsyncCommunicationPort(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.port = DebugPort()
+        self.port.open()
+        self.asyncPort = AsyncCommunicationPort(self.port)
+
+    def tearDown(self):
+        self.port.close()
+
+    async def testWriteStringReadString(self):
+        nBytes = await self.asyncPort.writeString("1234\n")
+        self.assertEqual(nBytes, 5)
+        self.assertEqual(await self.asyncPort.readString(), "1234\n")
+
+    async def testWriteDataReadData(self):
+        await self.asyncPort.writeData(b"abcd")
+        self.assertEqual(await self.asyncPort.readData(4), b"abcd")
+
+    async def testWriteStringReadMatchingGroups(self):
+        reply, groups = await self.asyncPort.writeStringReadMatchingGroups("abcd1234\n", replyPattern="(abc.)(\\d{4})")
+        self.assertEqual(groups, ("abcd", "1234"))
+
+    async def testWriteStringReadFirstMatchingGroup(self):
+        reply, group = await self.asyncPort.writeStringReadFirstMatchingGroup("abcd1234\n", replyPattern="abc.(\\d{4})")
+        self.assertEqual(group, "1234")
+
+    async def testFailedMatch(self):
+        with self.assertRaises(CommunicationReadNoMatch):
+            await self.asyncPort.writeStringReadMatchingGroups("abcd1234\n", replyPattern="(\\d{5})")
+
+    async def testConcurrentTransactionsOnSamePort(self):
+        commands = ["abcd{0}\n".format(i) for i in range(20)]
+        results = await asyncio.gather(*[self.asyncPort.writeStringReadFirstMatchingGroup(command, replyPattern="abcd(\\d+)") for command in commands])
+        self.assertEqual([group for reply, group in results], [str(i) for i in range(20)])
+
+    async def testTransactionsFromThreadsAndCoroutines(self):
+        failures = []
+
+        def threadTransactions():
+            for i in range(50):
+                try:
+                    self.port.writeStringExpectMatchingString("thread{0}\n".format(i), replyPattern="thread{0}\n".format(i))
+                except Exception as err:
+                    failures.append(err)
+
+        thread = Thread(target=threadTransactions)
+        thread.start()
+        for i in range(50):
+            reply = await self.asyncPort.writeStringExpectMatchingString("loop{0}\n".format(i), replyPattern="loop{0}\n".format(i))
+            self.assertEqual(reply, "loop{0}\n".format(i))
+        thread.join()
+        self.assertEqual(failures, [])
+
+    async def testWrappersOfSamePortAreExclusive(self):
+        otherAsyncPort = AsyncCommunicationPort(self.port)
+        events = []
+
+        async def transaction(asyncPort, name, delay):
+            await asyncio.sleep(delay)
+            async with asyncPort.transaction():
+                events.append(name + " start")
+                await asyncio.sleep(0.05)
+                events.append(name + " end")
+
+        await asyncio.gather(transaction(self.asyncPort, "first", 0), transaction(otherAsyncPort, "second", 0.01))
+        self.assertEqual(events, ["first start", "first end", "second start", "second end"])
+
+    async def testTransactionWaitsForThreadWithoutBlockingLoop(self):
+        locked = threading.Event()
+
+        def holdTransactionLock():
+            with self.port.transactionLock:
+                locked.set()
+                time.sleep(0.2)
+
+        thread = Thread(target=holdTransactionLock)
+        thread.start()
+        locked.wait()
+
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        tickerTask = asyncio.ensure_future(ticker())
+        startTime = time.perf_counter()
+        async with self.asyncPort.transaction():
+            duration = time.perf_counter() - startTime
+        tickerTask.cancel()
+        thread.join()
+
+        self.assertTrue(duration > 0.1)
+        self.assertTrue(ticks > 5)
+
+    async def testManyInstrumentsConcurrently(self):
+        nInstruments = 10
+        delay = 0.05
+        ports = [FixedDelayDebugPort(delay=delay) for i in range(nInstruments)]
+        for port in ports:
+            port.open()
+        asyncPorts = [AsyncCommunicationPort(port) for port in ports]
+
+        startTime = time.perf_counter()
+        await asyncio.gather(*[asyncPort.writeStringReadMatchingGroups("*CVU\n", replyPattern="(CVU)") for asyncPort in asyncPorts])
+        duration = time.perf_counter() - startTime
+
+        self.assertTrue(duration < nInstruments * delay / 2, "Took {0:.3f} s".format(duration))
+
+
+@unittest.skipIf(not hasattr(os, "openpty"), "Requires a POSIX pseudo-terminal")
+class TestAsyncSerialPort(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        self.port = SerialPort(portPath=os.ttyname(self.slave))
+        self.port.open(baudRate=9600, timeout=0.5)
+        self.asyncPort = AsyncSerialPort(self.port)
+        self.echoing = True
+        self.echo = Thread(target=self.echoLoop, daemon=True)
+        self.echo.start()
+
+    def tearDown(self):
+        self.echoing = False
+        self.port.close()
+        os.close(self.slave)
+        self.echo.join(timeout=1)
+        os.close(self.master)
+
+    def echoLoop(self):
+        while self.echoing:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            if data.startswith(b"silent"):
+                continue
+            os.write(self.master, data)
+
+    async def testHasFileDescriptor(self):
+        self.assertIsNotNone(self.asyncPort.fileDescriptor)
+
+    async def testWriteStringReadString(self):
+        await self.asyncPort.writeString("1234\n")
+        self.assertEqual(await self.asyncPort.readString(), "1234\n")
+
+    async def testWriteStringDoesNotRunOnLoop(self):
+        writingThreads = []
+        writeString = self.port.writeString
+        def recordingWriteString(string, endPoint=None):
+            writingThreads.append(threading.get_ident())
+            return writeString(string, endPoint)
+
+        self.port.writeString = recordingWriteString
+        await self.asyncPort.writeString("1234\n")
+        self.assertEqual(await self.asyncPort.readString(), "1234\n")
+        self.assertEqual(len(writingThreads), 1)
+        self.assertNotEqual(writingThreads[0], threading.get_ident())
+
+    async def testReadData(self):
+        await self.asyncPort.writeString("abcdefgh")
+        self.assertEqual(await self.asyncPort.readData(8), b"abcdefgh")
+
+    async def testWriteStringReadMatchingGroups(self):
+        reply, groups = await self.asyncPort.writeStringReadMatchingGroups("abcd1234\n", replyPattern="(abc.)(\\d{4})")
+        self.assertEqual(groups, ("abcd", "1234"))
+
+    async def testConcurrentTransactions(self):
+        commands = ["abcd{0}\n".format(i) for i in range(10)]
+        results = await asyncio.gather(*[self.asyncPort.writeStringReadFirstMatchingGroup(command, replyPattern="abcd(\\d+)") for command in commands])
+        self.assertEqual([group for reply, group in results], [str(i) for i in range(10)])
+
+    async def testReadTimeout(self):
+        await self.asyncPort.writeString("silent\n")
+        with self.assertRaises(CommunicationReadTimeout):
+            await self.asyncPort.readString()
+
+    async def testLoopIsNotBlockedWhileWaiting(self):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        tickerTask = asyncio.ensure_future(ticker())
+        await self.asyncPort.writeString("silent\n")
+        with self.assertRaises(CommunicationReadTimeout):
+            await self.asyncPort.readString()
+        tickerTask.cancel()
+        self.assertTrue(ticks > 10)
+
+    async def testLoopIsNotBlockedByThreadHoldingPortLock(self):
+        await self.asyncPort.writeString("1234\n")
+        locked = threading.Event()
+
+        def holdPortLock():
+            # Like a thread blocked in readString() on the port
+            with self.port.portLock:
+                locked.set()
+                time.sleep(0.3)
+
+        thread = Thread(target=holdPortLock)
+        thread.start()
+        locked.wait()
+
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        tickerTask = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0)
+        self.assertEqual(await self.asyncPort.readString(), "1234\n")
+        tickerTask.cancel()
+        thread.join()
+        self.assertTrue(ticks > 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,14 @@ import env
 import unittest
 from threading import Thread, Lock
 
+import os
+import array
+import random
+import struct
+from typing import NamedTuple
+import usb.core
 import usb.util as util
+import numpy as np
 
 from hardwarelibrary.communication import *
 
@@ -106,6 +113,22 @@ class BaseTestCases:
                 string = self.port.readString()
                 self.assertTrue(string == payloadString, "{0} is not {1}".format(string, payloadString))
 
+        def testReadStringKeepsLeftoverBytesForReadData(self):
+            self.port.writeString(payloadString)
+            self.port.writeData(payloadData)
+
+            string = self.port.readString()
+            self.assertEqual(string, payloadString)
+            data = self.port.readData(length=len(payloadData))
+            self.assertEqual(data, payloadData)
+
+        def testReadIntoBytearray(self):
+            self.port.writeData(payloadData)
+            buffer = bytearray(len(payloadData))
+            nBytes = self.port.readInto(buffer)
+            self.assertEqual(nBytes, len(payloadData))
+            self.assertEqual(buffer, payloadData)
+
         def testTimeoutReadData(self):
             with self.assertRaises(CommunicationReadTimeout):
                 self.port.readData(1)
@@ -163,6 +186,25 @@ class BaseTestCases:
                     "abcd1234\n",
                     replyPattern="(abc.)(\\d{5})")
 
+        def testBatchWriteStringsReadMatchingGroups(self):
+            replies = self.port.writeStringsReadMatchingGroups([("abcd1234\n", "abc.(\\d{4})"),
+                                                                ("efgh5678\n", "(e)fgh(\\d+)")])
+            self.assertEqual(len(replies), 2)
+            self.assertEqual(replies[0].groups, ("1234",))
+            self.assertEqual(replies[1].groups, ("e", "5678"))
+            self.assertIsNone(replies[0].error)
+            self.assertIsNone(replies[1].error)
+
+        def testBatchReportsErrorsPerCommand(self):
+            replies = self.port.writeStringsReadMatchingGroups([("abcd1234\n", "(\\d{4})"),
+                                                                ("abcd1234\n", "(\\d{5})"),
+                                                                ("efgh\n", "(efgh)")])
+            self.assertIsNone(replies[0].error)
+            self.assertIsInstance(replies[1].error, CommunicationReadNoMatch)
+            self.assertEqual(replies[1].reply, "abcd1234\n")
+            self.assertIsNone(replies[2].error)
+            self.assertEqual(replies[2].groups, ("efgh",))
+
         def testThreadSafety(self):
             global threadFailed, globalLock
             threadFailed = -1
@@ -268,6 +310,832 @@ class TestDebugPortDefaultsToECho(BaseTestCases.TestEchoPort):
         self.assertFalse(self.port.isOpen)
 
 
+class TestUnlockedDebugEchoPort(BaseTestCases.TestEchoPort):
+
+    def setUp(self):
+        self.port = DebugEchoPort(threadSafe=False)
+        self.assertIsNotNone(self.port)
+        self.port.open()
+        self.assertTrue(self.port.isOpen)
+        self.port.flush()
+
+    def tearDown(self):
+        self.port.close()
+        self.assertFalse(self.port.isOpen)
+
+    def testThreadSafety(self):
+        self.skipTest("An unlocked port is for a single thread")
+
+    def testLocksAreNoLocks(self):
+        self.assertFalse(self.port.isThreadSafe)
+        self.assertIsInstance(self.port.portLock, NoLock)
+        self.assertIsInstance(self.port.transactionLock, NoLock)
+        self.assertTrue(self.port.transactionLock.acquire(blocking=False))
+        self.port.transactionLock.release()
+
+
+class WriteCountingDebugPort(DebugPort):
+    def __init__(self, silentCommands=()):
+        super().__init__()
+        self.writeCount = 0
+        self.silentCommands = silentCommands
+
+    def writeData(self, data, endPoint=None):
+        self.writeCount += 1
+        return super().writeData(data, endPoint)
+
+    def processInputBuffers(self, endPointIndex):
+        # Echo each line, except the silent commands that get no reply
+        inputBytes = self.inputBuffers[endPointIndex]
+        for line in inputBytes.splitlines(keepends=True):
+            if line not in self.silentCommands:
+                self.writeToOutputBuffer(line, endPointIndex)
+        self.inputBuffers[endPointIndex] = bytearray()
+
+
+class TestBatchCommands(unittest.TestCase):
+    def testSingleWriteForAllCommands(self):
+        port = WriteCountingDebugPort()
+        port.open()
+        commands = [("cmd{0}\n".format(i), "cmd(\\d+)") for i in range(10)]
+        replies = port.writeStringsReadMatchingGroups(commands)
+        self.assertEqual(port.writeCount, 1)
+        self.assertEqual([reply.groups[0] for reply in replies], [str(i) for i in range(10)])
+
+    def testCommandsWithoutReply(self):
+        port = WriteCountingDebugPort(silentCommands=[b"set 1\n"])
+        port.open()
+        replies = port.writeStringsReadMatchingGroups([("set 1\n", None), ("get?\n", "(get)")])
+        self.assertIsNone(replies[0].reply)
+        self.assertIsNone(replies[0].error)
+        self.assertEqual(replies[1].groups, ("get",))
+
+    def testTimeoutMarksRemainingCommands(self):
+        port = WriteCountingDebugPort(silentCommands=[b"b?\n", b"c?\n"])
+        port.open()
+        replies = port.writeStringsReadMatchingGroups([("a?\n", "(a)"), ("b?\n", "(b)"), ("c?\n", "(c)")])
+        self.assertIsNone(replies[0].error)
+        self.assertIsInstance(replies[1].error, CommunicationReadTimeout)
+        self.assertIsInstance(replies[2].error, CommunicationReadTimeout)
+
+    def testReadErrorIsReportedForItsCommand(self):
+        class GarblingDebugPort(WriteCountingDebugPort):
+            def processInputBuffers(self, endPointIndex):
+                self.inputBuffers[endPointIndex] = self.inputBuffers[endPointIndex].replace(b"b?", b"\xffb?")
+                super().processInputBuffers(endPointIndex)
+
+        port = GarblingDebugPort()
+        port.open()
+        replies = port.writeStringsReadMatchingGroups([("a?\n", "(a)"), ("b?\n", "(b)"), ("c?\n", "(c)")])
+        self.assertEqual(replies[0].groups, ("a",))
+        self.assertIsInstance(replies[1].error, UnicodeDecodeError)
+        self.assertEqual(replies[2].groups, ("c",))
+
+    def testWriteErrorIsReportedForEveryCommand(self):
+        class FailingDebugPort(WriteCountingDebugPort):
+            def writeData(self, data, endPoint=None):
+                raise IOError("Device disconnected")
+
+        port = FailingDebugPort()
+        port.open()
+        replies = port.writeStringsReadMatchingGroups([("set 1\n", None), ("get?\n", "(get)")])
+        self.assertEqual([reply.command for reply in replies], ["set 1\n", "get?\n"])
+        self.assertTrue(all([ isinstance(reply.error, IOError) for reply in replies ]))
+
+
+class TestReadStringPerformance(unittest.TestCase):
+    def setUp(self):
+        self.port = DebugPort()
+        self.port.open()
+
+    def tearDown(self):
+        self.port.close()
+
+    def testReadStringLinesPerSecond(self):
+        line = "*CVU 1.2345678e-03 some padding for a typical reply\n"
+        nLines = 10000
+        self.port.writeString(line * nLines)
+
+        startTime = time.perf_counter()
+        for i in range(nLines):
+            self.assertEqual(self.port.readString(), line)
+        duration = time.perf_counter() - startTime
+
+        linesPerSecond = nLines / duration
+        print("\nreadString on DebugPort: {0:.0f} lines/s".format(linesPerSecond))
+        self.assertTrue(linesPerSecond > 1000)
+
+    def testReadStringChunkSizeIsConfigurable(self):
+        self.port.readChunkSize = 3
+        self.port.writeString(payloadString * 3)
+        for i in range(3):
+            self.assertEqual(self.port.readString(), payloadString)
+        self.assertEqual(self.port.bytesAvailable(), 0)
+
+
+class TestReplyPatterns(unittest.TestCase):
+    def setUp(self):
+        self.port = DebugPort()
+        self.port.open()
+
+    def tearDown(self):
+        self.port.close()
+
+    def testCompiledPatternIsCached(self):
+        pattern = compiledPattern(r"(\d+)\s(\d+)")
+        self.assertIs(compiledPattern(r"(\d+)\s(\d+)"), pattern)
+        self.assertIsNone(compiledPattern(None))
+
+    def testCompiledPatternAcceptsCompiledPattern(self):
+        pattern = re.compile("abc")
+        self.assertIs(compiledPattern(pattern), pattern)
+
+    def testReadMatchingGroupsAcceptsCompiledPattern(self):
+        self.port.writeString("12 34\n")
+        reply, groups = self.port.readMatchingGroups(re.compile(r"(\d+)\s(\d+)"))
+        self.assertEqual(groups, ('12', '34'))
+
+    def testTextCommandCompilesPatterns(self):
+        command = TextCommand(name="test", text="MOVE {0}\n", replyPattern=r"(\d+)", alternatePattern="ERR")
+        self.assertEqual(command.replyRegex.pattern, r"(\d+)")
+        self.assertEqual(command.alternateRegex.pattern, "ERR")
+        self.assertEqual(command.numberOfArguments, 1)
+
+    def testTextCommandWithoutArguments(self):
+        command = TextCommand(name="test", text="STATUS\n", replyPattern=None)
+        self.assertIsNone(command.replyRegex)
+        self.assertEqual(command.numberOfArguments, 0)
+
+    def testTextCommandSendMatchesReply(self):
+        command = TextCommand(name="test", text="12 34\n", replyPattern=r"(\d+)\s(\d+)")
+        self.assertFalse(command.send(self.port))
+        self.assertEqual(command.matchGroups, ('12', '34'))
+
+    def testBenchmarkMatchedRepliesPerSecond(self):
+        line = "*CVU 1.2345678e-03 some padding for a typical reply\n"
+        pattern = r"\*CVU\s+([-+]?\d*\.\d+e[-+]\d+)\s+(\w+)"
+        nReplies = 5000
+
+        startTime = time.perf_counter()
+        for i in range(nReplies):
+            self.port.writeString(line)
+            reply = self.port.readString()
+            match = re.search(pattern, reply)
+            self.assertIsNotNone(match)
+        rawDuration = time.perf_counter() - startTime
+
+        command = TextCommand(name="read", text=line, replyPattern=pattern)
+        startTime = time.perf_counter()
+        for i in range(nReplies):
+            self.assertFalse(command.send(self.port))
+        commandDuration = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        for i in range(nReplies):
+            self.port.writeStringReadMatchingGroups(line, pattern)
+        portDuration = time.perf_counter() - startTime
+
+        print("\nMatched replies on DebugPort: raw re.search {0:.0f}/s, TextCommand {1:.0f}/s, cached port pattern {2:.0f}/s".format(nReplies / rawDuration, nReplies / commandDuration, nReplies / portDuration))
+        self.assertTrue(nReplies / commandDuration > 1000)
+
+
+class Position(NamedTuple):
+    x: int
+    y: int
+    z: int
+
+class TestBinaryCommand(unittest.TestCase):
+    def setUp(self):
+        self.port = DebugPort()
+        self.port.open()
+
+    def tearDown(self):
+        self.port.close()
+
+    def testCompiledStructIsCached(self):
+        self.assertIs(compiledStruct('<lll'), compiledStruct('<lll'))
+        packer = struct.Struct('<h')
+        self.assertIs(compiledStruct(packer), packer)
+
+    def testRequestWithPrefixAndSuffix(self):
+        command = BinaryCommand("MOVE", prefix=b'M', requestFormat='<lll', suffix=b'\r')
+        self.assertEqual(command.request(1, 2, 3), b'M' + struct.pack('<lll', 1, 2, 3) + b'\r')
+        self.assertEqual(command.numberOfArguments, 3)
+
+    def testRequestWithoutArguments(self):
+        command = BinaryCommand("HOME", prefix=b'H\r')
+        self.assertEqual(command.request(), b'H\r')
+        self.assertEqual(command.numberOfArguments, 0)
+        self.assertEqual(command.payload, b'H\r')
+
+    def testFixedReplyIntoNamedTuple(self):
+        command = BinaryCommand("ECHO", requestFormat='<lll', replyFormat='<lll', replyType=Position)
+        self.assertFalse(command.send(self.port, 10, -20, 30))
+        self.assertEqual(command.values, Position(10, -20, 30))
+        self.assertEqual(command.values.y, -20)
+        self.assertTrue(command.isSentSuccessfully)
+
+    def testFixedReplyWithPadding(self):
+        command = BinaryCommand("POSITION", prefix=b'c', requestFormat='<lll', suffix=b'\r', replyFormat='<xlllx')
+        command.send(self.port, 1, 2, 3)
+        self.assertEqual(command.values, (1, 2, 3))
+
+    def testSeveralFixedRecords(self):
+        command = BinaryCommand("ECHO", requestFormat='<llllll', replyFormat='<lll', replyType=Position, replyCount=2)
+        command.send(self.port, 1, 2, 3, 4, 5, 6)
+        self.assertEqual(command.values, [Position(1, 2, 3), Position(4, 5, 6)])
+
+    def testLengthPrefixedReply(self):
+        command = BinaryCommand("ECHO", prefix=struct.pack('<H', 12), requestFormat='<lll',
+                                lengthFormat='<H', replyFormat='<l', replyCount=None)
+        command.send(self.port, 7, 8, 9)
+        self.assertEqual(command.values, [(7,), (8,), (9,)])
+        self.assertEqual(self.port.bytesAvailable(), 0)
+
+    def testTerminatedReply(self):
+        command = BinaryCommand("ECHO", requestFormat='<HH', suffix=b'\n', terminator=b'\n', replyFormat='<HH')
+        command.send(self.port, 1000, 2000)
+        self.assertEqual(command.values, (1000, 2000))
+        self.assertEqual(command.reply, struct.pack('<HH', 1000, 2000) + b'\n')
+
+    def testTerminatedReplyWithoutFormatIsRaw(self):
+        command = BinaryCommand("ECHO", prefix=b'abc\r', terminator=b'\r')
+        command.send(self.port)
+        self.assertEqual(command.values, b'abc')
+
+    def testReplyIntoStructuredArray(self):
+        dtype = np.dtype([('x', '<i4'), ('y', '<i4'), ('z', '<i4')])
+        command = BinaryCommand("ECHO", requestFormat='<llllll', replyFormat='<lll', replyType=dtype, replyCount=2)
+        command.send(self.port, 1, 2, 3, 4, 5, 6)
+        self.assertEqual(list(command.values['x']), [1, 4])
+        self.assertEqual(list(command.values['z']), [3, 6])
+
+    def testStructuredArrayMustMatchFormat(self):
+        with self.assertRaises(ValueError):
+            StructLayout('<ll', np.dtype([('x', '<i4')]))
+
+    def testNotEnoughReplyBytesRaises(self):
+        command = BinaryCommand("ECHO", requestFormat='<h', replyFormat='<l')
+        with self.assertRaises(Exception):
+            command.send(self.port, 1)
+        self.assertTrue(command.hasError)
+
+    def testReadDataUntil(self):
+        self.port.writeData(b'\x01\x02\xff\x03\xff')
+        self.assertEqual(self.port.readDataUntil(b'\xff'), b'\x01\x02\xff')
+        self.assertEqual(self.port.readDataUntil(b'\xff'), b'\x03\xff')
+
+    def testBenchmarkPerCommandOverhead(self):
+        nCommands = 20000
+
+        startTime = time.perf_counter()
+        for i in range(nCommands):
+            self.port.writeData(struct.pack('<clllc', b'c', i, 2, 3, b'\r'))
+            (x, y, z) = struct.unpack('<xlllx', self.port.readData(14))
+        handRolledDuration = time.perf_counter() - startTime
+
+        command = BinaryCommand("POSITION", prefix=b'c', requestFormat='<lll', suffix=b'\r', replyFormat='<xlllx')
+        startTime = time.perf_counter()
+        for i in range(nCommands):
+            command.send(self.port, i, 2, 3)
+            (x, y, z) = command.values
+        commandDuration = time.perf_counter() - startTime
+        self.assertEqual(x, nCommands-1)
+
+        nRecords = 4096
+        layout = StructLayout('<lll', np.dtype([('x', '<i4'), ('y', '<i4'), ('z', '<i4')]))
+        data = bytes(range(256)) * (nRecords * layout.size // 256)
+        startTime = time.perf_counter()
+        positions = [ struct.unpack('<lll', data[i*12:(i+1)*12]) for i in range(nRecords) ]
+        handRolledDecodeDuration = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        records = layout.unpackAll(memoryview(data))
+        decodeDuration = time.perf_counter() - startTime
+        self.assertEqual(len(records), nRecords)
+        self.assertEqual(tuple(records[-1]), positions[-1])
+
+        print("\nSutter-style commands on DebugPort: hand-rolled pack/unpack {0:.1f} us, BinaryCommand {1:.1f} us per command".format(handRolledDuration/nCommands*1e6, commandDuration/nCommands*1e6))
+        print("Decoding {0} records: hand-rolled unpack {1:.0f} us, structured array {2:.0f} us".format(nRecords, handRolledDecodeDuration*1e6, decodeDuration*1e6))
+
+
+class TestCommandResult(unittest.TestCase):
+    def setUp(self):
+        self.port = DebugPort()
+        self.port.open()
+
+    def tearDown(self):
+        self.port.close()
+
+    def testResultIsImmutable(self):
+        result = CommandResult("test", reply="1234\n", matchGroups=("1234",))
+        with self.assertRaises(AttributeError):
+            result.reply = "other"
+        with self.assertRaises(AttributeError):
+            result.somethingElse = 1
+        with self.assertRaises(AttributeError):
+            del result.reply
+        self.assertFalse(hasattr(result, '__dict__'))
+
+    def testExecuteTextCommandLeavesCommandUntouched(self):
+        command = TextCommand(name="test", text="ECHO {0}\n", replyPattern=r"ECHO (\d+)")
+        result = command.execute(self.port, params=42)
+        self.assertEqual(result.payload, "ECHO 42\n")
+        self.assertEqual(result.reply, "ECHO 42\n")
+        self.assertEqual(result.matchAsFloat(), 42.0)
+        self.assertIsNone(command.reply)
+        self.assertIsNone(command.matchGroups)
+        self.assertFalse(command.isSent)
+
+    def testExecuteRaisesInsteadOfKeepingException(self):
+        command = TextCommand(name="test", text="1234\n", replyPattern=r"abcd")
+        with self.assertRaises(CommunicationReadNoMatch):
+            command.execute(self.port)
+        self.assertEqual(len(command.exceptions), 0)
+
+    def testSendIsSentEvenIfReplyFails(self):
+        command = TextCommand(name="test", text="1234\n", replyPattern=r"abcd")
+        self.assertTrue(command.send(self.port))
+        self.assertTrue(command.isSent)
+        self.assertFalse(command.isSentSuccessfully)
+        self.assertIsInstance(command.exceptions[0], CommunicationReadNoMatch)
+
+        command = BinaryCommand("test", prefix=b'E', replyFormat='<l')
+        with self.assertRaises(CommunicationReadTimeout):
+            command.send(self.port)
+        self.assertTrue(command.isSent)
+        self.assertFalse(command.isSentSuccessfully)
+
+    def testExecuteMultilineCommand(self):
+        command = MultilineTextCommand(name="test", text="a 1\nb 2\nc 3\n", replyPattern=r"(\w) (\d)", lineCount=3)
+        result = command.execute(self.port)
+        self.assertEqual(result.matchGroups, (('a', '1'), ('b', '2'), ('c', '3')))
+
+    def testExecuteDataCommand(self):
+        command = DataCommand("Test", data=b"1234\n", replyDataLength=5)
+        result = command.execute(self.port)
+        self.assertEqual(result.reply, b"1234\n")
+        self.assertIsNone(command.reply)
+
+    def testExecuteBinaryCommand(self):
+        command = BinaryCommand("ECHO", requestFormat='<lll', replyFormat='<lll', replyType=Position)
+        result = command.execute(self.port, 1, 2, 3)
+        self.assertEqual(result.values, Position(1, 2, 3))
+        self.assertIsNone(command.values)
+
+    def testSendKeepsBoundedExceptions(self):
+        command = TextCommand(name="test", text="1234\n", replyPattern=r"abcd")
+        for i in range(3 * Command.maximumExceptionCount):
+            self.assertTrue(command.send(self.port))
+        self.assertEqual(len(command.exceptions), Command.maximumExceptionCount)
+
+    def executeConcurrently(self, ports, nThreads, nCommands):
+        command = TextCommand(name="ECHO", text="ECHO {0}\n", replyPattern=r"ECHO (\d+)")
+        failures = []
+
+        def work(threadIndex):
+            port = ports[threadIndex % len(ports)]
+            for i in range(nCommands):
+                value = threadIndex * nCommands + i
+                try:
+                    result = command.execute(port, params=value)
+                    if result.matchGroups[0] != str(value):
+                        failures.append((value, result))
+                except Exception as err:
+                    failures.append((value, err))
+
+        threads = [ Thread(target=work, args=(i,)) for i in range(nThreads) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertIsNone(command.reply)
+        self.assertEqual(len(command.exceptions), 0)
+
+    def testStressOneCommandManyPorts(self):
+        ports = [ DebugPort() for i in range(16) ]
+        for port in ports:
+            port.open()
+        self.executeConcurrently(ports, nThreads=16, nCommands=500)
+
+    def testStressOneCommandSharedPort(self):
+        self.executeConcurrently([self.port], nThreads=16, nCommands=500)
+
+
+class TestPortLocking(unittest.TestCase):
+    def testThreadSafeByDefault(self):
+        port = DebugEchoPort()
+        self.assertTrue(port.isThreadSafe)
+        self.assertFalse(isinstance(port.portLock, NoLock))
+
+    def testDelayDoesNotHoldPortLock(self):
+        port = DebugEchoPort(delay=0.2)
+        port.open()
+        port.delay = 0.2
+        port.randomGenerator = random.Random(1) # a delay of ~0.03 s
+        writer = Thread(target=port.writeData, args=(b"abc\n",))
+        writer.start()
+        time.sleep(0.01)
+        acquired = port.portLock.acquire(timeout=0.005)
+        if acquired:
+            port.portLock.release()
+        writer.join()
+        self.assertTrue(acquired)
+        self.assertEqual(port.readString(), "abc\n")
+
+    @unittest.skipIf(not hasattr(os, "openpty"), "Requires a POSIX pseudo-terminal")
+    def testSerialReadStringWaitsWithoutPortLock(self):
+        master, slave = os.openpty()
+        port = SerialPort(portPath=os.ttyname(slave))
+        port.open(baudRate=9600, timeout=0.5)
+        try:
+            results = []
+            def readString():
+                try:
+                    results.append(port.readString())
+                except CommunicationReadTimeout as err:
+                    results.append(err)
+
+            reader = Thread(target=readString)
+            reader.start()
+            time.sleep(0.05) # The reader is waiting for its reply
+            acquired = port.portLock.acquire(timeout=0.1)
+            if acquired:
+                port.portLock.release()
+            os.write(master, b"abc\n")
+            reader.join()
+            self.assertTrue(acquired)
+            self.assertEqual(results, ["abc\n"])
+
+            with self.assertRaises(CommunicationReadTimeout):
+                port.readString()
+        finally:
+            port.close()
+            os.close(slave)
+            os.close(master)
+
+    def commandDuration(self, ports, nThreads, nCommands):
+        """ Seconds per command, each thread using ports[thread % len(ports)] """
+        def work(port):
+            for i in range(nCommands):
+                port.writeStringReadMatchingGroups("VALUE 1234\n", replyPattern=r"VALUE (\d+)")
+
+        threads = [ Thread(target=work, args=(ports[i % len(ports)],)) for i in range(nThreads) ]
+        startTime = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (time.perf_counter() - startTime) / (nThreads * nCommands)
+
+    def testBenchmarkLockOverheadPerCommand(self):
+        nCommands = 2000
+        unlockedPort = DebugEchoPort(threadSafe=False)
+        unlockedPort.open()
+        lockedPort = DebugEchoPort()
+        lockedPort.open()
+
+        unlocked = self.commandDuration([unlockedPort], 1, nCommands)
+        print("\nDebugEchoPort, 1 thread: unlocked {0:.1f} µs/command".format(unlocked*1e6))
+        for nThreads in [1, 4, 16]:
+            shared = self.commandDuration([lockedPort], nThreads, nCommands)
+            privatePorts = [ DebugEchoPort(threadSafe=False) for i in range(nThreads) ]
+            for port in privatePorts:
+                port.open()
+            private = self.commandDuration(privatePorts, nThreads, nCommands)
+            print("DebugEchoPort, {0:2d} threads: locked shared port {1:.1f} µs/command, unlocked port per thread {2:.1f} µs/command".format(nThreads, shared*1e6, private*1e6))
+
+
+class TestRingBuffer(unittest.TestCase):
+    def testEmpty(self):
+        ring = RingBuffer(capacity=16)
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(ring.capacity, 16)
+        self.assertEqual(ring.read(4), b'')
+
+    def testWriteRead(self):
+        ring = RingBuffer(capacity=16)
+        ring.write(b'abcdefgh')
+        self.assertEqual(len(ring), 8)
+        self.assertEqual(ring.read(3), b'abc')
+        self.assertEqual(ring.read(10), b'defgh')
+        self.assertEqual(len(ring), 0)
+
+    def testWrapAround(self):
+        ring = RingBuffer(capacity=8)
+        ring.write(b'abcdef')
+        self.assertEqual(ring.read(4), b'abcd')
+        ring.write(b'ghijk')
+        self.assertEqual(ring.capacity, 8)
+        self.assertEqual(ring.read(7), b'efghijk')
+
+    def testGrowKeepsOrder(self):
+        ring = RingBuffer(capacity=8)
+        ring.write(b'abcdef')
+        ring.read(4)
+        ring.write(b'ghijklmnopqrstuv')
+        self.assertTrue(ring.capacity >= 18)
+        self.assertEqual(ring.read(100), b'efghijklmnopqrstuv')
+
+    def testReadIntoNumPyArray(self):
+        ring = RingBuffer(capacity=8)
+        values = np.arange(8, dtype=np.uint16)
+        ring.write(values.tobytes())
+        destination = np.zeros(8, dtype=np.uint16)
+        self.assertEqual(ring.readInto(destination), 16)
+        self.assertTrue((destination == values).all())
+
+
+class FakeInputEndPoint:
+    """ Mimics a pyusb input endpoint: serves the content of source and
+    counts calls to read(). Like libusb, a read fills as much of the buffer
+    as there is data, which may span several packets. """
+    def __init__(self, source, wMaxPacketSize=64, bEndpointAddress=0x82):
+        self.source = array.array('B', source)
+        self.position = 0
+        self.wMaxPacketSize = wMaxPacketSize
+        self.bEndpointAddress = bEndpointAddress
+        self.readCount = 0
+        self.requestedSizes = []
+
+    def read(self, size_or_buffer, timeout=None):
+        self.readCount += 1
+        self.requestedSizes.append(len(size_or_buffer))
+        nBytes = min(len(size_or_buffer), len(self.source) - self.position)
+        if nBytes == 0:
+            raise usb.core.USBTimeoutError("Operation timed out", errno=110, error_code=-7)
+        size_or_buffer[:nBytes] = self.source[self.position:self.position+nBytes]
+        self.position += nBytes
+        return nBytes
+
+
+def fakeUSBPort(endPoint, maximumTransferSize=None):
+    port = USBPort(maximumTransferSize=maximumTransferSize)
+    port.device = "fake"  # isOpen only checks for a device
+    port.defaultInputEndPoint = endPoint
+    return port
+
+
+def legacyUSBReadData(endPoint, internalBuffer, length):
+    # The USBPort.readData algorithm before the ring buffer, kept for comparison
+    while length > len(internalBuffer):
+        data = util.create_buffer(endPoint.wMaxPacketSize)
+        nBytesRead = endPoint.read(size_or_buffer=data, timeout=500)
+        internalBuffer += bytearray(data[:nBytesRead])
+
+    return internalBuffer[:length], internalBuffer[length:]
+
+
+class TestUSBPortInternalBuffer(unittest.TestCase):
+    def setUp(self):
+        self.source = bytes(random.getrandbits(8) for i in range(1 << 16))
+
+    def testReadDataAcrossPackets(self):
+        port = fakeUSBPort(FakeInputEndPoint(self.source, wMaxPacketSize=64))
+        self.assertEqual(port.readData(100), self.source[:100])
+        self.assertEqual(port.readData(28), self.source[100:128])
+        self.assertEqual(port.bytesAvailable(), 0)
+
+    def testReadStringLeavesRestOfPacket(self):
+        endPoint = FakeInputEndPoint(b'1234\nabcd\n', wMaxPacketSize=64)
+        port = fakeUSBPort(endPoint)
+        self.assertEqual(port.readString(), '1234\n')
+        self.assertEqual(port.readString(), 'abcd\n')
+        self.assertEqual(endPoint.readCount, 1)
+
+    def testReadIntoNumPyArray(self):
+        port = fakeUSBPort(FakeInputEndPoint(self.source, wMaxPacketSize=64))
+        spectrum = np.zeros(1000, dtype=np.uint16)
+        self.assertEqual(port.readInto(spectrum), 2000)
+        self.assertEqual(spectrum.tobytes(), self.source[:2000])
+
+    def testTimeoutKeepsPartialData(self):
+        port = fakeUSBPort(FakeInputEndPoint(b'1234', wMaxPacketSize=64))
+        with self.assertRaises(usb.core.USBTimeoutError):
+            port.readData(8)
+        self.assertEqual(port.readData(4), b'1234')
+
+    def testSinglePacketModeByDefault(self):
+        endPoint = FakeInputEndPoint(self.source, wMaxPacketSize=64)
+        port = fakeUSBPort(endPoint)
+        self.assertEqual(port.readData(4096), self.source[:4096])
+        self.assertEqual(endPoint.readCount, 64)
+        self.assertEqual(set(endPoint.requestedSizes), {64})
+
+    def testBulkModeReadsSeveralPacketsPerCall(self):
+        endPoint = FakeInputEndPoint(self.source, wMaxPacketSize=64)
+        port = fakeUSBPort(endPoint, maximumTransferSize=16384)
+        self.assertEqual(port.readData(4096), self.source[:4096])
+        self.assertEqual(endPoint.readCount, 1)
+
+    def testBulkModeIsCappedByMaximumTransferSize(self):
+        endPoint = FakeInputEndPoint(self.source, wMaxPacketSize=64)
+        port = fakeUSBPort(endPoint, maximumTransferSize=1024)
+        self.assertEqual(port.readData(4096), self.source[:4096])
+        self.assertEqual(endPoint.readCount, 4)
+        self.assertEqual(set(endPoint.requestedSizes), {1024})
+
+    def testBulkModeRequestsWholePacketsOnly(self):
+        endPoint = FakeInputEndPoint(self.source, wMaxPacketSize=64)
+        port = fakeUSBPort(endPoint, maximumTransferSize=1000)
+        self.assertEqual(port.readData(100), self.source[:100])
+        self.assertEqual(endPoint.requestedSizes, [128])
+        self.assertEqual(port.bytesAvailable(), 28)
+
+        port.readData(28 + 2000)
+        self.assertEqual(endPoint.requestedSizes, [128, 960, 960, 128])
+
+    def testBulkModeReadIntoNumPyArray(self):
+        endPoint = FakeInputEndPoint(self.source, wMaxPacketSize=512)
+        port = fakeUSBPort(endPoint, maximumTransferSize=16384)
+        spectrum = np.zeros(2048, dtype=np.uint16)
+        port.readInto(spectrum)
+        self.assertEqual(spectrum.tobytes(), self.source[:4096])
+        self.assertEqual(endPoint.readCount, 1)
+
+    def testBenchmarkBulkMode(self):
+        oneMegabyte = bytes(1 << 20)
+        for maximumTransferSize in [None, 16384, 65536]:
+            endPoint = FakeInputEndPoint(oneMegabyte, wMaxPacketSize=64)
+            port = fakeUSBPort(endPoint, maximumTransferSize=maximumTransferSize)
+            startTime = time.perf_counter()
+            for i in range(len(oneMegabyte) // 8192):
+                port.readData(8192)
+            duration = time.perf_counter() - startTime
+            print("\n1 MB with 64-byte packets, maximumTransferSize {0}: {1} endpoint reads in {2:.3f} s".format(maximumTransferSize, endPoint.readCount, duration))
+
+    def testBenchmarkOneMegabyte(self):
+        oneMegabyte = bytes(1 << 20)
+        readSize = 256
+
+        for packetSize in [512, 65536, 1 << 20]:
+            endPoint = FakeInputEndPoint(oneMegabyte, wMaxPacketSize=packetSize)
+            internalBuffer = bytearray()
+            startTime = time.perf_counter()
+            for i in range(len(oneMegabyte) // readSize):
+                data, internalBuffer = legacyUSBReadData(endPoint, internalBuffer, readSize)
+            legacyDuration = time.perf_counter() - startTime
+
+            port = fakeUSBPort(FakeInputEndPoint(oneMegabyte, wMaxPacketSize=packetSize))
+            startTime = time.perf_counter()
+            for i in range(len(oneMegabyte) // readSize):
+                data = port.readData(readSize)
+            ringDuration = time.perf_counter() - startTime
+            self.assertEqual(data, oneMegabyte[:readSize])
+
+            port = fakeUSBPort(FakeInputEndPoint(oneMegabyte, wMaxPacketSize=packetSize))
+            destination = np.zeros(len(oneMegabyte), dtype=np.uint8)
+            startTime = time.perf_counter()
+            port.readInto(destination)
+            readIntoDuration = time.perf_counter() - startTime
+
+            print("\n1 MB, {0}-byte packets, {1}-byte reads: legacy {2:.3f} s, ring buffer {3:.3f} s, single readInto {4:.3f} s".format(packetSize, readSize, legacyDuration, ringDuration, readIntoDuration))
+
+
+class TestUSBPortBackgroundReading(unittest.TestCase):
+    def setUp(self):
+        self.endPoint = DebugEndPoint(wMaxPacketSize=64, latency=0.0005)
+        self.port = fakeUSBPort(self.endPoint)
+        self.port.defaultTimeout = 200
+
+    def tearDown(self):
+        if self.port.isReadingInBackground:
+            self.port.stopBackgroundReading()
+
+    def waitForPackets(self, count, timeout=2):
+        endTime = time.time() + timeout
+        while self.port.backgroundStatistics()["packets"] < count and time.time() < endTime:
+            time.sleep(0.005)
+
+    def testStartStop(self):
+        self.assertFalse(self.port.isReadingInBackground)
+        self.port.startBackgroundReading()
+        self.assertTrue(self.port.isReadingInBackground)
+        with self.assertRaises(RuntimeError):
+            self.port.startBackgroundReading()
+        self.port.stopBackgroundReading()
+        self.assertFalse(self.port.isReadingInBackground)
+
+    def testReadDataFromBackgroundReader(self):
+        payload = bytes(range(256)) * 4
+        self.port.startBackgroundReading()
+        self.endPoint.feed(payload)
+        self.assertEqual(self.port.readData(len(payload)), payload)
+        self.assertEqual(self.port.backgroundStatistics()["packets"], 16)
+        self.assertEqual(self.port.backgroundStatistics()["bytes"], 1024)
+
+    def testReadStringFromBackgroundReader(self):
+        self.port.startBackgroundReading()
+        self.endPoint.feed(b'*VER 1.0\r\n*CVU 0.001\r\n')
+        self.assertEqual(self.port.readString(), '*VER 1.0\r\n')
+        self.assertEqual(self.port.readString(), '*CVU 0.001\r\n')
+
+    def testTimeoutWhenNothingArrives(self):
+        self.port.startBackgroundReading()
+        with self.assertRaises(CommunicationReadTimeout):
+            self.port.readData(1)
+
+    def testDropOldestPacketsWhenQueueIsFull(self):
+        self.port.startBackgroundReading(queueDepth=2, dropOldestPackets=True)
+        self.endPoint.feed(bytes(64 * 10))
+        self.waitForPackets(10)
+        time.sleep(0.1)
+        statistics = self.port.backgroundStatistics()
+        self.assertEqual(statistics["dropped"], 8)
+        self.assertEqual(statistics["queued"], 2)
+
+    def testLatePackets(self):
+        self.port.latePacketDelay = 0.01
+        self.port.startBackgroundReading()
+        self.endPoint.feed(bytes(64))
+        self.waitForPackets(1)
+        time.sleep(0.05)
+        self.port.readData(64)
+        self.assertEqual(self.port.backgroundStatistics()["late"], 1)
+        self.port.resetBackgroundStatistics()
+        self.assertEqual(self.port.backgroundStatistics()["late"], 0)
+
+    def testStopKeepsQueuedData(self):
+        self.port.startBackgroundReading()
+        self.endPoint.feed(b'abcd')
+        self.waitForPackets(1)
+        self.port.stopBackgroundReading()
+        self.assertEqual(self.port.readData(4), b'abcd')
+
+    def testRestartAfterReaderError(self):
+        failingEndPoint = DebugEndPoint(wMaxPacketSize=64)
+        read = failingEndPoint.read
+        def failingRead(size_or_buffer, timeout=None):
+            data = read(size_or_buffer, timeout)
+            if bytes(data) == b'fail':
+                raise usb.core.USBError("No such device")
+            return data
+        failingEndPoint.read = failingRead
+
+        self.port.startBackgroundReading(endPoint=failingEndPoint)
+        failingEndPoint.feed(b'abcd')
+        self.waitForPackets(1)
+        failingEndPoint.feed(b'fail')
+        self.port.backgroundReader.join(1)
+        self.assertFalse(self.port.isReadingInBackground)
+        self.assertIsInstance(self.port.backgroundError, usb.core.USBError)
+        self.assertEqual(self.port.readData(4), b'abcd')
+        with self.assertRaises(IOError):
+            self.port.readData(4)
+
+        self.port.startBackgroundReading()
+        self.assertTrue(self.port.isReadingInBackground)
+        self.endPoint.feed(b'wxyz')
+        self.assertEqual(self.port.readData(4), b'wxyz')
+
+    def testOtherEndPointIsDefaultWhileReadingInBackground(self):
+        otherEndPoint = DebugEndPoint(wMaxPacketSize=64, bEndpointAddress=0x82)
+        self.port.startBackgroundReading(endPoint=otherEndPoint)
+        otherEndPoint.feed(b'abcd')
+        self.endPoint.feed(b'wxyz')
+        self.assertEqual(self.port.readData(4), b'abcd')
+        self.port.stopBackgroundReading()
+        self.assertEqual(self.port.readData(4), b'wxyz')
+
+    def testBackgroundReadsUseMaximumTransferSize(self):
+        requestedSizes = []
+        read = self.endPoint.read
+        def recordingRead(size_or_buffer, timeout=None):
+            requestedSizes.append(size_or_buffer)
+            return read(size_or_buffer, timeout)
+        self.endPoint.read = recordingRead
+
+        self.port.maximumTransferSize = 64 * 8
+        self.port.startBackgroundReading()
+        self.endPoint.feed(b'abcd')
+        self.assertEqual(self.port.readData(4), b'abcd')
+        self.assertEqual(requestedSizes[0], 64 * 8)
+
+    def testBenchmarkBackgroundReadingWithProcessing(self):
+        nPackets = 100
+        self.endPoint.latency = 0.001
+
+        self.endPoint.feed(bytes(64 * nPackets))
+        startTime = time.perf_counter()
+        for i in range(nPackets):
+            self.port.readData(64)
+            time.sleep(0.001) # processing the packet
+        synchronousDuration = time.perf_counter() - startTime
+
+        self.endPoint.feed(bytes(64 * nPackets))
+        self.port.startBackgroundReading(queueDepth=16)
+        startTime = time.perf_counter()
+        for i in range(nPackets):
+            self.port.readData(64)
+            time.sleep(0.001)
+        backgroundDuration = time.perf_counter() - startTime
+
+        print("\n{0} packets with 1 ms latency and 1 ms processing: synchronous {1:.3f} s, background {2:.3f} s".format(nPackets, synchronousDuration, backgroundDuration))
+        self.assertTrue(backgroundDuration < synchronousDuration)
+
+
 class TestFTDIAdaptor(unittest.TestCase):
 
     # def testFindDevice(self):
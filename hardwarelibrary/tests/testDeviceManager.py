@@ -1,12 +1,15 @@
 import env
 import unittest
+import time
+from threading import Event
 
 from hardwarelibrary.communication.diagnostics import *
 from hardwarelibrary.devicemanager import DeviceManager, DeviceManagerNotification
 from hardwarelibrary.motion import DebugLinearMotionDevice, LinearMotionDevice
 from hardwarelibrary.motion import SutterDevice
 from hardwarelibrary.notificationcenter import NotificationCenter
-from hardwarelibrary.physicaldevice import PhysicalDevice
+from hardwarelibrary.physicaldevice import PhysicalDevice, DeviceState
+from hardwarelibrary.devicemanager import DebugPhysicalDevice
 
 
 class TestDeviceManager(unittest.TestCase):
@@ -255,5 +258,173 @@ class TestDeviceManager(unittest.TestCase):
             device[0].shutdownDevice()
 
 
+class DelayedDebugDevice(DebugPhysicalDevice):
+    """ Takes delay seconds to initialize and to shut down, and records the
+    order of the operations """
+    def __init__(self, name, delay=0.0, log=None):
+        super().__init__()
+        self.name = name
+        self.delay = delay
+        self.log = log if log is not None else []
+        self.initializationEvent = None
+
+    def doInitializeDevice(self):
+        if self.initializationEvent is not None:
+            self.initializationEvent.wait()
+        time.sleep(self.delay)
+        super().doInitializeDevice()
+        self.log.append(("initialize", self.name))
+
+    def doShutdownDevice(self):
+        time.sleep(self.delay)
+        super().doShutdownDevice()
+        self.log.append(("shutdown", self.name))
+
+    def __repr__(self):
+        return self.name
+
+class TestConcurrentOperations(unittest.TestCase):
+    def setUp(self):
+        DeviceManager().destroy()
+        self.manager = DeviceManager()
+        self.log = []
+
+    def tearDown(self):
+        for device in list(self.manager.devices):
+            self.manager.removeDevice(device)
+        self.manager.destroy()
+
+    def addDevices(self, delays):
+        devices = [ DelayedDebugDevice("device{0}".format(i), delay, self.log) for i, delay in enumerate(delays) ]
+        for device in devices:
+            self.manager.addDevice(device)
+        return devices
+
+    def testInitializeAll(self):
+        devices = self.addDevices([0.01] * 5)
+        self.manager.initializeDevices()
+        self.assertTrue(all([ device.state == DeviceState.Ready for device in devices ]))
+        self.manager.shutdownDevices()
+        self.assertTrue(all([ device.state == DeviceState.Recognized for device in devices ]))
+
+    def testWallTimeIsSlowestDevice(self):
+        delays = [0.2, 0.1, 0.1, 0.05, 0.05, 0.05, 0.02, 0.02]
+        devices = self.addDevices(delays)
+
+        startTime = time.perf_counter()
+        for device in devices:
+            device.initializeDevice()
+        serial = time.perf_counter() - startTime
+        for device in devices:
+            device.shutdownDevice()
+
+        startTime = time.perf_counter()
+        self.manager.initializeDevices()
+        concurrent = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        self.manager.shutdownDevices()
+        concurrentShutdown = time.perf_counter() - startTime
+
+        print("\n{0} delayed devices (slowest {1} s, sum {2:.2f} s): initialize one at a time {3:.3f} s, initializeDevices {4:.3f} s, shutdownDevices {5:.3f} s".format(
+              len(delays), max(delays), sum(delays), serial, concurrent, concurrentShutdown))
+        self.assertTrue(concurrent < max(delays) + 0.1)
+        self.assertTrue(concurrentShutdown < max(delays) + 0.1)
+        self.assertTrue(serial >= sum(delays))
+
+    def testBoundedPool(self):
+        self.manager.maximumConcurrentOperations = 2
+        self.addDevices([0.05] * 4)
+        startTime = time.perf_counter()
+        self.manager.initializeDevices()
+        self.assertTrue(time.perf_counter() - startTime >= 0.1)
+
+    def testAggregatedErrors(self):
+        devices = self.addDevices([0.01] * 4)
+        devices[1].errorInitialize = True
+        devices[3].errorInitialize = True
+        with self.assertRaises(DeviceManager.UnableToInitializeDevices) as context:
+            self.manager.initializeDevices()
+
+        errors = context.exception.errors
+        self.assertEqual(set(errors.keys()), {devices[1], devices[3]})
+        self.assertIsInstance(errors[devices[1]], PhysicalDevice.UnableToInitialize)
+        self.assertEqual(devices[0].state, DeviceState.Ready)
+        self.assertEqual(devices[2].state, DeviceState.Ready)
+
+    def testShutdownErrors(self):
+        devices = self.addDevices([0.0] * 2)
+        self.manager.initializeDevices()
+        devices[0].errorShutdown = True
+        with self.assertRaises(DeviceManager.UnableToShutdownDevices) as context:
+            self.manager.shutdownDevices()
+        self.assertEqual(list(context.exception.errors.keys()), [devices[0]])
+        self.assertEqual(devices[1].state, DeviceState.Recognized)
+
+    def testTimeout(self):
+        devices = self.addDevices([0.0] * 3)
+        devices[0].initializationEvent = Event()
+        startTime = time.perf_counter()
+        with self.assertRaises(DeviceManager.UnableToInitializeDevices) as context:
+            self.manager.initializeDevices(timeout=0.1)
+        self.assertTrue(time.perf_counter() - startTime < 0.5)
+        self.assertIsInstance(context.exception.errors[devices[0]], TimeoutError)
+        self.assertEqual(len(context.exception.errors), 1)
+        devices[0].initializationEvent.set()
+
+    def testNoOperationWhileTimedOutOperationRuns(self):
+        device, other = self.addDevices([0.0, 0.0])
+        device.initializationEvent = Event()
+        with self.assertRaises(DeviceManager.UnableToInitializeDevices):
+            self.manager.initializeDevices(timeout=0.1)
+        self.assertIn(device, self.manager.busyDevices)
+
+        with self.assertRaises(DeviceManager.UnableToShutdownDevices) as context:
+            self.manager.shutdownDevices()
+        self.assertEqual(list(context.exception.errors.keys()), [device])
+        self.assertIsInstance(context.exception.errors[device], DeviceManager.DeviceBusy)
+        self.assertNotIn(("shutdown", "device0"), self.log)
+
+        device.initializationEvent.set()
+        endTime = time.time() + 1
+        while device in self.manager.busyDevices and time.time() < endTime:
+            time.sleep(0.01)
+        self.assertNotIn(device, self.manager.busyDevices)
+        self.manager.shutdownDevices()
+        self.assertEqual(self.log[-1], ("shutdown", "device0"))
+
+    def testDependencies(self):
+        controller, stage1, stage2 = self.addDevices([0.05, 0.0, 0.0])
+        dependencies = {stage1: [controller], stage2: [controller]}
+        self.manager.initializeDevices(dependencies=dependencies)
+        self.assertEqual(self.log[0], ("initialize", "device0"))
+
+        self.manager.shutdownDevices(dependencies=dependencies)
+        self.assertEqual(self.log[-1], ("shutdown", "device0"))
+
+    def testFailedDependency(self):
+        controller, stage = self.addDevices([0.0, 0.0])
+        controller.errorInitialize = True
+        with self.assertRaises(DeviceManager.UnableToInitializeDevices) as context:
+            self.manager.initializeDevices(dependencies={stage: [controller]})
+        self.assertIsInstance(context.exception.errors[stage], DeviceManager.PrerequisiteFailed)
+        self.assertEqual(stage.state, DeviceState.Unconfigured)
+
+    def testCircularDependency(self):
+        first, second = self.addDevices([0.0, 0.0])
+        with self.assertRaises(DeviceManager.UnableToInitializeDevices) as context:
+            self.manager.initializeDevices(dependencies={first: [second], second: [first]})
+        self.assertEqual(len(context.exception.errors), 2)
+
+    def testRemoveAllDevices(self):
+        devices = self.addDevices([0.1] * 4)
+        self.manager.initializeDevices()
+        startTime = time.perf_counter()
+        self.manager.removeAllDevices()
+        self.assertTrue(time.perf_counter() - startTime < 0.3)
+        self.assertEqual(len(self.manager.devices), 0)
+        self.assertTrue(all([ device.state == DeviceState.Recognized for device in devices ]))
+
+
 if __name__ == '__main__':
     unittest.main()
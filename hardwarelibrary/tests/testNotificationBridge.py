@@ -0,0 +1,269 @@
+import env
+import unittest
+import os
+import sys
+import time
+import subprocess
+from threading import Event
+import numpy as np
+
+from hardwarelibrary.notificationcenter import NotificationCenter
+from hardwarelibrary.notificationbridge import NotificationBridge, RemoteNotificationCenter, RemoteObject, SharedArray
+from hardwarelibrary.physicaldevice import PhysicalDeviceNotification
+from hardwarelibrary.motion.linearmotiondevice import LinearMotionNotification
+
+class Device:
+    def __str__(self):
+        return "Test device"
+
+class DeviceWithState:
+    def __init__(self):
+        self.position = 0
+
+    def __str__(self):
+        return "Stage at {0}".format(self.position)
+
+# A process that observes the status notifications of the bridge given as
+# arguments (address and authkey) and prints what it receives
+remoteObserverScript = """
+import sys
+from threading import Event
+from hardwarelibrary.notificationbridge import RemoteNotificationCenter
+from hardwarelibrary.physicaldevice import PhysicalDeviceNotification
+
+received = []
+done = Event()
+def handle(notification):
+    received.append(notification)
+    if len(received) == 2:
+        done.set()
+
+center = RemoteNotificationCenter(sys.argv[1], bytes.fromhex(sys.argv[2]))
+center.addObserver(None, handle, PhysicalDeviceNotification.status)
+center.synchronize()
+print("ready", flush=True)
+done.wait(10)
+frame = received[0].userInfo["frame"]
+print(type(frame).__name__, frame.shape, int(frame.sum()), received[0].userInfo["index"])
+print(received[0].object.className, received[0].object is received[1].object, flush=True)
+center.close()
+"""
+
+class TestNotificationBridge(unittest.TestCase):
+    def setUp(self):
+        self.bridge = NotificationBridge(notificationNames=[PhysicalDeviceNotification.status])
+        self.bridge.start()
+        self.device = Device()
+        self.received = []
+        self.receivedEvent = Event()
+
+    def tearDown(self):
+        self.bridge.stop()
+        NotificationCenter().clear()
+
+    def handle(self, notification):
+        self.received.append(notification)
+        self.receivedEvent.set()
+
+    def remoteCenter(self):
+        """ A client in this process: notifications it receives are posted to
+        the same NotificationCenter, with a RemoteObject as the object """
+        center = RemoteNotificationCenter(self.bridge.address, self.bridge.authkey)
+        center.addObserver(self, self.handle, PhysicalDeviceNotification.status, observedObject=None)
+        self.assertTrue(center.synchronize())
+        return center
+
+    def remoteNotifications(self):
+        return [ notification for notification in self.received if isinstance(notification.object, RemoteObject) ]
+
+    def testForwardedOnce(self):
+        center = self.remoteCenter()
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"temperature": 20.5})
+        self.assertTrue(NotificationCenter().waitUntilDelivered(1))
+        while len(self.remoteNotifications()) == 0:
+            self.assertTrue(self.receivedEvent.wait(1))
+            self.receivedEvent.clear()
+        time.sleep(0.1)
+        center.close()
+
+        # The local post and the one received from the bridge, not relayed again
+        self.assertEqual(len(self.received), 2)
+        remote = self.remoteNotifications()[0]
+        self.assertEqual(remote.userInfo, {"temperature": 20.5})
+        self.assertEqual(remote.object.identifier, id(self.device))
+        self.assertEqual(remote.object.description, "Test device")
+
+    def testOnlySelectedNames(self):
+        center = self.remoteCenter()
+        center.addObserver(self, self.handle, LinearMotionNotification.didMove)
+        self.assertTrue(center.synchronize())
+        NotificationCenter().postNotification(LinearMotionNotification.didMove, self.device)
+        NotificationCenter().waitUntilDelivered(1)
+        self.assertTrue(center.synchronize())
+        center.close()
+        self.assertEqual(len(self.remoteNotifications()), 0)
+        self.assertEqual(self.bridge.sentCount, 0)
+
+    def testNotSentWithoutSubscribers(self):
+        center = self.remoteCenter()
+        center.removeObserver(self)
+        self.assertEqual(center.subscriptions, {})
+        self.assertTrue(center.synchronize())
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, np.zeros(100000))
+        NotificationCenter().waitUntilDelivered(1)
+        center.close()
+        self.assertEqual(self.bridge.sentCount, 0)
+        self.assertEqual(self.bridge.sharedBytes, 0)
+
+    def testLargeArrayThroughSharedMemory(self):
+        center = self.remoteCenter()
+        frame = np.arange(480*640, dtype=np.uint16).reshape(480, 640)
+        small = np.arange(10)
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"frame": frame, "small": small})
+        while len(self.remoteNotifications()) == 0:
+            self.assertTrue(self.receivedEvent.wait(1))
+            self.receivedEvent.clear()
+        self.assertTrue(center.synchronize())
+        center.close()
+
+        userInfo = self.remoteNotifications()[0].userInfo
+        self.assertTrue(np.array_equal(userInfo["frame"], frame))
+        self.assertEqual(userInfo["frame"].dtype, frame.dtype)
+        self.assertTrue(np.array_equal(userInfo["small"], small))
+        self.assertEqual(self.bridge.sharedBytes, frame.nbytes)
+        # Copied out and released by the client: unlinked
+        self.assertEqual(self.bridge.sharedBlocks, {})
+
+    def testEncodeKeepsStructure(self):
+        sharedNames = []
+        encoded = self.bridge.encode({"frames": [np.zeros(100000), np.zeros(3)], "position": (1, 2)}, sharedNames)
+        try:
+            self.assertIsInstance(encoded["frames"][0], SharedArray)
+            self.assertIsInstance(encoded["frames"][1], np.ndarray)
+            self.assertEqual(encoded["position"], (1, 2))
+            self.assertEqual(len(sharedNames), 1)
+        finally:
+            for name in sharedNames:
+                self.bridge.releaseSharedBlock(name)
+        self.assertEqual(self.bridge.sharedBlocks, {})
+
+    def testUnpicklableUserInfo(self):
+        center = self.remoteCenter()
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"callback": lambda x: x})
+        while len(self.remoteNotifications()) == 0:
+            self.assertTrue(self.receivedEvent.wait(1))
+            self.receivedEvent.clear()
+        center.close()
+        self.assertIsInstance(self.remoteNotifications()[0].userInfo, str)
+
+    def testUnpicklableUserInfoReleasesSharedMemory(self):
+        center = self.remoteCenter()
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"frame": np.zeros(100000), "callback": lambda x: x})
+        while len(self.remoteNotifications()) == 0:
+            self.assertTrue(self.receivedEvent.wait(1))
+            self.receivedEvent.clear()
+        center.close()
+        self.assertEqual(self.bridge.sharedBytes, 100000*8)
+        self.assertEqual(self.bridge.sharedBlocks, {})
+
+    def testWrongAuthkey(self):
+        with self.assertRaises(Exception):
+            RemoteNotificationCenter(self.bridge.address, b"wrong")
+
+    def testRemoteObjects(self):
+        center = self.remoteCenter()
+        center.close()
+        first = center.remoteObject(RemoteObject(1, "Device", "Test device"))
+        self.assertIs(center.remoteObject(RemoteObject(1, "Device", "Test device")), first)
+        # id() reused in the other process by another object
+        other = center.remoteObject(RemoteObject(1, "Spectrometer", "USB2000"))
+        self.assertEqual(other.className, "Spectrometer")
+        renamed = center.remoteObject(RemoteObject(1, "Device", "Other device"))
+        self.assertIs(renamed, first)
+        self.assertEqual(renamed.description, "Other device")
+
+        center.maximumRemoteObjects = 10
+        observer = Device()
+        center.addObserver(observer, self.handle, PhysicalDeviceNotification.status, observedObject=first)
+        for identifier in range(100, 200):
+            center.remoteObject(RemoteObject(identifier, "Device", "Test device"))
+        self.assertEqual(len(center.remoteObjects), 10)
+        # Observed: never evicted
+        self.assertIs(center.remoteObject(RemoteObject(1, "Device", "Test device")), first)
+
+    def testObservedRemoteObjectWithChangingDescription(self):
+        center = self.remoteCenter()
+        device = DeviceWithState()
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, device, 0)
+        while len(self.remoteNotifications()) == 0:
+            self.assertTrue(self.receivedEvent.wait(1))
+            self.receivedEvent.clear()
+        remoteDevice = self.remoteNotifications()[0].object
+        self.assertEqual(remoteDevice.description, "Stage at 0")
+
+        observer = Device()
+        observedNotifications = []
+        observed = Event()
+        def handleObserved(notification):
+            observedNotifications.append(notification)
+            observed.set()
+        center.addObserver(observer, handleObserved, PhysicalDeviceNotification.status, observedObject=remoteDevice)
+        self.assertTrue(center.synchronize())
+
+        device.position = 10
+        NotificationCenter().postNotification(PhysicalDeviceNotification.status, device, 10)
+        self.assertTrue(observed.wait(1))
+        center.close()
+        self.assertIs(observedNotifications[0].object, remoteDevice)
+        self.assertEqual(remoteDevice.description, "Stage at 10")
+
+    def testSubprocessObserver(self):
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join([env.root, environment.get("PYTHONPATH", "")])
+        process = subprocess.Popen([sys.executable, "-c", remoteObserverScript, self.bridge.address, self.bridge.authkey.hex()],
+                                   stdout=subprocess.PIPE, env=environment, text=True)
+        try:
+            self.assertEqual(process.stdout.readline().strip(), "ready")
+            frame = np.ones((1024, 1024), dtype=np.uint8)
+            for index in range(2):
+                NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"frame": frame, "index": index})
+            lines = process.stdout.read().splitlines()
+            self.assertEqual(process.wait(10), 0)
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+
+        self.assertEqual(lines[0], "ndarray (1024, 1024) {0} 0".format(1024*1024))
+        self.assertEqual(lines[1], "Device True")
+        # The releases sent by the process before exiting may still be in transit
+        timeout = time.time() + 1
+        while self.bridge.sharedBlocks and time.time() < timeout:
+            time.sleep(0.01)
+        self.assertEqual(self.bridge.sentCount, 2)
+        self.assertEqual(self.bridge.sharedBlocks, {})
+
+    def bridgedFrameDuration(self, frame, nFrames):
+        self.received = []
+        startTime = time.perf_counter()
+        for i in range(nFrames):
+            self.receivedEvent.clear()
+            NotificationCenter().postNotification(PhysicalDeviceNotification.status, self.device, {"frame": frame})
+            while len(self.remoteNotifications()) <= i:
+                self.assertTrue(self.receivedEvent.wait(1))
+                self.receivedEvent.clear()
+        return (time.perf_counter() - startTime) / nFrames
+
+    def testBenchmarkSharedMemory(self):
+        center = self.remoteCenter()
+        frame = np.zeros((2048, 2048), dtype=np.uint16)
+        nFrames = 20
+
+        sharedMemory = self.bridgedFrameDuration(frame, nFrames)
+        self.bridge.sharedMemoryThreshold = float("inf")
+        pickled = self.bridgedFrameDuration(frame, nFrames)
+        center.close()
+        print("\n8 MB frame through the bridge: pickled {0:.2f} ms, shared memory {1:.2f} ms".format(pickled*1e3, sharedMemory*1e3))
+
+if __name__ == '__main__':
+    unittest.main()
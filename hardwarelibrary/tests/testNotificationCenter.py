@@ -1,8 +1,16 @@
 import env
 import unittest
+import time
+import asyncio
+import gc
+import weakref
+import functools
+import tracemalloc
+from threading import Thread, Event, current_thread
 from enum import Enum
 
-from hardwarelibrary.notificationcenter import NotificationCenter, ObserverInfo
+from hardwarelibrary.notificationcenter import NotificationCenter, ObserverInfo, OverflowPolicy, Notification
+import hardwarelibrary.notificationcenter as notificationcenter
 
 
 class TestNotificationName(Enum):
@@ -146,9 +154,479 @@ class TestNotificationCenter(unittest.TestCase):
         nc.removeObserver(self, observedObject=someObject)
         self.assertEqual(nc.observersCount(), 0)
 
+    def testOnlyObservedObjectIsDelivered(self):
+        nc = NotificationCenter()
+        devices = [ Observer() for i in range(3) ]
+        observers = [ Observer() for i in range(3) ]
+        for device, observer in zip(devices, observers):
+            nc.addObserver(observer, observer.handle, TestNotificationName.test, device)
+        anyObserver = Observer()
+        nc.addObserver(anyObserver, anyObserver.handle, TestNotificationName.test)
+
+        nc.postNotification(TestNotificationName.test, devices[1])
+        self.assertEqual([ len(observer.received) for observer in observers ], [0, 1, 0])
+        self.assertEqual(len(anyObserver.received), 1)
+        self.assertIs(observers[1].received[0].object, devices[1])
+
+    def testRemoveSpecificObjectKeepsOthers(self):
+        nc = NotificationCenter()
+        device1, device2 = Observer(), Observer()
+        nc.addObserver(self, self.handle, TestNotificationName.test, device1)
+        nc.addObserver(self, self.handle, TestNotificationName.test2, device2)
+        nc.removeObserver(self, observedObject=device1)
+        self.assertEqual(nc.observersCount(), 1)
+        nc.postNotification(TestNotificationName.test2, device2)
+        self.assertTrue(self.notificationReceived)
+
+    def testRemoveUnknownNotificationName(self):
+        nc = NotificationCenter()
+        nc.addObserver(self, self.handle, TestNotificationName.test)
+        nc.removeObserver(self, notificationName=TestNotificationName.other)
+        self.assertEqual(nc.observersCount(), 1)
+
+    def testObserverCanRemoveItselfWhileNotified(self):
+        nc = NotificationCenter()
+        def handleOnce(notification):
+            self.handle(notification)
+            nc.removeObserver(self)
+        nc.addObserver(self, handleOnce, TestNotificationName.test)
+        nc.postNotification(TestNotificationName.test, None)
+        self.assertTrue(self.notificationReceived)
+        self.assertEqual(nc.observersCount(), 0)
+
+    def testBenchmark10kObservers(self):
+        nc = NotificationCenter()
+        nObservers = 10000
+        devices = [ Observer() for i in range(nObservers) ]
+        observers = [ Observer() for i in range(nObservers) ]
+
+        startTime = time.perf_counter()
+        for device, observer in zip(devices, observers):
+            nc.addObserver(observer, observer.handle, TestNotificationName.test, device)
+            nc.addObserver(observer, observer.handle, TestNotificationName.test2, device)
+        addDuration = time.perf_counter() - startTime
+        self.assertEqual(nc.observersCount(), 2*nObservers)
+
+        startTime = time.perf_counter()
+        for device in devices:
+            nc.postNotification(TestNotificationName.test, device)
+        postDuration = time.perf_counter() - startTime
+        self.assertTrue(all([ len(observer.received) == 1 for observer in observers ]))
+
+        startTime = time.perf_counter()
+        for observer in observers:
+            nc.removeObserver(observer)
+        removeDuration = time.perf_counter() - startTime
+        self.assertEqual(nc.observersCount(), 0)
+
+        print("\n{0} observers: add {1:.1f} µs, post {2:.1f} µs, remove {3:.1f} µs".format(nObservers,
+              addDuration/(2*nObservers)*1e6, postDuration/nObservers*1e6, removeDuration/nObservers*1e6))
+        self.assertTrue(postDuration < 1.0)
+
     def handle(self, notification):
         self.notificationReceived = True
         self.postedUserInfo = notification.userInfo
 
+class Observer:
+    def __init__(self):
+        self.received = []
+
+    def handle(self, notification):
+        self.received.append(notification)
+
+class BlockingObserver(Observer):
+    """ Waits in its first notification until release() """
+    def __init__(self):
+        super().__init__()
+        self.started = Event()
+        self.released = Event()
+        self.threads = set()
+
+    def handle(self, notification):
+        self.threads.add(current_thread())
+        self.started.set()
+        self.released.wait(5)
+        self.received.append(notification)
+
+    def release(self):
+        self.released.set()
+
+class TestAsynchronousDelivery(unittest.TestCase):
+    def setUp(self):
+        self.nc = NotificationCenter()
+
+    def tearDown(self):
+        self.nc.clear()
+
+    def post(self, values, notifyingObject=None, name=TestNotificationName.test):
+        for value in values:
+            self.nc.postNotification(name, notifyingObject, userInfo=value)
+
+    def testDeliveredOnAnotherThread(self):
+        observer = BlockingObserver()
+        observer.release()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True)
+        self.post(range(10))
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual([ n.userInfo for n in observer.received ], list(range(10)))
+        self.assertNotIn(current_thread(), observer.threads)
+
+    def testSynchronousObserversUnchanged(self):
+        observer = Observer()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test)
+        self.post([1])
+        self.assertEqual(len(observer.received), 1)
+        self.assertIsNone(self.nc.deliveryThread)
+
+    def testDropOldest(self):
+        observer = BlockingObserver()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True,
+                            overflowPolicy=OverflowPolicy.dropOldest, queueSize=5)
+        self.post([0])
+        self.assertTrue(observer.started.wait(1))
+        self.post(range(1, 20))
+        self.assertEqual(self.nc.deliveryStatistics()["depth"], 5)
+        self.assertEqual(self.nc.deliveryStatistics()["dropped"], 14)
+        observer.release()
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual([ n.userInfo for n in observer.received ], [0, 15, 16, 17, 18, 19])
+
+    def testCoalesceLatestPerObject(self):
+        observer = BlockingObserver()
+        device1, device2 = Observer(), Observer()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True,
+                            overflowPolicy=OverflowPolicy.coalesce)
+        self.post([0], device1)
+        self.assertTrue(observer.started.wait(1))
+        for i in range(1, 100):
+            self.post([i], device1)
+            self.post([-i], device2)
+        self.assertEqual(self.nc.deliveryStatistics()["depth"], 2)
+        observer.release()
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual([ (n.object, n.userInfo) for n in observer.received ], [(device1, 0), (device1, 99), (device2, -99)])
+
+    def testBlockWaitsForRoom(self):
+        observer = BlockingObserver()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True,
+                            overflowPolicy=OverflowPolicy.block, queueSize=2)
+        poster = Thread(target=self.post, args=(range(5),))
+        poster.start()
+        self.assertTrue(observer.started.wait(1))
+        poster.join(0.1)
+        self.assertTrue(poster.is_alive())
+        observer.release()
+        poster.join(1)
+        self.assertFalse(poster.is_alive())
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual([ n.userInfo for n in observer.received ], list(range(5)))
+        self.assertEqual(self.nc.deliveryStatistics()["dropped"], 0)
+
+    def testRemoveObserverDiscardsPending(self):
+        observer = BlockingObserver()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True)
+        self.post(range(10))
+        self.assertTrue(observer.started.wait(1))
+        self.nc.removeObserver(observer)
+        observer.release()
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual(len(observer.received), 1)
+
+    def testSlowObserverDoesNotBlockOthers(self):
+        slowObserver = BlockingObserver()
+        fastObserver = Observer()
+        self.nc.addObserver(slowObserver, slowObserver.handle, TestNotificationName.test, asynchronous=True)
+        self.nc.addObserver(fastObserver, fastObserver.handle, TestNotificationName.test)
+        startTime = time.perf_counter()
+        self.post(range(100))
+        self.assertTrue(time.perf_counter() - startTime < 1)
+        self.assertEqual(len(fastObserver.received), 100)
+        slowObserver.release()
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+        self.assertEqual(len(slowObserver.received), 100)
+
+    def testDeliveryOnAsyncioLoop(self):
+        async def receive():
+            loop = asyncio.get_running_loop()
+            received = asyncio.Queue()
+            self.nc.addObserver(self, received.put_nowait, TestNotificationName.test, loop=loop)
+            await loop.run_in_executor(None, self.post, [1, 2, 3])
+            return [ (await received.get()).userInfo for i in range(3) ]
+
+        self.assertEqual(asyncio.run(receive()), [1, 2, 3])
+
+    def testBenchmarkPosterWithSlowObserver(self):
+        def slowHandle(notification):
+            time.sleep(0.001)
+
+        nPosts = 200
+        self.nc.addObserver(self, slowHandle, TestNotificationName.test)
+        startTime = time.perf_counter()
+        self.post(range(nPosts))
+        synchronousDuration = time.perf_counter() - startTime
+        self.nc.removeObserver(self)
+
+        self.nc.addObserver(self, slowHandle, TestNotificationName.test, asynchronous=True, overflowPolicy=OverflowPolicy.dropOldest)
+        startTime = time.perf_counter()
+        self.post(range(nPosts))
+        asynchronousDuration = time.perf_counter() - startTime
+
+        print("\nPosting to a 1 ms observer: synchronous {0:.1f} µs/post, asynchronous {1:.1f} µs/post".format(synchronousDuration/nPosts*1e6, asynchronousDuration/nPosts*1e6))
+        self.assertTrue(asynchronousDuration < synchronousDuration)
+
+class TestCoalescingAndRateLimiting(unittest.TestCase):
+    def setUp(self):
+        self.nc = NotificationCenter()
+        self.originalNotification = notificationcenter.Notification
+        self.notificationsCreated = 0
+
+        test = self
+        class CountingNotification(notificationcenter.Notification):
+            def __init__(self, *args, **kwargs):
+                test.notificationsCreated += 1
+                super().__init__(*args, **kwargs)
+        notificationcenter.Notification = CountingNotification
+
+    def tearDown(self):
+        notificationcenter.Notification = self.originalNotification
+        self.nc.clear()
+
+    def testInvalidMaxRate(self):
+        with self.assertRaises(ValueError):
+            self.nc.addObserver(self, print, TestNotificationName.test, maxRate=0)
+
+    def testMaxRateImpliesCoalesce(self):
+        observer = Observer()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, maxRate=30)
+        delivery = self.nc.matchingObservers(TestNotificationName.test, None)[0].delivery
+        self.assertEqual(delivery.overflowPolicy, OverflowPolicy.coalesce)
+        self.assertAlmostEqual(delivery.minimumInterval, 1/30)
+
+    def testLatestValuePerObjectAtMaxRate(self):
+        observer = Observer()
+        device1, device2 = Observer(), Observer()
+        maxRate = 20
+        duration = 0.5
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, maxRate=maxRate)
+
+        nPosts = 0
+        startTime = time.perf_counter()
+        while time.perf_counter() < startTime + duration:
+            self.nc.postNotification(TestNotificationName.test, device1, userInfo=nPosts)
+            self.nc.postNotification(TestNotificationName.test, device2, userInfo=-nPosts)
+            nPosts += 1
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+
+        self.assertTrue(len(observer.received) <= 2 * (duration * maxRate + 2))
+        self.assertTrue(len(observer.received) >= 4)
+        lastFromDevice1 = [ n.userInfo for n in observer.received if n.object is device1 ][-1]
+        lastFromDevice2 = [ n.userInfo for n in observer.received if n.object is device2 ][-1]
+        self.assertEqual(lastFromDevice1, nPosts - 1)
+        self.assertEqual(lastFromDevice2, -(nPosts - 1))
+
+    def testStaleNotificationsAreNeverCreated(self):
+        observer = BlockingObserver()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, coalesce=True)
+        self.nc.postNotification(TestNotificationName.test, None, userInfo=0)
+        self.assertTrue(observer.started.wait(1))
+        for i in range(1000):
+            self.nc.postNotification(TestNotificationName.test, None, userInfo=i)
+        observer.release()
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+
+        self.assertEqual([ n.userInfo for n in observer.received ], [0, 999])
+        self.assertEqual(self.notificationsCreated, 2)
+        self.assertEqual(self.nc.deliveryStatistics()["dropped"], 999)
+
+    def testNoObserverCreatesNoNotification(self):
+        self.nc.postNotification(TestNotificationName.test, None)
+        self.assertEqual(self.notificationsCreated, 0)
+
+    def testBenchmarkMillionPosts(self):
+        def slowDisplay(notification):
+            time.sleep(0.001)
+
+        nSynchronous = 1000
+        self.nc.addObserver(self, slowDisplay, TestNotificationName.test)
+        startTime = time.perf_counter()
+        for i in range(nSynchronous):
+            self.nc.postNotification(TestNotificationName.test, self, userInfo=i)
+        synchronousDuration = (time.perf_counter() - startTime) / nSynchronous
+        self.nc.removeObserver(self)
+
+        observer = Observer()
+        observer.handle = lambda notification: (time.sleep(0.001), observer.received.append(notification))
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, maxRate=30)
+        self.notificationsCreated = 0
+        nPosts = 1000000
+        startTime = time.perf_counter()
+        for i in range(nPosts):
+            self.nc.postNotification(TestNotificationName.test, self, userInfo=i)
+        duration = time.perf_counter() - startTime
+        self.assertTrue(self.nc.waitUntilDelivered(timeout=1))
+
+        print("\n{0} posts to a 1 ms display at maxRate=30: {1:.2f} s ({2:.1f} µs/post), {3} delivered, {4} Notification objects; synchronous: {5:.0f} µs/post".format(
+              nPosts, duration, duration/nPosts*1e6, len(observer.received), self.notificationsCreated, synchronousDuration*1e6))
+        self.assertEqual(observer.received[-1].userInfo, nPosts - 1)
+        self.assertTrue(len(observer.received) < nPosts / 100)
+        self.assertEqual(self.notificationsCreated, len(observer.received))
+        self.assertTrue(duration / nPosts < synchronousDuration)
+
+class TestWeakObservers(unittest.TestCase):
+    def setUp(self):
+        self.nc = NotificationCenter()
+
+    def tearDown(self):
+        self.nc.clear()
+
+    def testDeletedObserverIsRemoved(self):
+        observer = Observer()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test)
+        self.assertEqual(self.nc.observersCount(), 1)
+        del observer
+        self.assertEqual(self.nc.observersCount(), 0)
+        self.nc.postNotification(TestNotificationName.test, None)
+        self.assertEqual(self.nc.observers[TestNotificationName.test], {})
+
+    def testCenterDoesNotKeepObserverAlive(self):
+        observer = Observer()
+        reference = weakref.ref(observer)
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, asynchronous=True)
+        del observer
+        self.assertIsNone(reference())
+
+    def testDeletedObservedObjectIsForgotten(self):
+        observer = Observer()
+        device = Observer()
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test, device)
+        self.nc.addObserver(observer, observer.handle, TestNotificationName.test2)
+        del device
+        self.assertEqual(self.nc.observersCount(), 1)
+        self.nc.postNotification(TestNotificationName.test, Observer())
+        self.assertEqual(len(observer.received), 0)
+
+    def testFunctionsAreKept(self):
+        received = []
+        self.nc.addObserver(self, lambda notification: received.append(notification), TestNotificationName.test)
+        gc.collect()
+        self.nc.postNotification(TestNotificationName.test, None)
+        self.assertEqual(len(received), 1)
+
+    def testMethodOfAnotherObjectIsKept(self):
+        other = Observer()
+        self.nc.addObserver(self, other.handle, TestNotificationName.test)
+        del other
+        gc.collect()
+        self.assertEqual(self.nc.observersCount(), 1)
+
+    def addObserverWithClosure(self, observer):
+        # In its own scope: del in the test does not empty the closure cell
+        self.nc.addObserver(observer, lambda notification: observer.handle(notification), TestNotificationName.test)
+
+    def testClosureDoesNotKeepObserverAlive(self):
+        observer = Observer()
+        reference = weakref.ref(observer)
+        self.addObserverWithClosure(observer)
+        gc.collect()
+        self.nc.postNotification(TestNotificationName.test, None)
+        self.assertEqual(len(observer.received), 1)
+
+        del observer
+        gc.collect()
+        self.assertIsNone(reference())
+        self.assertEqual(self.nc.observersCount(), 0)
+
+    def testPartialDoesNotKeepObserverAlive(self):
+        observer = Observer()
+        reference = weakref.ref(observer)
+        self.nc.addObserver(observer, functools.partial(Observer.handle, observer), TestNotificationName.test, asynchronous=True)
+        self.nc.postNotification(TestNotificationName.test, None)
+        self.assertTrue(self.nc.waitUntilDelivered(1))
+        self.assertEqual(len(observer.received), 1)
+
+        del observer
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def testRemoveObserverReleasesClosure(self):
+        observer = Observer()
+        self.addObserverWithClosure(observer)
+        self.nc.removeObserver(observer)
+        self.assertEqual(observer.__dict__[ObserverInfo.keptMethodsAttribute], [])
+
+    def testObjectsWithoutWeakReferences(self):
+        received = []
+        observer = {"name": "not weakly referenceable"}
+        self.nc.addObserver(observer, received.append, TestNotificationName.test, observedObject=1234)
+        self.nc.postNotification(TestNotificationName.test, 1234)
+        self.assertEqual(len(received), 1)
+        self.nc.removeObserver(observer)
+        self.assertEqual(self.nc.observersCount(), 0)
+
+    def testSlots(self):
+        self.assertFalse(hasattr(Notification(TestNotificationName.test), '__dict__'))
+        self.assertFalse(hasattr(ObserverInfo(self, self.setUp), '__dict__'))
+
+    def testPostWithoutObserversDoesNotAllocate(self):
+        device = Observer()
+        for i in range(1000):
+            self.nc.postNotification(TestNotificationName.test, device, userInfo=i)
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            for i in range(100000):
+                self.nc.postNotification(TestNotificationName.test, device, userInfo=i)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        growth = sum([ stat.size_diff for stat in after.compare_to(before, 'filename') if 'notificationcenter' in str(stat.traceback) ])
+        self.assertTrue(growth < 1024)
+
+    def testFlatFootprintOver24SimulatedHours(self):
+        """ 4 devices posting their status every simulated second, a
+        permanent observer, and a transient observer every simulated minute
+        that is never removed: the memory must not grow from hour to hour. """
+        self.assertFlatFootprint(lambda transient: transient.handle)
+
+    def testFlatFootprintWithClosures(self):
+        """ Same, with transient observers registered with a closure that
+        refers to them """
+        self.assertFlatFootprint(lambda transient: (lambda notification: transient.handle(notification)))
+
+    def assertFlatFootprint(self, transientMethod):
+        devices = [ Observer() for i in range(4) ]
+        counter = Observer()
+        counter.count = 0
+        def count(notification):
+            counter.count += 1
+        self.nc.addObserver(counter, count, TestNotificationName.test)
+
+        def simulateHour(hour):
+            for second in range(3600):
+                if second % 60 == 0:
+                    transient = Observer()
+                    self.nc.addObserver(transient, transientMethod(transient), TestNotificationName.test, observedObject=devices[0])
+                for device in devices:
+                    self.nc.postNotification(TestNotificationName.test, device, userInfo=(hour, second))
+
+        simulateHour(0)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            memory = []
+            for hour in range(1, 24):
+                simulateHour(hour)
+                gc.collect()
+                memory.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+
+        print("\n24 simulated hours, {0} posts: traced memory after hour 1: {1} bytes, after hour 23: {2} bytes".format(counter.count, memory[0], memory[-1]))
+        self.assertEqual(counter.count, 24 * 3600 * len(devices))
+        self.assertTrue(self.nc.observersCount() <= 2)
+        self.assertTrue(memory[-1] - memory[0] < 16384)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,387 @@
+import env
+import unittest
+import time
+import threading
+from threading import Event
+
+from hardwarelibrary.pollingscheduler import PollingScheduler, PollingTask
+from hardwarelibrary.notificationcenter import NotificationCenter
+from hardwarelibrary.physicaldevice import PhysicalDeviceNotification
+from hardwarelibrary.devicemanager import DebugPhysicalDevice
+from hardwarelibrary.motion import DebugLinearMotionDevice
+from hardwarelibrary.sources import LaserSourceDevice
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, duration):
+        self.now += duration
+
+class TestPollingSchedulerFakeClock(unittest.TestCase):
+    def setUp(self):
+        PollingScheduler().destroy()
+        self.clock = FakeClock()
+        self.scheduler = PollingScheduler()
+        self.scheduler.clock = self.clock
+        self.scheduler.startsAutomatically = False
+        self.polls = []
+
+    def tearDown(self):
+        PollingScheduler().destroy()
+
+    def poll(self):
+        self.polls.append(self.clock())
+
+    def testSingleton(self):
+        self.assertIs(PollingScheduler(), self.scheduler)
+        self.assertFalse(self.scheduler.isRunning)
+
+    def testPolledOnGrid(self):
+        task = self.scheduler.schedule(self.poll, interval=1.0)
+        self.assertEqual(self.scheduler.runPending(), 1)
+        self.clock.advance(0.5)
+        self.assertEqual(self.scheduler.runPending(), 0)
+        self.clock.advance(0.7)
+        self.assertEqual(self.scheduler.runPending(), 1)
+        self.assertEqual(task.deadline, 2.0) # not 2.2: late polls do not drift
+        self.clock.advance(0.8)
+        self.scheduler.runPending()
+        self.assertEqual(self.polls, [0.0, 1.2, 2.0])
+        statistics = task.statistics()
+        self.assertEqual(statistics.polls, 3)
+        self.assertAlmostEqual(statistics.maximumLateness, 0.2)
+        self.assertEqual(statistics.missedDeadlines, 0)
+
+    def testMissedDeadlinesAreSkipped(self):
+        task = self.scheduler.schedule(self.poll, interval=1.0)
+        self.scheduler.runPending()
+        self.clock.advance(3.5)
+        self.assertEqual(self.scheduler.runPending(), 1) # once, not a burst of 3
+        self.assertEqual(task.statistics().missedDeadlines, 2)
+        self.assertEqual(task.deadline, 4.0)
+
+    def testOverrun(self):
+        def slowPoll():
+            self.clock.advance(1.5)
+        task = self.scheduler.schedule(slowPoll, interval=1.0)
+        self.scheduler.runPending()
+        statistics = task.statistics()
+        self.assertEqual(statistics.overruns, 1)
+        self.assertEqual(statistics.maximumDuration, 1.5)
+        self.assertEqual(statistics.missedDeadlines, 1)
+        self.assertEqual(task.deadline, 2.0)
+
+    def testDelay(self):
+        self.scheduler.schedule(self.poll, interval=1.0, delay=0.5)
+        self.assertEqual(self.scheduler.runPending(), 0)
+        self.clock.advance(0.5)
+        self.assertEqual(self.scheduler.runPending(), 1)
+
+    def testIntervals(self):
+        fast = self.scheduler.schedule(self.poll, interval=0.1, name="fast")
+        slow = self.scheduler.schedule(self.poll, interval=1.0, name="slow")
+        for i in range(100):
+            self.scheduler.runPending()
+            self.clock.advance(0.01)
+        statistics = self.scheduler.statistics()
+        self.assertEqual(statistics["fast"].polls, 10)
+        self.assertEqual(statistics["slow"].polls, 1)
+
+    def testIntervalChangedByPoll(self):
+        task = None
+        def poll():
+            task.interval = 2.0
+        task = self.scheduler.schedule(poll, interval=1.0)
+        self.scheduler.runPending()
+        self.assertEqual(task.deadline, 2.0)
+
+    def testCancel(self):
+        task = self.scheduler.schedule(self.poll, interval=1.0)
+        self.scheduler.runPending()
+        self.scheduler.cancel(task)
+        self.clock.advance(1.0)
+        self.assertEqual(self.scheduler.runPending(), 0)
+        self.assertEqual(self.scheduler.activeTasks(), [])
+        self.assertEqual(self.scheduler.tasks, [])
+
+    def testCancelFromPoll(self):
+        task = None
+        def poll():
+            self.scheduler.cancel(task)
+        task = self.scheduler.schedule(poll, interval=1.0)
+        self.scheduler.runPending()
+        self.clock.advance(1.0)
+        self.assertEqual(self.scheduler.runPending(), 0)
+
+    def testErrorsKeepPolling(self):
+        def failingPoll():
+            raise RuntimeError("Disconnected")
+        task = self.scheduler.schedule(failingPoll, interval=1.0)
+        self.scheduler.runPending()
+        self.clock.advance(1.0)
+        self.scheduler.runPending()
+        self.assertEqual(task.statistics().errors, 2)
+        self.assertIsInstance(task.lastError, RuntimeError)
+
+    def testDeviceFacade(self):
+        device = DebugPhysicalDevice()
+        device.refreshInterval = 0.5
+        notifications = []
+        NotificationCenter().addObserver(self, notifications.append, PhysicalDeviceNotification.status, device)
+        device.startBackgroundStatusUpdates()
+        self.assertTrue(device.isMonitoring)
+        with self.assertRaises(RuntimeError):
+            device.startBackgroundStatusUpdates()
+
+        for i in range(4):
+            self.scheduler.runPending()
+            self.clock.advance(0.25)
+        self.assertEqual(len(notifications), 2)
+
+        device.refreshInterval = 0.1 # applies from the next deadline
+        self.scheduler.runPending()
+        self.clock.advance(0.1)
+        self.scheduler.runPending()
+        self.assertEqual(len(notifications), 4)
+
+        device.stopBackgroundStatusUpdates()
+        self.assertFalse(device.isMonitoring)
+        with self.assertRaises(RuntimeError):
+            device.stopBackgroundStatusUpdates()
+        self.clock.advance(1.0)
+        self.scheduler.runPending()
+        self.assertEqual(len(notifications), 4)
+        NotificationCenter().removeObserver(self)
+
+
+class ScriptedDevice(DebugPhysicalDevice):
+    """ Returns the values of script, one per status update, then the last one """
+    def __init__(self, script):
+        super().__init__()
+        self.script = list(script)
+
+    def doGetStatusUserInfo(self):
+        if len(self.script) > 1:
+            return self.script.pop(0)
+        return self.script[0]
+
+class TestAdaptiveRefresh(unittest.TestCase):
+    def setUp(self):
+        PollingScheduler().destroy()
+        self.clock = FakeClock()
+        self.scheduler = PollingScheduler()
+        self.scheduler.clock = self.clock
+        self.scheduler.startsAutomatically = False
+
+    def tearDown(self):
+        PollingScheduler().destroy()
+
+    def pollTimes(self, device, duration, step=1/64):
+        """ The times of the status updates of device during duration """
+        times = []
+        NotificationCenter().addObserver(self, lambda notification: times.append(self.clock()), PhysicalDeviceNotification.status, device)
+        end = self.clock() + duration
+        while self.clock() < end - 1e-9:
+            self.scheduler.runPending()
+            self.clock.advance(step)
+        NotificationCenter().removeObserver(self)
+        return times
+
+    def adaptiveDevice(self, device):
+        device.adaptiveRefresh = True
+        device.minimumRefreshInterval = 0.125
+        device.maximumRefreshInterval = 2.0
+        device.refreshInterval = 0.5
+        return device
+
+    def intervals(self, times):
+        return [ b - a for a, b in zip(times[:-1], times[1:]) ]
+
+    def testBacksOffWhenStable(self):
+        device = self.adaptiveDevice(ScriptedDevice([1.0]))
+        device.startBackgroundStatusUpdates()
+        times = self.pollTimes(device, 10)
+        self.assertEqual(self.intervals(times)[:5], [0.25, 0.5, 1.0, 2.0, 2.0])
+        self.assertEqual(device.currentRefreshInterval, 2.0)
+        device.stopBackgroundStatusUpdates()
+
+    def testFasterWhenChanging(self):
+        device = self.adaptiveDevice(ScriptedDevice([1.0] * 4 + list(range(2, 40))))
+        device.startBackgroundStatusUpdates()
+        times = self.pollTimes(device, 6)
+        # The first value is a change, stable values, then changes
+        self.assertEqual(self.intervals(times)[:9], [0.25, 0.5, 1.0, 2.0, 1.0, 0.5, 0.25, 0.125, 0.125])
+        self.assertEqual(device.currentRefreshInterval, 0.125)
+        device.stopBackgroundStatusUpdates()
+
+    def testRefreshIntervalIsKept(self):
+        device = self.adaptiveDevice(ScriptedDevice([1.0]))
+        device.startBackgroundStatusUpdates()
+        self.pollTimes(device, 10)
+        device.stopBackgroundStatusUpdates()
+        self.assertEqual(device.refreshInterval, 0.5)
+
+        device.adaptiveRefresh = False
+        device.startBackgroundStatusUpdates()
+        self.assertEqual(self.intervals(self.pollTimes(device, 2.0)), [0.5, 0.5, 0.5])
+        self.assertEqual(device.currentRefreshInterval, 0.5)
+        device.stopBackgroundStatusUpdates()
+
+    def testFirstPollBeforeScheduleReturns(self):
+        # As if a worker polled before schedule() returned
+        self.scheduler.startsAutomatically = True
+        self.scheduler.start = self.scheduler.runPending
+        device = self.adaptiveDevice(ScriptedDevice([1.0]))
+        monitoringDuringPoll = []
+        updateStatus = device.updateStatus
+        def recordingUpdateStatus():
+            monitoringDuringPoll.append(device.monitoring)
+            updateStatus()
+        device.updateStatus = recordingUpdateStatus
+
+        device.startBackgroundStatusUpdates()
+        self.assertEqual(len(monitoringDuringPoll), 1)
+        self.assertIs(monitoringDuringPoll[0], device.monitoring)
+        self.assertEqual(device.monitoring.interval, 0.25)
+        device.stopBackgroundStatusUpdates()
+
+    def testFixedWithoutAdaptiveRefresh(self):
+        device = ScriptedDevice([1.0])
+        device.refreshInterval = 0.5
+        device.startBackgroundStatusUpdates()
+        self.assertEqual(len(self.pollTimes(device, 4.0)), 8)
+        self.assertEqual(device.refreshInterval, 0.5)
+        device.stopBackgroundStatusUpdates()
+
+    def testCommandPollsFastRightAway(self):
+        device = self.adaptiveDevice(DebugLinearMotionDevice())
+        device.startBackgroundStatusUpdates()
+        self.pollTimes(device, 10)
+        self.assertEqual(device.currentRefreshInterval, 2.0)
+
+        device.moveTo((10, 20, 30))
+        self.assertEqual(device.currentRefreshInterval, 0.125)
+        moveTime = self.clock()
+        times = self.pollTimes(device, 0.5)
+        self.assertEqual(times[0] - moveTime, 0.125)
+        self.assertEqual(device.lastStatusUserInfo, (10, 20, 30))
+        device.stopBackgroundStatusUpdates()
+
+    def testPositionOnlyWithAdaptiveRefresh(self):
+        device = DebugLinearMotionDevice()
+        self.assertIsNone(device.doGetStatusUserInfo())
+        device.adaptiveRefresh = True
+        self.assertEqual(device.doGetStatusUserInfo(), device.doGetPosition())
+
+    def testBusTimeSaved(self):
+        stable = ScriptedDevice([1.0])
+        adaptive = self.adaptiveDevice(ScriptedDevice([1.0]))
+        stable.refreshInterval = 0.125
+        stable.startBackgroundStatusUpdates()
+        adaptive.startBackgroundStatusUpdates()
+        self.pollTimes(None, 60)
+        fixedPolls = stable.monitoring.statistics().polls
+        adaptivePolls = adaptive.monitoring.statistics().polls
+        self.assertTrue(adaptivePolls < fixedPolls / 10, (adaptivePolls, fixedPolls))
+        stable.stopBackgroundStatusUpdates()
+        adaptive.stopBackgroundStatusUpdates()
+
+    def testArraysAlwaysChanged(self):
+        device = DebugPhysicalDevice()
+        self.assertTrue(device.statusHasChanged(None, (1, 2)))
+        self.assertFalse(device.statusHasChanged((1, 2), (1, 2)))
+        import numpy as np
+        self.assertTrue(device.statusHasChanged(np.zeros(3), np.zeros(3)))
+
+    def testLaserSourceWithoutPhysicalDevice(self):
+        class Laser(LaserSourceDevice):
+            def doTurnOn(self):
+                self.on = True
+        laser = Laser()
+        laser.turnOn()
+        self.assertTrue(laser.on)
+
+    def testRescheduleOnlyEarlier(self):
+        polls = []
+        task = self.scheduler.schedule(lambda: polls.append(self.clock()), interval=1.0)
+        self.scheduler.runPending()
+        self.scheduler.reschedule(task, 2.0)
+        self.assertEqual(task.deadline, 1.0)
+        self.scheduler.reschedule(task, 0.25)
+        self.assertEqual(task.deadline, 0.25)
+        self.clock.advance(1.0)
+        self.assertEqual(self.scheduler.runPending(), 1) # the previous entry at 1.0 is dropped
+        self.assertEqual(len(self.scheduler.tasks), 1)
+
+
+class TestPollingSchedulerThreads(unittest.TestCase):
+    def setUp(self):
+        PollingScheduler().destroy()
+        self.devices = []
+
+    def tearDown(self):
+        for device in self.devices:
+            if device.isMonitoring:
+                device.stopBackgroundStatusUpdates()
+        PollingScheduler().destroy()
+        NotificationCenter().clear()
+
+    def testStatusNotifications(self):
+        device = DebugLinearMotionDevice()
+        device.refreshInterval = 0.01
+        self.devices.append(device)
+        received = Event()
+        notifications = []
+        def handle(notification):
+            notifications.append(notification)
+            if len(notifications) == 5:
+                received.set()
+
+        NotificationCenter().addObserver(self, handle, PhysicalDeviceNotification.status, device)
+        device.startBackgroundStatusUpdates()
+        self.assertTrue(received.wait(2))
+        device.stopBackgroundStatusUpdates()
+        count = len(notifications)
+        time.sleep(0.05)
+        self.assertEqual(len(notifications), count)
+
+    def testStopWaitsForCurrentPoll(self):
+        polling = Event()
+        finished = []
+        def poll():
+            polling.set()
+            time.sleep(0.05)
+            finished.append(True)
+
+        task = PollingScheduler().schedule(poll, interval=1.0)
+        self.assertTrue(polling.wait(1))
+        PollingScheduler().cancel(task)
+        self.assertEqual(finished, [True])
+
+    def testFortyDevicesWithFewThreads(self):
+        threadsBefore = threading.active_count()
+        for i in range(20):
+            self.devices.append(DebugPhysicalDevice())
+            self.devices.append(DebugLinearMotionDevice())
+
+        for device in self.devices:
+            device.refreshInterval = 0.02
+            device.startBackgroundStatusUpdates()
+
+        time.sleep(0.3)
+        self.assertTrue(threading.active_count() <= threadsBefore + PollingScheduler.numberOfWorkers + 1)
+
+        statistics = PollingScheduler().statistics()
+        self.assertEqual(len(statistics), 40)
+        for name, stats in statistics.items():
+            self.assertTrue(stats.polls >= 5, (name, stats))
+        maximumLateness = max([ stats.maximumLateness for stats in statistics.values() ])
+        print("\n40 devices polled at 50 Hz: {0} threads, maximum lateness {1:.2f} ms".format(
+              PollingScheduler.numberOfWorkers + 1, maximumLateness*1e3))
+
+if __name__ == '__main__':
+    unittest.main()
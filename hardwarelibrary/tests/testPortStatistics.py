@@ -0,0 +1,184 @@
+import env
+import unittest
+import time
+from threading import Thread
+
+from hardwarelibrary.communication import *
+from hardwarelibrary.motion.sutterdevice import SutterDevice
+from hardwarelibrary.devicemanager import DeviceManager
+
+class TestPortStatistics(unittest.TestCase):
+    def setUp(self):
+        self.port = DebugEchoPort()
+        self.port.open()
+
+    def tearDown(self):
+        self.port.close()
+
+    def testDisabledByDefault(self):
+        self.assertIsNone(self.port.statistics)
+        self.assertNotIn('writeData', self.port.__dict__)
+
+    def testDisableRestoresPort(self):
+        portLock = self.port.portLock
+        transactionLock = self.port.transactionLock
+        self.port.enableStatistics()
+        self.assertIsNot(self.port.portLock, portLock)
+        self.port.disableStatistics()
+        self.assertIsNone(self.port.statistics)
+        self.assertIs(self.port.portLock, portLock)
+        self.assertIs(self.port.transactionLock, transactionLock)
+        for name in ['writeData', 'doReadData', 'doReadInto', 'readString']:
+            self.assertNotIn(name, self.port.__dict__)
+
+    def testEnableTwiceKeepsStatistics(self):
+        statistics = self.port.enableStatistics()
+        self.assertIs(self.port.enableStatistics(), statistics)
+
+    def testCountsBytesAndCommands(self):
+        statistics = self.port.enableStatistics()
+        for i in range(10):
+            reply, groups = self.port.writeStringReadMatchingGroups("VALUE {0}\n".format(i), replyPattern=r"VALUE (\d+)")
+            self.assertEqual(groups[0], str(i))
+
+        self.assertEqual(statistics.count('bytesWritten'), 80)
+        self.assertEqual(statistics.count('bytesRead'), 80)
+        self.assertEqual(statistics.count('writes'), 10)
+        self.assertEqual(statistics.count('commands'), 10)
+        self.assertEqual(statistics.count('transaction'), 10)
+        self.assertEqual(statistics.count('readString'), 10)
+        self.assertEqual(statistics.count('write'), 10)
+        self.assertTrue(statistics.meanTime('transaction') >= statistics.meanTime('readString'))
+        self.assertTrue(statistics.maximumTime('transaction') >= statistics.meanTime('transaction'))
+
+    def testCountsTimeouts(self):
+        statistics = self.port.enableStatistics()
+        with self.assertRaises(CommunicationReadTimeout):
+            self.port.readData(1)
+        self.assertEqual(statistics.count('timeouts'), 1)
+
+    def testReadIntoIsCountedOnce(self):
+        statistics = self.port.enableStatistics()
+        self.port.writeData(b"abcd")
+        buffer = bytearray(4)
+        self.assertEqual(self.port.readInto(buffer), 4)
+        self.assertEqual(statistics.count('bytesRead'), 4)
+
+    def testNestedTransactionIsOneCommand(self):
+        statistics = self.port.enableStatistics()
+        self.port.writeStringReadFirstMatchingGroup("VALUE 1\n", replyPattern=r"VALUE (\d+)")
+        self.assertEqual(statistics.count('commands'), 1)
+
+    def testCommandExecute(self):
+        statistics = self.port.enableStatistics()
+        command = TextCommand("VALUE", "VALUE 1\n", replyPattern=r"VALUE (\d+)")
+        command.execute(self.port)
+        self.assertEqual(statistics.count('commands'), 1)
+
+    def testLockWaitIsMeasured(self):
+        statistics = self.port.enableStatistics()
+
+        def holdTransaction():
+            with self.port.transactionLock:
+                time.sleep(0.05)
+
+        thread = Thread(target=holdTransaction)
+        thread.start()
+        time.sleep(0.01)
+        with self.port.transactionLock:
+            pass
+        thread.join()
+        self.assertTrue(statistics.maximumTime('transactionLockWait') > 0.02)
+        self.assertTrue(statistics.percentile('transactionLockWait', 100) > 0.02)
+
+    def testPercentileResolution(self):
+        statistics = PortStatistics()
+        for i in range(99):
+            statistics.recordDuration(PortStatistics.write, 10e-6)
+        statistics.recordDuration(PortStatistics.write, 0.01)
+        self.assertEqual(statistics.percentile('write', 50), 16e-6)
+        self.assertTrue(0.01 <= statistics.percentile('write', 100) < 0.02)
+        self.assertIsNone(statistics.percentile('read', 50))
+        self.assertIsNone(statistics.meanTime('read'))
+
+    def testSnapshotAndReset(self):
+        statistics = self.port.enableStatistics()
+        self.port.writeData(b"abcd")
+        snapshot = statistics.snapshot()
+        statistics.reset()
+        self.assertEqual(snapshot.count('bytesWritten'), 4)
+        self.assertEqual(statistics.count('bytesWritten'), 0)
+        self.port.writeData(b"ab")
+        self.assertEqual(snapshot.count('bytesWritten'), 4)
+        self.assertEqual(statistics.count('bytesWritten'), 2)
+
+    def testCombined(self):
+        other = DebugEchoPort()
+        other.open()
+        self.port.enableStatistics()
+        other.enableStatistics()
+        self.port.writeData(b"abcd")
+        other.writeData(b"ab")
+        total = PortStatistics.combined([self.port.statistics, other.statistics])
+        self.assertEqual(total.count('bytesWritten'), 6)
+        self.assertEqual(total.count('write'), 2)
+
+    def testAsDict(self):
+        statistics = self.port.enableStatistics()
+        self.port.writeData(b"abcd")
+        summary = statistics.asDict()
+        self.assertEqual(summary['bytesWritten'], 4)
+        self.assertEqual(summary['write']['count'], 1)
+
+    def commandDuration(self, nCommands):
+        startTime = time.perf_counter()
+        for i in range(nCommands):
+            self.port.writeStringReadMatchingGroups("VALUE 1234\n", replyPattern=r"VALUE (\d+)")
+        return (time.perf_counter() - startTime) / nCommands
+
+    def testBenchmarkOverhead(self):
+        nCommands = 5000
+        disabled = self.commandDuration(nCommands)
+        self.port.enableStatistics()
+        enabled = self.commandDuration(nCommands)
+        self.port.disableStatistics()
+        disabledAgain = self.commandDuration(nCommands)
+        print("\nDebugEchoPort command: statistics disabled {0:.1f} µs, enabled {1:.1f} µs, disabled again {2:.1f} µs".format(disabled*1e6, enabled*1e6, disabledAgain*1e6))
+
+
+class TestDeviceManagerPortStatistics(unittest.TestCase):
+    def setUp(self):
+        self.manager = DeviceManager()
+        self.devices = [SutterDevice("debug"), SutterDevice("debug")]
+        for device in self.devices:
+            device.timingPolicy = fastTiming
+            device.initializeDevice()
+            self.manager.addDevice(device)
+
+    def tearDown(self):
+        self.manager.disablePortStatistics()
+        for device in self.devices:
+            device.shutdownDevice()
+        self.manager.destroy()
+
+    def testAggregation(self):
+        self.manager.enablePortStatistics()
+        for device in self.devices:
+            device.doMoveTo((1, 2, 3))
+            device.doGetPosition()
+
+        total = self.manager.portStatistics()
+        perPort = [ device.port.statistics.count('bytesWritten') for device in self.devices ]
+        self.assertTrue(perPort[0] > 0)
+        self.assertEqual(total.count('bytesWritten'), sum(perPort))
+        self.assertEqual(total.count('writes'), 4)
+
+    def testSharedPortCountedOnce(self):
+        self.devices[1].port = self.devices[0].port
+        self.assertEqual(len(self.manager.devicePorts()), 1)
+
+    def testNoStatistics(self):
+        self.assertEqual(self.manager.portStatistics().count('bytesWritten'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import env
+import unittest
+import os
+import time
+import tempfile
+
+from hardwarelibrary.communication import *
+from hardwarelibrary.motion.sutterdevice import SutterDevice
+
+class TestRecordingPort(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filePath = os.path.join(self.directory.name, "session.hwrec")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def recordEchoSession(self):
+        port = RecordingPort(DebugEchoPort(), self.filePath)
+        port.open()
+        port.writeData(b"abc\n")
+        self.assertEqual(port.readData(4), b"abc\n")
+        port.writeString("hello\n")
+        self.assertEqual(port.readString(), "hello\n")
+        with self.assertRaises(CommunicationReadTimeout):
+            port.readData(1)
+        port.close()
+
+    def testRecordedEvents(self):
+        self.recordEchoSession()
+        events = RecordingPort.readEvents(self.filePath)
+        kinds = [ event.kind for event in events ]
+        self.assertEqual(kinds[:2], [RecordedEvent.write, RecordedEvent.read])
+        self.assertEqual(kinds[-1], RecordedEvent.timeout)
+        self.assertEqual(events[0].data, b"abc\n")
+        self.assertEqual(events[1].data, b"abc\n")
+        self.assertIsNone(events[0].endPoint)
+        times = [ event.time for event in events ]
+        self.assertEqual(times, sorted(times))
+
+    def testNotARecording(self):
+        with open(self.filePath, "wb") as file:
+            file.write(b"something else")
+        with self.assertRaises(ValueError):
+            RecordingPort.readEvents(self.filePath)
+
+    def testReplay(self):
+        self.recordEchoSession()
+        port = ReplayPort(self.filePath)
+        port.open()
+        port.writeData(b"abc\n")
+        self.assertEqual(port.readData(4), b"abc\n")
+        port.writeString("hello\n")
+        self.assertEqual(port.readString(), "hello\n")
+        with self.assertRaises(CommunicationReadTimeout):
+            port.readData(1)
+        self.assertTrue(port.isFinished)
+        port.close()
+
+    def testReplayIsRepeatable(self):
+        self.recordEchoSession()
+        port = ReplayPort(self.filePath)
+        for i in range(3):
+            port.open()
+            port.writeData(b"abc\n")
+            self.assertEqual(port.bytesAvailable(), 4)
+            self.assertEqual(port.readData(4), b"abc\n")
+            port.close()
+
+    def testStrictReplayDetectsMismatch(self):
+        self.recordEchoSession()
+        port = ReplayPort(self.filePath)
+        port.open()
+        with self.assertRaises(ReplayMismatch):
+            port.writeData(b"xyz\n")
+
+    def testLenientReplayAcceptsAnyWrite(self):
+        self.recordEchoSession()
+        port = ReplayPort(self.filePath, strict=False)
+        port.open()
+        port.writeData(b"xyz\n")
+        self.assertEqual(port.readData(4), b"abc\n")
+
+    def testRealTimeReplayKeepsDelays(self):
+        events = [RecordedEvent(RecordedEvent.write, 0.0, None, b"?"),
+                  RecordedEvent(RecordedEvent.read, 0.1, None, b"!")]
+
+        port = ReplayPort(events=events, realTime=True)
+        port.open()
+        port.writeData(b"?")
+        self.assertEqual(port.bytesAvailable(), 0)
+        startTime = time.perf_counter()
+        self.assertEqual(port.readData(1), b"!")
+        self.assertTrue(time.perf_counter() - startTime > 0.08)
+
+        port = ReplayPort(events=events, realTime=False)
+        port.open()
+        port.writeData(b"?")
+        self.assertEqual(port.bytesAvailable(), 1)
+
+
+class TestRecordingPortSutter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filePath = os.path.join(self.directory.name, "sutter.hwrec")
+        self.positions = [ (i, 2*i, 3*i) for i in range(20) ]
+
+        device = SutterDevice("debug")
+        device.timingPolicy = fastTiming
+        device.initializeDevice()
+        recordingPort = RecordingPort(device.port, self.filePath)
+        device.port = recordingPort
+        for position in self.positions:
+            device.doMoveTo(position)
+            device.doGetPosition()
+        device.shutdownDevice()
+        recordingPort.stopRecording() # the debug port is never opened, so it is not closed either
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def replayedDevice(self, **kwargs):
+        device = SutterDevice("debug")
+        device.timingPolicy = fastTiming
+        device.initializeDevice()
+        device.port.close()
+        device.port = ReplayPort(self.filePath, **kwargs)
+        device.port.open()
+        return device
+
+    def testReplayThroughDevice(self):
+        device = self.replayedDevice()
+        for position in self.positions:
+            device.doMoveTo(position)
+            self.assertEqual(device.doGetPosition(), position)
+        self.assertTrue(device.port.isFinished)
+        device.shutdownDevice()
+
+    def testReplayDetectsProtocolChange(self):
+        device = self.replayedDevice()
+        with self.assertRaises(ReplayMismatch):
+            device.doMoveTo((1, 1, 1))
+        device.shutdownDevice()
+
+    def testBenchmarkReplayedCommands(self):
+        device = self.replayedDevice()
+        nRepeats = 50
+        startTime = time.perf_counter()
+        for i in range(nRepeats):
+            device.port.rewind()
+            for position in self.positions:
+                device.doMoveTo(position)
+                device.doGetPosition()
+        duration = time.perf_counter() - startTime
+        device.shutdownDevice()
+
+        rate = 2 * nRepeats * len(self.positions) / duration
+        print("\nSutterDevice replayed from a recording: {0:.0f} commands/s".format(rate))
+        self.assertTrue(rate > 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+import env
+import unittest
+import time
+from threading import Thread
+
+from serial.tools.list_ports_common import ListPortInfo
+
+from hardwarelibrary.communication import *
+from hardwarelibrary.communication.serialport import UnableToOpenSerialPort
+from hardwarelibrary.communication.serialportpool import IncompatibleOpenParameters
+import hardwarelibrary.communication.serialport as serialport
+from hardwarelibrary.devicemanager import DeviceManager
+from hardwarelibrary.motion.sutterdevice import SutterDevice
+from hardwarelibrary.oscilloscope.oscilloscopedevice import OscilloscopeDevice
+
+def portInfo(device, vid, pid, serialNumber):
+    port = ListPortInfo(device=device)
+    port.vid = vid
+    port.pid = pid
+    port.serial_number = serialNumber
+    return port
+
+class TestPortEnumerationCache(unittest.TestCase):
+    def setUp(self):
+        self.comportsCalls = 0
+        self.enumerationDelay = 0
+        self.fakePorts = [portInfo("/dev/ttyUSB0", 0x0403, 0x6001, "FTABC1"),
+                          portInfo("/dev/ttyUSB1", 0x0403, 0x6001, "FTABC12"),
+                          portInfo("/dev/ttyUSB2", 0x0403, 0x6010, "FTXYZ"),
+                          portInfo("/dev/ttyS0", None, None, None)]
+
+        def fakeComports():
+            self.comportsCalls += 1
+            time.sleep(self.enumerationDelay)
+            return list(self.fakePorts)
+
+        self.originalComports = serialport.comports
+        self.originalFtdiPorts = SerialPort.ftdiPorts
+        serialport.comports = fakeComports
+        SerialPort.ftdiPorts = classmethod(lambda cls: [])
+        SerialPort.invalidatePortCache()
+
+    def tearDown(self):
+        serialport.comports = self.originalComports
+        SerialPort.ftdiPorts = self.originalFtdiPorts
+        SerialPort.portCacheTimeout = 5.0
+        SerialPort.invalidatePortCache()
+
+    def testMatchVendor(self):
+        self.assertEqual(SerialPort.matchPorts(idVendor=0x0403), ["/dev/ttyUSB0", "/dev/ttyUSB1", "/dev/ttyUSB2"])
+
+    def testMatchVendorProduct(self):
+        self.assertEqual(SerialPort.matchPorts(idVendor=0x0403, idProduct=0x6010), ["/dev/ttyUSB2"])
+
+    def testMatchExactSerialNumber(self):
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, "FTABC12"), ["/dev/ttyUSB1"])
+
+    def testSerialNumbersAreNotKeys(self):
+        portIndex = SerialPort.portIndex()
+        self.assertEqual(set(portIndex.keys()), {(0x0403, None, None), (0x0403, 0x6001, None), (0x0403, 0x6010, None), (None, None, None)})
+        self.assertEqual(portIndex.serialNumbers["/dev/ttyUSB1"], "FTABC12")
+
+    def testExactSerialNumberIsAlsoSearched(self):
+        # "FTABC1" exists, but is also found in "FTABC12", as before
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, "FTABC1"), ["/dev/ttyUSB0", "/dev/ttyUSB1"])
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, "FTABC1$"), ["/dev/ttyUSB0"])
+
+    def testMatchSerialNumberPattern(self):
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, "ftabc"), ["/dev/ttyUSB0", "/dev/ttyUSB1"])
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, ".*"), ["/dev/ttyUSB0", "/dev/ttyUSB1"])
+        self.assertEqual(SerialPort.matchPorts(0x0403, 0x6001, "nothing"), [])
+
+    def testNoMatch(self):
+        self.assertIsNone(SerialPort.matchAnyPort(idVendor=0x1234, idProduct=0x5678))
+
+    def testEnumerationIsCached(self):
+        for i in range(10):
+            SerialPort.matchAnyPort(idVendor=0x0403, idProduct=0x6001)
+        self.assertEqual(self.comportsCalls, 1)
+
+    def testCacheExpires(self):
+        SerialPort.portCacheTimeout = 0.1
+        SerialPort.matchAnyPort(idVendor=0x0403)
+        time.sleep(0.2)
+        SerialPort.matchAnyPort(idVendor=0x0403)
+        self.assertEqual(self.comportsCalls, 2)
+
+    def testInvalidateSeesNewPort(self):
+        self.assertEqual(SerialPort.matchPorts(idVendor=0x1342, idProduct=0x0001), [])
+        self.fakePorts.append(portInfo("/dev/ttyUSB3", 0x1342, 0x0001, "SUTTER"))
+        self.assertEqual(SerialPort.matchPorts(idVendor=0x1342, idProduct=0x0001), [])
+        SerialPort.invalidatePortCache()
+        self.assertEqual(SerialPort.matchPorts(idVendor=0x1342, idProduct=0x0001), ["/dev/ttyUSB3"])
+        self.assertEqual(self.comportsCalls, 2)
+
+    def testDeviceManagerInvalidatesOnUSBChange(self):
+        dm = DeviceManager()
+        try:
+            dm.usbDeviceConnected = lambda usbDevice: None
+            dm.newlyConnectedAndDisconnectedUSBDevices = lambda: ([], [])
+            SerialPort.matchAnyPort(idVendor=0x0403)
+            dm.updateConnectedDevices()
+            SerialPort.matchAnyPort(idVendor=0x0403)
+            self.assertEqual(self.comportsCalls, 1)
+
+            dm.newlyConnectedAndDisconnectedUSBDevices = lambda: (["newDevice"], [])
+            dm.updateConnectedDevices()
+            SerialPort.matchAnyPort(idVendor=0x0403)
+            self.assertEqual(self.comportsCalls, 2)
+        finally:
+            dm.destroy()
+
+    def testBenchmarkCachedEnumeration(self):
+        self.enumerationDelay = 0.02
+        nLookups = 50
+
+        startTime = time.perf_counter()
+        for i in range(nLookups):
+            SerialPort.invalidatePortCache()
+            SerialPort.matchAnyPort(0x0403, 0x6001, "FTABC1")
+        uncachedDuration = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        for i in range(nLookups):
+            SerialPort.matchAnyPort(0x0403, 0x6001, "FTABC1")
+        cachedDuration = time.perf_counter() - startTime
+
+        print("\n{0} port lookups with a 20 ms enumeration: uncached {1:.3f} s, cached {2:.4f} s".format(nLookups, uncachedDuration, cachedDuration))
+        self.assertTrue(cachedDuration < uncachedDuration)
+
+
+class TestLoopSerialPort(unittest.TestCase):
+    def setUp(self):
+        self.port = SerialPort(portPath="loop://")
+        self.port.open(timeout=0.1)
+
+    def tearDown(self):
+        self.port.close()
+
+    def testIsOpen(self):
+        self.assertTrue(self.port.isOpen)
+
+    def testEcho(self):
+        reply = self.port.writeStringExpectMatchingString("abcd1234\n", replyPattern="abc.\\d{4}")
+        self.assertEqual(reply, "abcd1234\n")
+
+
+class TestSerialPortPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = SerialPortPool()
+        self.pool.idleTimeout = 0.2
+
+    def tearDown(self):
+        self.pool.destroy()
+
+    def testSingleton(self):
+        self.assertIs(SerialPortPool(), self.pool)
+
+    def testAcquireOpensPort(self):
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.assertTrue(port.isOpen)
+        self.assertEqual(self.pool.referenceCount("loop://"), 1)
+
+    def testAcquireTwiceSharesPort(self):
+        port1 = self.pool.acquire("loop://", timeout=0.1)
+        port2 = self.pool.acquire("loop://", timeout=0.1)
+        self.assertIs(port1, port2)
+        self.assertIs(port1.transactionLock, port2.transactionLock)
+        self.assertEqual(self.pool.referenceCount("loop://"), 2)
+
+    def testDifferentPathsAreDifferentPorts(self):
+        port1 = self.pool.acquire("loop://", timeout=0.1)
+        port2 = self.pool.acquire("loop://?logging=info", timeout=0.1)
+        self.assertIsNot(port1, port2)
+
+    def testReleaseKeepsPortOpenWhileUsed(self):
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.pool.acquire("loop://", timeout=0.1)
+        self.pool.release(port)
+        self.assertTrue(port.isOpen)
+        self.assertEqual(self.pool.referenceCount("loop://"), 1)
+
+    def testIdlePortClosesAfterTimeout(self):
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.pool.release(port)
+        self.assertTrue(port.isOpen)
+        time.sleep(self.pool.idleTimeout + 0.2)
+        self.assertFalse(port.isOpen)
+        self.assertEqual(self.pool.referenceCount("loop://"), 0)
+
+    def testReacquireBeforeTimeoutReusesOpenPort(self):
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.pool.release(port)
+        samePort = self.pool.acquire("loop://", timeout=0.1)
+        self.assertIs(port, samePort)
+        time.sleep(self.pool.idleTimeout + 0.2)
+        self.assertTrue(port.isOpen)
+
+    def testImmediateCloseWithoutIdleTimeout(self):
+        self.pool.idleTimeout = 0
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.pool.release(port)
+        self.assertFalse(port.isOpen)
+
+    def testCloseIdlePorts(self):
+        self.pool.idleTimeout = 10
+        port = self.pool.acquire("loop://", timeout=0.1)
+        self.pool.release(port)
+        self.assertEqual(self.pool.closeIdlePorts(idleTimeout=0), 1)
+        self.assertFalse(port.isOpen)
+
+    def testAcquireWithOtherParametersRaises(self):
+        port = self.pool.acquire("loop://", baudRate=9600, timeout=0.1)
+        self.assertIs(self.pool.acquire("loop://", baudRate=9600, timeout=0.1), port)
+        self.assertIs(self.pool.acquire("loop://"), port)
+        with self.assertRaises(IncompatibleOpenParameters):
+            self.pool.acquire("loop://", baudRate=19200, timeout=0.1)
+        with self.assertRaises(IncompatibleOpenParameters):
+            self.pool.acquire("loop://", rtscts=True)
+        self.assertEqual(self.pool.referenceCount("loop://"), 3)
+
+    def testFailedInitializationReleasesPort(self):
+        originalMatchAnyPort = SerialPort.matchAnyPort
+        SerialPort.matchAnyPort = classmethod(lambda cls, *args, **kwargs: "loop://")
+        try:
+            device = OscilloscopeDevice()
+            def failingStatus():
+                raise IOError("No reply")
+            device.doGetTektronikStatus = failingStatus
+            with self.assertRaises(IOError):
+                device.doInitializeDevice()
+        finally:
+            SerialPort.matchAnyPort = originalMatchAnyPort
+
+        self.assertIsNone(device.port)
+        self.assertEqual(self.pool.referenceCount("loop://"), 0)
+
+    def testReleaseUnpooledPortClosesIt(self):
+        port = SerialPort(portPath="loop://")
+        port.open(timeout=0.1)
+        self.pool.release(port)
+        self.assertFalse(port.isOpen)
+
+    def testAcquireWithoutMatchRaises(self):
+        with self.assertRaises(UnableToOpenSerialPort):
+            self.pool.acquire(idVendor=0xfffe, idProduct=0xfffe)
+
+    def testReopenStormOpensOnce(self):
+        openCount = 0
+        originalOpen = SerialPort.open
+        def countingOpen(port, *args, **kwargs):
+            nonlocal openCount
+            openCount += 1
+            originalOpen(port, *args, **kwargs)
+
+        SerialPort.open = countingOpen
+        try:
+            for i in range(100):
+                port = self.pool.acquire("loop://", timeout=0.1)
+                self.pool.release(port)
+        finally:
+            SerialPort.open = originalOpen
+
+        self.assertEqual(openCount, 1)
+
+    def testSharedPortSerializesDevices(self):
+        failures = []
+
+        def device(index):
+            port = self.pool.acquire("loop://", timeout=1.0)
+            try:
+                for i in range(50):
+                    value = "{0}-{1}".format(index, i)
+                    reply, groups = port.writeStringReadMatchingGroups("ECHO {0}\n".format(value), replyPattern=r"ECHO (\S+)")
+                    if groups[0] != value:
+                        failures.append((value, groups))
+            except Exception as err:
+                failures.append(err)
+            finally:
+                self.pool.release(port)
+
+        threads = [ Thread(target=device, args=(i,)) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(self.pool.referenceCount("loop://"), 0)
+
+    def testSharedPortSerializesSutterDevices(self):
+        # loop:// echoes the request: each device must read back its own.
+        # The slow device waits before reading, the other one would read
+        # its request if the transaction was not exclusive.
+        echo = BinaryCommand(name="ECHO", prefix=b'E', requestFormat='<l', suffix=b'\r', replyFormat='<clc')
+        devices = []
+        for replyDelay in [0.02, 0]:
+            device = SutterDevice(serialNumber="loop")
+            device.timingPolicy = conservativeTiming._replace(commandDelay=0, replyDelay=replyDelay)
+            device.port = self.pool.acquire("loop://", timeout=1.0)
+            devices.append(device)
+        failures = []
+
+        def sendEchoes(device, index):
+            try:
+                for i in range(10):
+                    value = index*1000+i
+                    reply = device.sendCommand(echo, value)
+                    if reply[1] != value:
+                        failures.append((value, reply))
+            except Exception as err:
+                failures.append(err)
+
+        threads = [ Thread(target=sendEchoes, args=(device, index)) for index, device in enumerate(devices) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for device in devices:
+            device.doShutdownDevice()
+        self.assertEqual(failures, [])
+        self.assertEqual(self.pool.referenceCount("loop://"), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import env
+import unittest
+import time
+
+from hardwarelibrary.communication import *
+from hardwarelibrary.motion.sutterdevice import SutterDevice
+
+class TestTimingPolicy(unittest.TestCase):
+    def testConservativeIsHistoricalValues(self):
+        self.assertEqual(conservativeTiming.openSettleDelay, 0.05)
+        self.assertEqual(conservativeTiming.flushSettleDelay, 0.02)
+        self.assertEqual(conservativeTiming.usbFlushDelay, 0.1)
+        self.assertEqual(conservativeTiming.usbFlushReadTimeoutInMs, 100)
+        self.assertEqual(conservativeTiming.commandDelay, 0.1)
+        self.assertEqual(conservativeTiming.replyDelay, 0.1)
+
+    def testPortsDefaultToConservative(self):
+        self.assertIs(DebugPort().timingPolicy, conservativeTiming)
+        self.assertIs(SerialPort(portPath="loop://").timingPolicy, conservativeTiming)
+
+    def testReplace(self):
+        policy = conservativeTiming._replace(commandDelay=0)
+        self.assertEqual(policy.commandDelay, 0)
+        self.assertEqual(policy.replyDelay, 0.1)
+
+    def testUSBReadTimeoutIsNeverZero(self):
+        policy = fastTiming._replace(usbFlushReadTimeout=0)
+        self.assertEqual(policy.usbFlushReadTimeoutInMs, 1)
+
+    def testWaitUntilReturnsImmediately(self):
+        startTime = time.time()
+        self.assertTrue(conservativeTiming.waitUntil(lambda: True, timeout=1))
+        self.assertTrue(time.time() - startTime < 0.01)
+
+    def testWaitUntilTimesOut(self):
+        self.assertFalse(fastTiming.waitUntil(lambda: False, timeout=0.1))
+
+    def testWaitUntilBacksOff(self):
+        calls = []
+        policy = TimingPolicy(pollInterval=0.001, backoffFactor=2, maximumPollInterval=0.008)
+        policy.waitUntil(lambda: calls.append(time.time()) or len(calls) > 6, timeout=1)
+        intervals = [ calls[i+1]-calls[i] for i in range(len(calls)-1) ]
+        self.assertTrue(intervals[-1] > intervals[0])
+        self.assertTrue(max(intervals) < 0.05)
+
+    def testWaitUntilQuietDiscardsEverything(self):
+        pending = [10, 5, 0, 3]
+        discarded = []
+
+        def bytesAvailable():
+            if len(pending) > 0:
+                return pending.pop(0)
+            return 0
+
+        nBytes = fastTiming.waitUntilQuiet(bytesAvailable, discarded.append, quietTime=0.01)
+        self.assertEqual(nBytes, 18)
+        self.assertEqual(discarded, [10, 5, 3])
+
+    def testWaitUntilQuietStopsAtTimeout(self):
+        startTime = time.time()
+        fastTiming.waitUntilQuiet(lambda: 1, lambda n: None, quietTime=0.01, timeout=0.05)
+        self.assertTrue(time.time() - startTime < 0.5)
+
+
+class TestTimingPolicyLoopSerialPort(unittest.TestCase):
+    def setUp(self):
+        self.port = SerialPort(portPath="loop://")
+
+    def tearDown(self):
+        self.port.close()
+
+    def testFastFlushDiscardsPendingInput(self):
+        self.port.timingPolicy = fastTiming
+        self.port.open(timeout=0.1)
+        self.port.writeData(b"1234")
+        self.port.flush()
+        self.assertEqual(self.port.bytesAvailable(), 0)
+
+    def commandsPerSecond(self, duration=0.5):
+        nCommands = 0
+        startTime = time.time()
+        while time.time() < startTime + duration:
+            self.port.flush()
+            self.port.writeStringReadMatchingGroups("VALUE 1234\n", replyPattern=r"VALUE (\d+)")
+            nCommands += 1
+        return nCommands / (time.time() - startTime)
+
+    def testBenchmarkFlushAndCommand(self):
+        self.port.open(timeout=0.1)
+        conservativeRate = self.commandsPerSecond()
+        self.port.timingPolicy = fastTiming
+        fastRate = self.commandsPerSecond()
+        print("\nloop:// flush + command: conservative {0:.0f}/s, fast {1:.0f}/s".format(conservativeRate, fastRate))
+        self.assertTrue(fastRate > conservativeRate)
+
+    def testBenchmarkOpenClose(self):
+        nOpen = 5
+        startTime = time.time()
+        for i in range(nOpen):
+            self.port.open(timeout=0.1)
+            self.port.close()
+        conservativeDuration = time.time() - startTime
+
+        self.port.timingPolicy = fastTiming
+        startTime = time.time()
+        for i in range(nOpen):
+            self.port.open(timeout=0.1)
+            self.port.close()
+        fastDuration = time.time() - startTime
+        self.port.open(timeout=0.1)
+
+        print("\nloop:// open: conservative {0:.1f} ms, fast {1:.1f} ms".format(conservativeDuration/nOpen*1000, fastDuration/nOpen*1000))
+        self.assertTrue(fastDuration < conservativeDuration)
+
+
+class TestTimingPolicySutterDebug(unittest.TestCase):
+    def setUp(self):
+        self.device = SutterDevice("debug")
+        self.device.initializeDevice()
+
+    def tearDown(self):
+        self.device.shutdownDevice()
+
+    def commandsPerSecond(self, nCommands):
+        startTime = time.time()
+        for i in range(nCommands):
+            self.device.doMoveTo((i, 2*i, 3*i))
+            self.assertEqual(self.device.doGetPosition(), (i, 2*i, 3*i))
+        return 2*nCommands / (time.time() - startTime)
+
+    def testBenchmarkCommandsPerSecond(self):
+        conservativeRate = self.commandsPerSecond(2)
+        self.device.timingPolicy = fastTiming
+        fastRate = self.commandsPerSecond(1000)
+        print("\nSutterDevice on DebugPort: conservative {0:.1f} commands/s, fast {1:.0f} commands/s".format(conservativeRate, fastRate))
+        self.assertTrue(fastRate > 10 * conservativeRate)
+
+if __name__ == '__main__':
+    unittest.main()
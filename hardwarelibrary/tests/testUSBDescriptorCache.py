@@ -0,0 +1,174 @@
+import env
+import unittest
+import time
+import usb.core
+
+from hardwarelibrary.communication import USBDescriptorCache, USBDeviceStrings
+from hardwarelibrary.devicemanager import USBDeviceDescriptor
+import hardwarelibrary.utils as utils
+
+class FakeUSBDevice:
+    """ The strings are at index 1, 2 and 3 like on most devices """
+    iManufacturer = 1
+    iProduct = 2
+    iSerialNumber = 3
+
+    def __init__(self, bus=1, address=2, portNumbers=(1,), idVendor=0x0403, idProduct=0x6001, strings=None):
+        self.bus = bus
+        self.address = address
+        self.port_numbers = portNumbers
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        if strings is None:
+            strings = {1:"FTDI", 2:"FT232R USB UART", 3:"A1"}
+        self.strings = strings
+
+class FakeReader:
+    """ Replaces usb.util.get_string(), counts the reads. The next
+    `failures` reads fail, like a busy device. """
+    def __init__(self, duration=0):
+        self.reads = 0
+        self.duration = duration
+        self.failures = 0
+
+    def __call__(self, usbDevice, index):
+        self.reads += 1
+        time.sleep(self.duration)
+        if self.failures > 0:
+            self.failures -= 1
+            raise usb.core.USBError("Resource busy")
+        if index not in usbDevice.strings:
+            raise ValueError("The device has no langid")
+        return usbDevice.strings[index]
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestUSBDescriptorCache(unittest.TestCase):
+    def setUp(self):
+        USBDescriptorCache().destroy()
+        self.cache = USBDescriptorCache()
+        self.reader = FakeReader()
+        self.cache.readString = self.reader
+        self.clock = FakeClock()
+        self.cache.clock = self.clock
+
+    def tearDown(self):
+        USBDescriptorCache().destroy()
+
+    def testSingleton(self):
+        self.assertIs(USBDescriptorCache(), self.cache)
+        self.assertIs(USBDescriptorCache().readString, self.reader)
+
+    def testReadOnce(self):
+        for i in range(10):
+            # New objects, like usb.core.find() returns
+            self.assertEqual(self.cache.serialNumber(FakeUSBDevice()), "A1")
+        self.assertEqual(self.reader.reads, 1)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 9)
+
+    def testDeviceStrings(self):
+        device = FakeUSBDevice()
+        self.assertEqual(self.cache.deviceStrings(device), USBDeviceStrings("A1", "FTDI", "FT232R USB UART"))
+        self.assertEqual(self.cache.manufacturer(device), "FTDI")
+        self.assertEqual(self.cache.product(device), "FT232R USB UART")
+        self.assertEqual(self.reader.reads, 3)
+        self.assertEqual(self.cache.hits, 2)
+
+    def testDevicesAreDistinct(self):
+        self.assertEqual(self.cache.serialNumber(FakeUSBDevice(address=2)), "A1")
+        self.assertEqual(self.cache.serialNumber(FakeUSBDevice(address=3, strings={3:"B2"})), "B2")
+        self.assertEqual(self.cache.serialNumber(FakeUSBDevice(bus=2, address=2, strings={3:"C3"})), "C3")
+        self.assertEqual(self.reader.reads, 3)
+
+    def testFailureIsRetriedLater(self):
+        device = FakeUSBDevice()
+        self.reader.failures = 1
+        self.assertIsNone(self.cache.serialNumber(device))
+        self.assertIsNone(self.cache.serialNumber(device))
+        self.assertEqual(self.reader.reads, 1)
+
+        self.clock.now += self.cache.failureRetryInterval
+        self.assertEqual(self.cache.serialNumber(device), "A1")
+        self.assertEqual(self.cache.serialNumber(device), "A1")
+        self.assertEqual(self.reader.reads, 2)
+        self.assertEqual(self.cache.failedReads, {})
+
+    def testNoStringIndex(self):
+        device = FakeUSBDevice()
+        device.iSerialNumber = 0
+        self.assertIsNone(self.cache.serialNumber(device))
+        self.assertEqual(self.reader.reads, 0)
+
+    def testForget(self):
+        self.cache.deviceStrings(FakeUSBDevice())
+        self.cache.forget(FakeUSBDevice())
+        self.assertEqual(self.cache.strings, {})
+        self.cache.serialNumber(FakeUSBDevice())
+        self.assertEqual(self.reader.reads, 4)
+
+    def testReconnectedDeviceIsReadAgain(self):
+        self.cache.serialNumber(FakeUSBDevice(address=2))
+        reconnected = FakeUSBDevice(address=5, strings={3:"A2"}) # e.g. reprogrammed
+        self.assertEqual(self.cache.serialNumber(reconnected), "A2")
+        self.assertEqual(self.reader.reads, 2)
+
+    def testPurge(self):
+        ftdi = [FakeUSBDevice(address=2), FakeUSBDevice(address=3, strings={3:"B2"})]
+        other = FakeUSBDevice(address=4, idVendor=0x1342, idProduct=0x0001)
+        for device in ftdi + [other]:
+            self.cache.serialNumber(device)
+
+        self.cache.purge(ftdi[1:], vidpids=[(0x0403, 0x6001)])
+        self.assertEqual(set(self.cache.strings.keys()), set([self.cache.keyFor(ftdi[1]), self.cache.keyFor(other)]))
+        self.cache.purge([], vidpids=[(0x0403, None)])
+        self.assertEqual(list(self.cache.strings.keys()), [self.cache.keyFor(other)])
+        self.cache.purge([])
+        self.assertEqual(self.cache.strings, {})
+
+    def testConnectedUSBDevicesAfterTransientFailure(self):
+        connected = [FakeUSBDevice(address=2)]
+        originalFind = usb.core.find
+        usb.core.find = lambda find_all=False, **kwargs: iter(connected)
+        try:
+            self.reader.failures = 1
+            self.assertEqual(utils.connectedUSBDevices(serialNumberPattern="A1"), [])
+            self.clock.now += self.cache.failureRetryInterval
+            self.assertEqual(len(utils.connectedUSBDevices(serialNumberPattern="A1")), 1)
+
+            connected = []  # Unplugged: forgotten at the next enumeration
+            self.assertEqual(utils.connectedUSBDevices(serialNumberPattern="A1"), [])
+            self.assertEqual(self.cache.strings, {})
+        finally:
+            usb.core.find = originalFind
+
+    def testClear(self):
+        self.cache.serialNumber(FakeUSBDevice())
+        self.cache.clear()
+        self.assertEqual(self.cache.strings, {})
+        self.assertEqual(self.cache.hits + self.cache.misses, 0)
+
+    def testUSBDeviceDescriptor(self):
+        for i in range(5):
+            descriptor = USBDeviceDescriptor.fromUSBDevice(FakeUSBDevice())
+            self.assertEqual(descriptor.serialNumber, "A1")
+        self.assertEqual(self.reader.reads, 1)
+
+    def testBenchmark(self):
+        self.reader.duration = 0.001
+        devices = [FakeUSBDevice(address=address) for address in range(1, 21)]
+        startTime = time.perf_counter()
+        for i in range(10):
+            for device in devices:
+                self.cache.serialNumber(device)
+        duration = time.perf_counter() - startTime
+        self.assertEqual(self.reader.reads, len(devices))
+        print("\n10 x {0} serial numbers, 1 ms per read: {1:.1f} ms with the cache, {2:.1f} ms without".format(len(devices), duration*1e3, 10*len(devices)*self.reader.duration*1e3))
+
+if __name__ == '__main__':
+    unittest.main()
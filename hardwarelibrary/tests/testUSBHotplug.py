@@ -0,0 +1,241 @@
+import env
+import unittest
+import time
+import socket
+from threading import Thread
+
+from hardwarelibrary.usbhotplug import *
+from hardwarelibrary.devicemanager import DeviceManager, DeviceManagerNotification
+from hardwarelibrary.notificationcenter import NotificationCenter
+from hardwarelibrary.communication import USBDescriptorCache
+
+class FakeUSBDevice:
+    serialNumberReads = 0
+    iSerialNumber = 3
+
+    def __init__(self, bus, address, idVendor=0x0403, idProduct=0x6001, serialNumber="A1"):
+        self.bus = bus
+        self.address = address
+        self.port_numbers = (address,)
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.serialNumber = serialNumber
+
+    @staticmethod
+    def readString(usbDevice, index):
+        """ Replaces usb.util.get_string() in the USBDescriptorCache """
+        FakeUSBDevice.serialNumberReads += 1
+        if usbDevice.serialNumber is None:
+            raise ValueError("The device has no langid")
+        return usbDevice.serialNumber
+
+    def __repr__(self):
+        return "FakeUSBDevice({0}, {1})".format(self.bus, self.address)
+
+class FakeEnumeration:
+    """ An injectable source: returns (copies of) the devices in self.connected,
+    as usb.core.find() returns new objects every time """
+    def __init__(self):
+        self.connected = []
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return [ FakeUSBDevice(device.bus, device.address, device.idVendor, device.idProduct, device.serialNumber) for device in self.connected ]
+
+def uevent(action, subsystem="usb", devtype="usb_device"):
+    return "{0}@/devices/pci0000:00/usb1/1-2\0ACTION={0}\0DEVPATH=/devices/pci0000:00/usb1/1-2\0SUBSYSTEM={1}\0DEVTYPE={2}\0BUSNUM=001\0DEVNUM=007\0PRODUCT=403/6001/600\0".format(action, subsystem, devtype).encode()
+
+class TestUSBDeviceSet(unittest.TestCase):
+    def setUp(self):
+        self.enumeration = FakeEnumeration()
+        self.deviceSet = USBDeviceSet(source=self.enumeration)
+        FakeUSBDevice.serialNumberReads = 0
+        USBDescriptorCache().destroy()
+        USBDescriptorCache().readString = FakeUSBDevice.readString
+
+    def tearDown(self):
+        USBDescriptorCache().destroy()
+
+    def testConnectAndDisconnect(self):
+        self.enumeration.connected = [FakeUSBDevice(1, 2), FakeUSBDevice(1, 3, serialNumber="B2")]
+        connected, disconnected = self.deviceSet.update()
+        self.assertEqual([ (d.bus, d.address) for d in connected ], [(1, 2), (1, 3)])
+        self.assertEqual(disconnected, [])
+
+        self.enumeration.connected = self.enumeration.connected[1:]
+        connected, disconnected = self.deviceSet.update()
+        self.assertEqual(connected, [])
+        self.assertEqual([ (d.bus, d.address) for d in disconnected ], [(1, 2)])
+        self.assertEqual(len(self.deviceSet.devices), 1)
+
+    def testNewObjectsForSameDevicesAreNotChanges(self):
+        self.enumeration.connected = [FakeUSBDevice(1, 2)]
+        self.deviceSet.update()
+        for i in range(10):
+            self.assertEqual(self.deviceSet.update(), ([], []))
+
+    def testSerialNumberReadOnce(self):
+        self.enumeration.connected = [FakeUSBDevice(1, address) for address in range(2, 12)]
+        for i in range(10):
+            self.deviceSet.update()
+        self.assertEqual(FakeUSBDevice.serialNumberReads, 10)
+
+    def testDisconnectedDevicesAreForgotten(self):
+        self.enumeration.connected = [FakeUSBDevice(1, 2), FakeUSBDevice(1, 3)]
+        self.deviceSet.update()
+        self.assertEqual(len(USBDescriptorCache().strings), 2)
+        self.enumeration.connected = self.enumeration.connected[1:]
+        self.deviceSet.update()
+        self.assertEqual(len(USBDescriptorCache().strings), 1)
+
+    def testReconnectedDeviceHasNewKey(self):
+        self.enumeration.connected = [FakeUSBDevice(1, 2)]
+        self.deviceSet.update()
+        self.enumeration.connected = [FakeUSBDevice(1, 5)] # Same device, new address
+        connected, disconnected = self.deviceSet.update()
+        self.assertEqual(len(connected), 1)
+        self.assertEqual(len(disconnected), 1)
+
+    def testKey(self):
+        self.enumeration.connected = [FakeUSBDevice(1, 2, serialNumber=None)]
+        self.deviceSet.update()
+        self.assertEqual(list(self.deviceSet.devicesByKey.keys()), [USBDeviceKey(1, 2, 0x0403, 0x6001, None)])
+
+    def testBenchmarkDiff(self):
+        self.enumeration.connected = [FakeUSBDevice(bus, address) for bus in range(4) for address in range(1, 100)]
+        self.deviceSet.update()
+        startTime = time.perf_counter()
+        for i in range(10):
+            self.deviceSet.update()
+        duration = (time.perf_counter() - startTime)/10
+        print("\nUSBDeviceSet.update() with {0} devices: {1:.2f} ms".format(len(self.enumeration.connected), duration*1e3))
+
+class TestHotplugMonitors(unittest.TestCase):
+    def testParseUevent(self):
+        properties = NetlinkHotplugMonitor.parseUevent(uevent("add"))
+        self.assertEqual(properties["ACTION"], "add")
+        self.assertEqual(properties["SUBSYSTEM"], "usb")
+        self.assertEqual(properties["PRODUCT"], "403/6001/600")
+
+    def testNetlinkEvents(self):
+        kernel, eventSocket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        monitor = NetlinkHotplugMonitor(eventSocket=eventSocket)
+        monitor.settleTime = 0.01
+        try:
+            self.assertFalse(monitor.waitForChange(0.05))
+
+            kernel.send(uevent("add", subsystem="tty", devtype="tty"))
+            kernel.send(uevent("add", devtype="usb_interface"))
+            self.assertFalse(monitor.waitForChange(0.05))
+
+            kernel.send(uevent("add"))
+            kernel.send(uevent("add", devtype="usb_interface"))
+            startTime = time.monotonic()
+            self.assertTrue(monitor.waitForChange(5))
+            self.assertTrue(time.monotonic() - startTime < 1)
+            self.assertEqual([ action for action, properties in monitor.events ], ["add"])
+
+            kernel.send(uevent("remove"))
+            self.assertTrue(monitor.waitForChange(5))
+        finally:
+            monitor.close()
+            kernel.close()
+
+    def testNetlinkFallbackInterval(self):
+        kernel, eventSocket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        monitor = NetlinkHotplugMonitor(eventSocket=eventSocket)
+        monitor.fallbackInterval = 0.1
+        try:
+            self.assertTrue(monitor.waitForChange(1))
+        finally:
+            monitor.close()
+            kernel.close()
+
+    def testWakeUp(self):
+        kernel, eventSocket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for monitor in [NetlinkHotplugMonitor(eventSocket=eventSocket), PollingHotplugMonitor(interval=10)]:
+            Thread(target=lambda: (time.sleep(0.05), monitor.wakeUp())).start()
+            startTime = time.monotonic()
+            self.assertFalse(monitor.waitForChange(5))
+            self.assertTrue(time.monotonic() - startTime < 1)
+            monitor.close()
+        kernel.close()
+
+    def testPolling(self):
+        monitor = PollingHotplugMonitor(interval=0.01)
+        self.assertTrue(monitor.waitForChange(1))
+
+    def testCreate(self):
+        monitor = createHotplugMonitor()
+        if NetlinkHotplugMonitor.isAvailable():
+            self.assertIsInstance(monitor, (NetlinkHotplugMonitor, PollingHotplugMonitor))
+        else:
+            self.assertIsInstance(monitor, PollingHotplugMonitor)
+        monitor.close()
+
+class TestDeviceManagerHotplug(unittest.TestCase):
+    def setUp(self):
+        DeviceManager().destroy()
+        self.manager = DeviceManager()
+        self.enumeration = FakeEnumeration()
+        self.manager.usbDeviceSet.source = self.enumeration
+        self.kernel, eventSocket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.manager.hotplugMonitor = NetlinkHotplugMonitor(eventSocket=eventSocket)
+        self.manager.hotplugMonitor.settleTime = 0.01
+        self.connected = []
+        self.disconnected = []
+        NotificationCenter().addObserver(self, self.handle, DeviceManagerNotification.usbDeviceDidConnect)
+        NotificationCenter().addObserver(self, self.handle, DeviceManagerNotification.usbDeviceDidDisconnect)
+
+    def tearDown(self):
+        NotificationCenter().removeObserver(self)
+        if self.manager.isMonitoring:
+            self.manager.stopMonitoring()
+        self.kernel.close()
+        self.manager.destroy()
+
+    def handle(self, notification):
+        if notification.name == DeviceManagerNotification.usbDeviceDidConnect:
+            self.connected.append(notification.userInfo)
+        else:
+            self.disconnected.append(notification.userInfo)
+
+    def waitFor(self, condition, timeout=2):
+        endTime = time.time() + timeout
+        while not condition() and time.time() < endTime:
+            time.sleep(0.01)
+        return condition()
+
+    def testEnumeratesOnlyAfterEvents(self):
+        self.manager.statusInterval = 0.02
+        self.manager.startMonitoring()
+        self.assertTrue(self.waitFor(lambda: self.enumeration.calls == 1))
+        time.sleep(0.2)
+        self.assertEqual(self.enumeration.calls, 1)
+
+        self.enumeration.connected = [FakeUSBDevice(1, 7, idVendor=0xfff0, idProduct=0x0001)]
+        self.kernel.send(uevent("add"))
+        self.assertTrue(self.waitFor(lambda: len(self.connected) == 1))
+        self.assertEqual(self.enumeration.calls, 2)
+        self.assertEqual(self.connected[0].idVendor, 0xfff0)
+
+        self.enumeration.connected = []
+        self.kernel.send(uevent("remove"))
+        self.assertTrue(self.waitFor(lambda: len(self.disconnected) == 1))
+
+        startTime = time.time()
+        self.manager.stopMonitoring()
+        self.assertTrue(time.time() - startTime < 0.5)
+
+    def testPollingFallback(self):
+        self.manager.hotplugMonitor.close()
+        self.manager.hotplugMonitor = PollingHotplugMonitor(interval=0.02)
+        self.manager.startMonitoring()
+        self.assertTrue(self.waitFor(lambda: self.enumeration.calls >= 1))
+        self.enumeration.connected = [FakeUSBDevice(1, 7, idVendor=0xfff0, idProduct=0x0001)]
+        self.assertTrue(self.waitFor(lambda: len(self.connected) == 1))
+        self.assertTrue(self.enumeration.calls >= 2)
+
+if __name__ == '__main__':
+    unittest.main()
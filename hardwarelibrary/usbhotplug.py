@@ -0,0 +1,184 @@
+import sys
+import time
+import select
+import socket
+from typing import NamedTuple
+from threading import Event
+from hardwarelibrary.communication.usbdescriptorcache import USBDescriptorCache
+
+NETLINK_KOBJECT_UEVENT = 15
+kernelUeventGroup = 1
+
+class USBDeviceKey(NamedTuple):
+    """ Identifies a connected USB device: a device that is reconnected
+    gets another address, hence another key """
+    bus: int
+    address: int
+    idVendor: int
+    idProduct: int
+    serialNumber: str
+
+class USBDeviceSet:
+    """
+    The USB devices returned by source() (connectedUSBDevices() for the
+    DeviceManager) the last time update() was called, by USBDeviceKey.
+    update() returns the devices that were connected and disconnected since,
+    with set operations. The serial number (a control transfer) is only
+    read for the devices that were not there the previous time, through the
+    USBDescriptorCache, which forgets the devices that disconnected.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.devicesByKey = {}
+        self.keysByLocation = {}    # (bus, address, idVendor, idProduct) -> USBDeviceKey
+
+    @property
+    def devices(self) -> list:
+        return list(self.devicesByKey.values())
+
+    @staticmethod
+    def location(usbDevice):
+        return (getattr(usbDevice, 'bus', None), getattr(usbDevice, 'address', None), usbDevice.idVendor, usbDevice.idProduct)
+
+    @staticmethod
+    def serialNumberOf(usbDevice):
+        return USBDescriptorCache().serialNumber(usbDevice)
+
+    def update(self) -> (list, list):
+        """ The devices connected and disconnected since the last update """
+        devicesByKey = {}
+        for usbDevice in self.source():
+            location = self.location(usbDevice)
+            key = self.keysByLocation.get(location)
+            if key is None:
+                key = USBDeviceKey(*location, self.serialNumberOf(usbDevice))
+            devicesByKey[key] = usbDevice
+
+        connected = [ usbDevice for key, usbDevice in devicesByKey.items() if key not in self.devicesByKey ]
+        disconnected = [ usbDevice for key, usbDevice in self.devicesByKey.items() if key not in devicesByKey ]
+
+        for usbDevice in disconnected:
+            USBDescriptorCache().forget(usbDevice)
+
+        self.devicesByKey = devicesByKey
+        self.keysByLocation = { key[:4]: key for key in devicesByKey }
+        return connected, disconnected
+
+class PollingHotplugMonitor:
+    """ Without hotplug events: the USB devices must be enumerated every
+    interval seconds to find out """
+    def __init__(self, interval=0.3):
+        self.interval = interval
+        self.wakeUpEvent = Event()
+
+    def waitForChange(self, timeout=None) -> bool:
+        """ Waits at most timeout seconds for the USB devices to change,
+        returns True if they may have changed (here, always unless woken up) """
+        if timeout is None:
+            timeout = self.interval
+        wokenUp = self.wakeUpEvent.wait(min(timeout, self.interval))
+        self.wakeUpEvent.clear()
+        return not wokenUp
+
+    def wakeUp(self):
+        """ Makes waitForChange() return now, e.g. to stop monitoring """
+        self.wakeUpEvent.set()
+
+    def close(self):
+        pass
+
+class NetlinkHotplugMonitor:
+    """
+    Linux: waits for the uevents that the kernel sends on a netlink socket
+    when a USB device is added or removed, so the devices are enumerated
+    only when they changed (and at least every fallbackInterval, in case an
+    event was lost). A device sends a burst of events (the device, then
+    each interface): they are collected for settleTime before returning.
+    The kernel messages do not need special privileges or udev.
+    """
+    settleTime = 0.05
+    fallbackInterval = 10.0
+
+    @classmethod
+    def isAvailable(cls) -> bool:
+        return sys.platform.startswith('linux') and hasattr(socket, 'AF_NETLINK')
+
+    def __init__(self, eventSocket=None):
+        if eventSocket is None:
+            eventSocket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            try:
+                eventSocket.bind((0, kernelUeventGroup))
+            except OSError:
+                eventSocket.close()
+                raise
+        self.eventSocket = eventSocket
+        self.eventSocket.setblocking(False)
+        self.wakeUpSockets = socket.socketpair()
+        self.lastChange = time.monotonic()
+        self.events = [] # (action, properties) of the USB devices, for inspection
+
+    @staticmethod
+    def parseUevent(data) -> dict:
+        """ The properties of a kernel uevent ("add@/devices/...\\0ACTION=add\\0...") """
+        properties = {}
+        for field in data.split(b'\0')[1:]:
+            key, separator, value = field.partition(b'=')
+            if separator:
+                properties[key.decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+        return properties
+
+    def readEvents(self) -> bool:
+        """ Reads the pending uevents, returns True if a USB device was
+        added or removed """
+        usbDeviceChanged = False
+        while True:
+            try:
+                data = self.eventSocket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return usbDeviceChanged
+
+            properties = self.parseUevent(data)
+            if properties.get('SUBSYSTEM') == 'usb' and properties.get('DEVTYPE') == 'usb_device':
+                if properties.get('ACTION') in ('add', 'remove'):
+                    self.events.append((properties['ACTION'], properties))
+                    del self.events[:-100]
+                    usbDeviceChanged = True
+
+    def waitForChange(self, timeout=None) -> bool:
+        if timeout is None:
+            timeout = self.fallbackInterval
+        endTime = time.monotonic() + timeout
+        while True:
+            remaining = endTime - time.monotonic()
+            if time.monotonic() - self.lastChange >= self.fallbackInterval:
+                self.lastChange = time.monotonic()
+                return True
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self.eventSocket, self.wakeUpSockets[0]], [], [], remaining)
+            if self.wakeUpSockets[0] in readable:
+                self.wakeUpSockets[0].recv(1024)
+                return False
+            if self.eventSocket in readable and self.readEvents():
+                time.sleep(self.settleTime)
+                self.readEvents()
+                self.lastChange = time.monotonic()
+                return True
+
+    def wakeUp(self):
+        self.wakeUpSockets[1].send(b'\0')
+
+    def close(self):
+        self.eventSocket.close()
+        for wakeUpSocket in self.wakeUpSockets:
+            wakeUpSocket.close()
+
+def createHotplugMonitor(pollingInterval=0.3):
+    """ A NetlinkHotplugMonitor where available, a PollingHotplugMonitor otherwise """
+    if NetlinkHotplugMonitor.isAvailable():
+        try:
+            return NetlinkHotplugMonitor()
+        except OSError:
+            pass # e.g. in some containers
+    return PollingHotplugMonitor(pollingInterval)
@@ -1,5 +1,6 @@
 import usb.util
 import re
+from hardwarelibrary.communication.usbdescriptorcache import USBDescriptorCache
 
 
 class NoUSBDeviceConnected(Exception):
@@ -80,11 +81,12 @@ def connectedUSBDevices(vidpids = None, serialNumberPattern=None):
             devices.extend(list(usb.core.find(find_all=True, idVendor=idVendor, idProduct=idProduct)))
     else:
         devices.extend(list(usb.core.find(find_all=True)))
+    USBDescriptorCache().purge(devices, vidpids)
 
     if serialNumberPattern is not None: # A serial number was provided, try to match
         for device in devices:
-            deviceSerialNumber = usb.util.get_string(device, device.iSerialNumber )
-            if re.search(serialNumberPattern, deviceSerialNumber):
+            deviceSerialNumber = USBDescriptorCache().serialNumber(device)
+            if deviceSerialNumber is not None and re.search(serialNumberPattern, deviceSerialNumber):
                 return [device]
 
         return [] # Nothing matched